@@ -11,12 +11,14 @@ import sys as sys
 import io as io
 import time as time
 import traceback as trb
+import copy as copy
 import argparse as argp
-import configparser as cfgp
 import importlib as imp
+import concurrent.futures as conc
 
 from piedpiper.syscallinterface import SysCallInterface
-from piedpiper.notify import send_email_notification
+from piedpiper.configuration import load_configuration
+from piedpiper.filestate import FileStateIndex
 
 __version__ = '0.2'
 
@@ -50,7 +52,10 @@ def piper_argument_parser():
                         help='Specify how many times the pipeline should be repeatedly executed'
                              ' (no change of configuration between executions). For Ruffus, this'
                              ' alleviates the drawback that lazy task loading is not supported'
-                             ' in current versions. Default: 1')
+                             ' in current versions. If the RUN section lists folders to watch (option: watch),'
+                             ' an execution is skipped if the previous one did not change any file in these'
+                             ' folders; the set of changed files is available as args.changed_files. Note that'
+                             ' each execution still checks the complete pipeline. Default: 1')
     parser.add_argument('--debug-only', '-dbg', dest='debug', action='store_true', default=False,
                         help='Dump a full configuration and PYTHONPATH listing to the current working directory'
                              ' after command line and configuration file parsing and exit.')
@@ -65,6 +70,35 @@ def piper_argument_parser():
                              ' and from the stack traceback. This number is divided by two and the first'
                              ' and the last N/2 characters are included in the email. This avoids overly'
                              ' long emails that may take a long time to load. Default: 3000 = 2 * 1500')
+    parser.add_argument('--config-cache', '-cch', dest='configcache', type=str, default='',
+                        help='Specify a folder to cache the parsed and fully interpolated configuration'
+                             ' (e.g. ~/.cache/piedpiper). The cache is only used as long as none of the'
+                             ' configuration files changed. Default: <empty> = no caching')
+    parser.add_argument('--daemon-socket', '-dmn', dest='daemonsocket', type=str, default='',
+                        help='Specify the path to the Unix socket of a Pied Piper daemon. If set, this'
+                             ' (script mode) run is submitted to the daemon instead of being executed'
+                             ' in a new process, i.e. w/o paying the cost of module imports and DRMAA'
+                             ' session initialization.')
+    parser.add_argument('--serve-daemon', '-srv', dest='servedaemon', default=False, action='store_true',
+                        help='Start a Pied Piper daemon listening on the socket specified via --daemon-socket.'
+                             ' If --grid-mode is set, the daemon keeps a DRMAA session open for all runs.')
+    parser.add_argument('--stop-daemon', '-stp', dest='stopdaemon', default=False, action='store_true',
+                        help='Shut down the Pied Piper daemon listening on the socket specified'
+                             ' via --daemon-socket.')
+    parser.add_argument('--job-journal', '-jnl', dest='journal', type=str, default='',
+                        help='Specify a file to journal all DRMAA job submissions. If the runner process'
+                             ' dies, restart with the same journal file to reattach to jobs that are still'
+                             ' running (or to collect their results) instead of submitting them again.'
+                             ' Does not apply to Ruffus grid jobs or runs of a Pied Piper daemon.')
+    parser.add_argument('--run-configs', '-runs', dest='runconfigs', type=str, nargs='+', default=[],
+                        help='Specify full paths to several RUN configuration files. All runs are executed'
+                             ' concurrently in a single Pied Piper process (script mode only), sharing a single'
+                             ' DRMAA session. Job submissions are queued per run and the queues are served'
+                             ' round-robin. Submission limits (Governor section) apply to all runs together'
+                             ' and must not contradict each other.')
+    parser.add_argument('--max-parallel', '-par', dest='maxparallel', type=int, default=0,
+                        help='Specify the maximal number of runs that are executed concurrently if'
+                             ' several RUN configuration files are given. Default: 0 (all runs)')
     args, unknown_args = parser.parse_known_args()
     return args, unknown_args
 
@@ -83,21 +117,101 @@ def piper_configuration_parser(args):
         runcfg = os.environ['PIED_PIPER_CONFIG']
         assert os.path.isfile(runcfg), 'Path to Pied Piper configuration file in shell environment' \
                                        ' is not a valid file path: {}'.format(runcfg)
-    config = cfgp.ConfigParser(interpolation=cfgp.ExtendedInterpolation())
-    # this change makes ConfigParser to read options case-sensitive
-    config.optionxform = str
-    config.read([args.envconfig, runcfg])
-    assert config.has_section('Run'), 'No RUN section found in configuration'
-    assert config.has_option('Run', 'load_path'), 'No LOAD PATH specified in RUN section of configuration'
-    assert config.has_option('Run', 'load_name'), 'No LOAD NAME specified in RUN section of configuration'
-    if config.has_option('Run', 'config'):
-        add_configs = config.get('Run', 'config').split()
-        config.read(add_configs)
+    config = load_configuration(args.envconfig, runcfg, args.configcache)
     if config.has_option('Run', 'mkdir'):
         os.makedirs(config.get('Run', 'mkdir').strip(), exist_ok=True)
     return config
 
 
+def piper_daemon_mode(args):
+    """
+    Start or stop a Pied Piper daemon, or submit the
+    current run to a daemon (thin client mode)
+
+    :param args:
+    :return: exit code
+    """
+    daemon = imp.import_module('piedpiper.daemon')
+    assert not args.journal, 'Job journals are not supported for runs of a Pied Piper daemon'
+    if args.servedaemon:
+        daemon.serve_runs(args.daemonsocket, args.gridmode, args.configcache)
+        return 0
+    if args.stopdaemon:
+        response = daemon.shutdown_daemon(args.daemonsocket)
+    else:
+        assert args.runmode == 'script', 'Only script mode runs can be submitted to a Pied Piper daemon'
+        if not os.path.isfile(args.runconfig):
+            assert 'PIED_PIPER_CONFIG' in os.environ, 'No Pied Piper configuration file found as' \
+                                                      ' command line argument ({}) or as shell' \
+                                                      ' environment variable'.format(args.runconfig)
+            args.runconfig = os.environ['PIED_PIPER_CONFIG']
+        # the daemon runs in a different working directory
+        args.runconfig = os.path.abspath(args.runconfig)
+        args.envconfig = os.path.abspath(args.envconfig)
+        response = daemon.submit_run(args.daemonsocket, vars(args))
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['exit']
+
+
+def piper_multi_mode(args):
+    """
+    Execute several script mode runs concurrently, each run
+    with its own configuration, but all sharing the same
+    SysCallInterface session
+
+    :param args:
+    :return: exit code (maximum over all runs)
+    """
+    assert args.runmode == 'script', 'Concurrent execution of several runs is only supported in script mode'
+    runs = []
+    for runcfg in args.runconfigs:
+        run_args = copy.copy(args)
+        run_args.runconfig = runcfg
+        config = piper_configuration_parser(run_args)
+        mod_name = adapt_sys_path(config)
+        runs.append((run_args, config, mod_name))
+    max_parallel = args.maxparallel if args.maxparallel > 0 else len(runs)
+    exc = 0
+    # all runs share the same limits
+    limits = merge_governor_limits([config for _, config, _ in runs])
+    with SysCallInterface(import_drmaa=args.gridmode, journal=args.journal) as sci_obj:
+        sci_obj.configure_governor(**limits)
+        with conc.ThreadPoolExecutor(max_workers=max_parallel) as pool:
+            running = dict()
+            for run_args, config, mod_name in runs:
+                mod = imp.import_module(mod_name)
+                fut = pool.submit(_repeat_script, mod, run_args, config, sci_obj.derive())
+                running[fut] = run_args.runconfig
+            for fut in conc.as_completed(running):
+                try:
+                    run_exc = fut.result()
+                except Exception as e:
+                    buf = io.StringIO()
+                    trb.print_exc(file=buf)
+                    sys.stderr.write('\nError in run {}: {}'.format(running[fut], e))
+                    sys.stderr.write('\n{}\n'.format(buf.getvalue()))
+                    run_exc = 1
+                exc = max(exc, 0 if run_exc is None else run_exc)
+    return exc
+
+
+def _repeat_script(mod, args, config, sci_obj):
+    """
+    :param mod: the loaded run module
+    :param args:
+    :param config:
+    :param sci_obj:
+    :return: exit code of last execution
+    """
+    exc = 0
+    num_exec = 0
+    while num_exec < args.repeat:
+        exc = mod.run_script(args, config, sci_obj)
+        num_exec += 1
+    return exc
+
+
 def overwrite_ruffus_args(args, config):
     """
     :param args:
@@ -140,6 +254,68 @@ def adapt_sys_path(config):
     return config.get('Run', 'load_name')
 
 
+def configure_governor(config, sci_obj):
+    """
+    Set limits for job submissions if the configuration
+    contains a Governor section (keys: max_rate, max_active,
+    retries, backoff, max_backoff)
+
+    :param config:
+    :param sci_obj:
+    :return: None
+    """
+    if config.has_section('Governor'):
+        sci_obj.configure_governor(**dict(config.items('Governor')))
+    return
+
+
+def merge_governor_limits(configs):
+    """
+    Collect the submission limits of several runs that share
+    a governor; a limit may be set by any number of runs, but
+    all runs setting it have to agree on its value
+
+    :param configs:
+    :return: merged limits
+     :rtype: dict
+    """
+    limits = dict()
+    for config in configs:
+        if not config.has_section('Governor'):
+            continue
+        for key, value in config.items('Governor'):
+            if key in limits:
+                assert float(limits[key]) == float(value), 'Conflicting submission limits for {}' \
+                                                           ' in Governor sections: {} and {}'.format(key,
+                                                                                                     limits[key],
+                                                                                                     value)
+            limits[key] = value
+    return limits
+
+
+def make_file_index(config):
+    """
+    If the RUN section lists folders to watch, create an index
+    of the file states in these folders to track changes between
+    repeated executions of the pipeline. By default, only folders
+    whose listing changed are checked again (set watch_full to
+    check all files in each iteration)
+
+    :param config:
+    :return:
+     :rtype: FileStateIndex or None
+    """
+    if not config.has_option('Run', 'watch'):
+        return None
+    filtpat = '*'
+    if config.has_option('Run', 'watch_pattern'):
+        filtpat = config.get('Run', 'watch_pattern').strip()
+    full = config.has_option('Run', 'watch_full') and config.getboolean('Run', 'watch_full')
+    index = FileStateIndex(config.get('Run', 'watch').split(), filtpat, full)
+    _ = index.update()
+    return index
+
+
 def make_debug_dump(config):
     """
     :param config:
@@ -165,6 +341,7 @@ def notify_user(user_addr, from_addr, start, end, exc, runinfo, terminfo, err, t
     :param limit: character limit for sending error information
     :return:
     """
+    from piedpiper.notify import send_email_notification
     half_limit = limit // 2
     if len(trb) > limit:
         trb = trb[:half_limit] + '\n\n[ ... SIZE LIMIT REACHED ... ]\n\n' + trb[-half_limit:]
@@ -198,6 +375,22 @@ if __name__ == '__main__':
     term_info = 'UNKNOWN'
     try:
         args, unknown_args = piper_argument_parser()
+        if args.daemonsocket:
+            run_info = os.path.basename(args.runconfig) + ' / daemon'
+            exc = piper_daemon_mode(args)
+            end = time.ctime()
+            if args.notify and not (args.servedaemon or args.stopdaemon):
+                notify_user(args.notify, args.fromaddr, start, end, exc,
+                            run_info, os.environ.get('STY', 'none'), 'none', 'none', args.sizelimit)
+            sys.exit(exc)
+        if args.runconfigs:
+            run_info = ' / '.join([os.path.basename(f) for f in args.runconfigs])
+            exc = piper_multi_mode(args)
+            end = time.ctime()
+            if args.notify:
+                notify_user(args.notify, args.fromaddr, start, end, exc,
+                            run_info, os.environ.get('STY', 'none'), 'none', 'none', args.sizelimit)
+            sys.exit(exc)
         config = piper_configuration_parser(args)
         if args.runmode == 'ruffus':
             cmdline = imp.import_module('ruffus.cmdline')
@@ -219,9 +412,23 @@ if __name__ == '__main__':
             term_info = 'none'
         num_exec = 0
         pipe = None
-        with SysCallInterface(imp_ruffus_drmaa, imp_drmaa) as sci_obj:
+        file_index = make_file_index(config)
+        args.changed_files = None
+        # see FileStateIndex.needs_update
+        args.file_index = file_index
+        with SysCallInterface(imp_ruffus_drmaa, imp_drmaa, journal=args.journal) as sci_obj:
+            configure_governor(config, sci_obj)
             mod = imp.import_module(mod_name)
             while num_exec < args.repeat:
+                if file_index is not None and num_exec > 0:
+                    # if the previous execution did not change any file
+                    # in the watched folders, all subsequent executions
+                    # would just re-check the same (complete) state;
+                    # otherwise, jobs using file_index.needs_update are
+                    # only checked if their files changed
+                    args.changed_files = file_index.update()
+                    if not args.changed_files:
+                        break
                 if args.runmode == 'ruffus':
                     pipe = mod.build_pipeline(args, config, sci_obj, pipe)
                     cmdline.run(args)
@@ -0,0 +1,291 @@
+# coding=utf-8
+
+"""
+Module to load the Pied Piper configuration (ENVIRONMENT and RUN config files plus
+all files listed in Run.config). All interpolations are resolved exactly once when
+the files are parsed, and the resolved values are stored in a read-only object.
+If requested, the resolved configuration is cached on disk; the cache is keyed by
+the paths and the modification times of all files that went into it, so repeated
+launches of the same run do not have to parse the INI files again.
+"""
+
+import os as os
+import json as json
+import hashlib as hsl
+import configparser as cfgp
+from types import MappingProxyType
+
+_CACHE_VERSION = 1
+
+_UNSET = object()
+
+
+class FrozenConfig(object):
+    """
+    Read-only configuration object with all values interpolated.
+    Supports the reading part of ConfigParser's interface (get, items,
+    sections, options, has_section etc.) that is used by the pipelines,
+    but each lookup is a simple dictionary access
+    """
+    def __init__(self, sections):
+        """
+        :param sections: section name -> (option name -> value)
+         :type: dict of dict
+        """
+        self._sections = dict()
+        for name, options in sections.items():
+            self._sections[name] = MappingProxyType(dict(options))
+
+    def sections(self):
+        """
+        :return: list of section names
+         :rtype: list of str
+        """
+        return list(self._sections.keys())
+
+    def options(self, section):
+        """
+        :param section:
+        :return: list of option names
+         :rtype: list of str
+        """
+        try:
+            return list(self._sections[section].keys())
+        except KeyError:
+            raise cfgp.NoSectionError(section)
+
+    def set(self, section, option, value=None):
+        """
+        :raises: TypeError, the configuration is read-only
+        """
+        raise TypeError('Configuration is read-only, cannot set option {} in section {}'.format(option, section))
+
+    def has_section(self, section):
+        """
+        :param section:
+        :return:
+         :rtype: bool
+        """
+        return section in self._sections
+
+    def has_option(self, section, option):
+        """
+        :param section:
+        :param option:
+        :return:
+         :rtype: bool
+        """
+        return section in self._sections and option in self._sections[section]
+
+    def get(self, section, option, *, fallback=_UNSET, **kwargs):
+        """
+        Same semantics as ConfigParser.get; any other keyword
+        arguments (raw, vars) are accepted for compatibility
+        but ignored since all values are already interpolated
+
+        :param section:
+        :param option:
+        :param fallback:
+        :return:
+         :rtype: str
+        """
+        try:
+            opts = self._sections[section]
+        except KeyError:
+            if fallback is _UNSET:
+                raise cfgp.NoSectionError(section)
+            return fallback
+        try:
+            return opts[option]
+        except KeyError:
+            if fallback is _UNSET:
+                raise cfgp.NoOptionError(option, section)
+            return fallback
+
+    def getint(self, section, option, *, fallback=_UNSET, **kwargs):
+        """
+        :return:
+         :rtype: int
+        """
+        val = self.get(section, option, fallback=fallback)
+        return val if val is fallback else int(val)
+
+    def getfloat(self, section, option, *, fallback=_UNSET, **kwargs):
+        """
+        :return:
+         :rtype: float
+        """
+        val = self.get(section, option, fallback=fallback)
+        return val if val is fallback else float(val)
+
+    def getboolean(self, section, option, *, fallback=_UNSET, **kwargs):
+        """
+        :return:
+         :rtype: bool
+        """
+        val = self.get(section, option, fallback=fallback)
+        if val is fallback:
+            return val
+        try:
+            return cfgp.ConfigParser.BOOLEAN_STATES[val.lower()]
+        except KeyError:
+            raise ValueError('Not a boolean: {}'.format(val))
+
+    def items(self, section):
+        """
+        :param section:
+        :return: list of (option, value) pairs
+         :rtype: list of tuple
+        """
+        try:
+            return list(self._sections[section].items())
+        except KeyError:
+            raise cfgp.NoSectionError(section)
+
+    def __getitem__(self, section):
+        return self._sections[section]
+
+    def __contains__(self, section):
+        return section in self._sections
+
+    def write(self, fileobj):
+        """
+        Write configuration in INI format, e.g. for a debug dump
+
+        :param fileobj: file-like object opened in text mode
+        :return: None
+        """
+        for name, options in self._sections.items():
+            _ = fileobj.write('[{}]\n'.format(name))
+            for key, value in options.items():
+                value = str(value).replace('\n', '\n\t')
+                _ = fileobj.write('{} = {}\n'.format(key, value))
+            _ = fileobj.write('\n')
+        return
+
+
+def freeze_config(config):
+    """
+    Resolve all interpolations of a ConfigParser object
+
+    :param config:
+     :type: configparser.ConfigParser
+    :return:
+     :rtype: FrozenConfig
+    """
+    sections = dict()
+    for name in config.sections():
+        sections[name] = dict(config.items(name))
+    return FrozenConfig(sections)
+
+
+def _file_state(filepath):
+    """
+    :param filepath:
+    :return: path, mtime (ns) and size, or None for both if file is missing
+     :rtype: list
+    """
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return [filepath, None, None]
+    return [filepath, st.st_mtime_ns, st.st_size]
+
+
+def _parse_config_files(envconfig, runconfig):
+    """
+    :param envconfig:
+    :param runconfig:
+    :return: the parsed configuration and the state of all files read
+     (recorded before reading to never cache outdated content)
+     :rtype: configparser.ConfigParser, list of list
+    """
+    config = cfgp.ConfigParser(interpolation=cfgp.ExtendedInterpolation())
+    # this change makes ConfigParser to read options case-sensitive
+    config.optionxform = str
+    main_configs = [os.path.abspath(envconfig), os.path.abspath(runconfig)]
+    file_states = [_file_state(f) for f in main_configs]
+    config.read(main_configs)
+    assert config.has_section('Run'), 'No RUN section found in configuration'
+    assert config.has_option('Run', 'load_path'), 'No LOAD PATH specified in RUN section of configuration'
+    assert config.has_option('Run', 'load_name'), 'No LOAD NAME specified in RUN section of configuration'
+    if config.has_option('Run', 'config'):
+        add_configs = [os.path.abspath(f) for f in config.get('Run', 'config').split()]
+        file_states.extend([_file_state(f) for f in add_configs])
+        config.read(add_configs)
+    return config, file_states
+
+
+def _cache_path(cachedir, envconfig, runconfig):
+    """
+    The cache file name depends on the two main configuration files
+    and the current working directory (relative paths in Run.config)
+    """
+    key = '\n'.join([os.getcwd(), os.path.abspath(envconfig), os.path.abspath(runconfig)])
+    key = hsl.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(cachedir, 'ppconfig_{}.json'.format(key))
+
+
+def _read_cache(cachefile):
+    """
+    :param cachefile:
+    :return: the cached configuration if it is still valid, None otherwise
+     :rtype: FrozenConfig or None
+    """
+    try:
+        with open(cachefile, 'r') as infile:
+            cached = json.load(infile)
+    except (OSError, ValueError):
+        return None
+    if cached.get('version', None) != _CACHE_VERSION:
+        return None
+    for state in cached['files']:
+        if _file_state(state[0]) != state:
+            return None
+    return FrozenConfig(cached['sections'])
+
+
+def _write_cache(cachefile, file_states, config):
+    """
+    Write the cache atomically, i.e. concurrent launches
+    never see a partially written cache file
+    """
+    os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+    cached = {'version': _CACHE_VERSION,
+              'files': file_states,
+              'sections': {s: dict(config[s]) for s in config.sections()}}
+    tmpfile = '{}.{}.tmp'.format(cachefile, os.getpid())
+    with open(tmpfile, 'w') as outfile:
+        json.dump(cached, outfile)
+    os.replace(tmpfile, cachefile)
+    return
+
+
+def load_configuration(envconfig, runconfig, cachedir=None):
+    """
+    Read the ENVIRONMENT and RUN configuration files and all additional
+    files listed in Run.config, resolve all interpolations and return
+    a read-only configuration object. If a cache directory is specified,
+    the result is read from/written to the cache. A cached configuration
+    is only used if none of the files involved has changed since.
+
+    :param envconfig: path to ENVIRONMENT configuration file
+    :param runconfig: path to RUN configuration file
+    :param cachedir: cache folder, set to None or empty string to deactivate
+    :return:
+     :rtype: FrozenConfig
+    """
+    cachefile = None
+    if cachedir:
+        cachefile = _cache_path(cachedir, envconfig, runconfig)
+        config = _read_cache(cachefile)
+        if config is not None:
+            return config
+    parsed, file_states = _parse_config_files(envconfig, runconfig)
+    config = freeze_config(parsed)
+    if cachefile is not None:
+        try:
+            _write_cache(cachefile, file_states, config)
+        except OSError:
+            pass  # caching is an optimization, just continue w/o
+    return config
@@ -0,0 +1,240 @@
+# coding=utf-8
+
+"""
+Module implementing a persistent runner process (daemon) for script mode runs.
+The daemon keeps all modules imported and a single SysCallInterface (and thus
+a DRMAA session in grid mode) open. Clients connect via a Unix socket and submit
+runs; each run is executed in the daemon process and its output is sent back to
+the client. This avoids paying Python startup, module imports and DRMAA session
+initialization for each (small) run.
+
+Protocol: one JSON object per line, one request/response per connection.
+"""
+
+import os as os
+import io as io
+import sys as sys
+import json as json
+import errno as errno
+import socket as socket
+import argparse as argp
+import threading as thd
+import traceback as trb
+import importlib as imp
+import socketserver as sockserv
+import contextlib as ctl
+
+from piedpiper.syscallinterface import SysCallInterface
+from piedpiper.configuration import load_configuration
+
+
+def _import_run_module(mod_name, loaded):
+    """
+    Import the pipeline module - if it has been imported before,
+    it is only reloaded if its source file has changed in the meantime
+
+    :param mod_name:
+    :param loaded: module name -> mtime of the module file when imported
+     :type: dict
+    :return:
+    """
+    if mod_name in sys.modules and mod_name in loaded:
+        mod = sys.modules[mod_name]
+        try:
+            mtime = os.stat(mod.__file__).st_mtime_ns
+        except (OSError, AttributeError, TypeError):
+            mtime = None
+        if mtime is not None and mtime == loaded[mod_name]:
+            return mod
+        mod = imp.reload(mod)
+    else:
+        mod = imp.import_module(mod_name)
+    try:
+        loaded[mod_name] = os.stat(mod.__file__).st_mtime_ns
+    except (OSError, AttributeError, TypeError):
+        loaded[mod_name] = None
+    return mod
+
+
+def _exit_code(exit_exc):
+    """
+    Exit code as the interpreter would set it for sys.exit(code)
+
+    :param exit_exc:
+     :type: SystemExit
+    :return: exit code
+     :rtype: int
+    """
+    if exit_exc.code is None:
+        return 0
+    if isinstance(exit_exc.code, int):
+        return exit_exc.code
+    sys.stderr.write('{}\n'.format(exit_exc.code))
+    return 1
+
+
+def _execute_run(request, sci_obj, cachedir, loaded):
+    """
+    Execute a single script mode run inside the daemon process
+
+    :param request: the parsed command line arguments of the client
+     :type: dict
+    :param sci_obj:
+     :type: SysCallInterface
+    :param cachedir: configuration cache folder
+    :param loaded: see _import_run_module
+    :return: exit code
+     :rtype: int
+    """
+    args = argp.Namespace(**request['args'])
+    assert args.runmode == 'script', 'Pied Piper daemon only supports script mode runs'
+    # the journal belongs to the DRMAA session, which is shared by all runs of the daemon
+    assert not getattr(args, 'journal', ''), 'Pied Piper daemon does not support job journals'
+    if args.gridmode:
+        assert sci_obj.session is not None, 'Grid mode run submitted, but daemon' \
+                                            ' was started w/o DRMAA session'
+    os.chdir(request['cwd'])
+    config = load_configuration(args.envconfig, args.runconfig, cachedir)
+    if config.has_option('Run', 'mkdir'):
+        os.makedirs(config.get('Run', 'mkdir').strip(), exist_ok=True)
+    for p in config.get('Run', 'load_path').split():
+        if p not in sys.path:
+            sys.path.insert(0, p)
+    # limits of previous runs do not apply
+    sci_obj.governor.reset()
+    if config.has_section('Governor'):
+        sci_obj.configure_governor(**dict(config.items('Governor')))
+    mod = _import_run_module(config.get('Run', 'load_name'), loaded)
+    exc = 0
+    num_exec = 0
+    while num_exec < args.repeat:
+        exc = mod.run_script(args, config, sci_obj)
+        num_exec += 1
+    return 0 if exc is None else exc
+
+
+class _RunHandler(sockserv.StreamRequestHandler):
+    """
+    Handles one client connection, i.e. one submitted run
+    """
+    def handle(self):
+        """
+        :return: None
+        """
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        if request.get('command', 'run') == 'shutdown':
+            response = {'exit': 0, 'stdout': 'Pied Piper daemon shutting down\n', 'stderr': ''}
+            # shutdown() blocks until serve_forever() returns, i.e.
+            # cannot be called from the thread handling this request
+            thd.Thread(target=self.server.shutdown).start()
+        else:
+            out, err = io.StringIO(), io.StringIO()
+            cwd = os.getcwd()
+            try:
+                with ctl.redirect_stdout(out), ctl.redirect_stderr(err):
+                    try:
+                        exc = _execute_run(request, self.server.sci_obj,
+                                           self.server.cachedir, self.server.loaded)
+                    except SystemExit as e:
+                        # sys.exit() in a pipeline ends the run, not the daemon
+                        exc = _exit_code(e)
+            except Exception as e:
+                trb.print_exc(file=err)
+                err.write('\nError: {}\n'.format(e))
+                exc = 1
+            finally:
+                os.chdir(cwd)
+            response = {'exit': exc, 'stdout': out.getvalue(), 'stderr': err.getvalue()}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+        return
+
+
+def _remove_stale_socket(socket_path):
+    """
+    Remove the socket of a crashed daemon, i.e. a socket
+    file that no process is listening on anymore
+
+    :param socket_path:
+    :return: None
+    :raises: RuntimeError if a daemon is listening on the socket
+    """
+    if not os.path.exists(socket_path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError as e:
+            if e.errno == errno.ECONNREFUSED:
+                os.unlink(socket_path)
+                return
+            if e.errno == errno.ENOENT:
+                return
+            raise
+    raise RuntimeError('A Pied Piper daemon is already listening on socket {}'.format(socket_path))
+
+
+def serve_runs(socket_path, gridmode=False, cachedir=None):
+    """
+    Start the daemon and process submitted runs one at a time
+    until a shutdown request is received or the process is killed
+
+    :param socket_path: path of the Unix socket to listen on
+    :param gridmode: open a DRMAA session that is kept open for all runs
+    :param cachedir: configuration cache folder
+    :return: None
+    """
+    _remove_stale_socket(socket_path)
+    with SysCallInterface(import_drmaa=gridmode) as sci_obj:
+        old_umask = os.umask(0o177)
+        try:
+            server = sockserv.UnixStreamServer(socket_path, _RunHandler)
+        finally:
+            os.umask(old_umask)
+        server.sci_obj = sci_obj
+        server.cachedir = cachedir
+        server.loaded = dict()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
+    return
+
+
+def submit_run(socket_path, args, cwd=None):
+    """
+    Thin client: submit a run to the daemon and wait for it to finish
+
+    :param socket_path:
+    :param args: command line arguments of the run
+     :type: dict
+    :param cwd: working directory for the run, defaults to current one
+    :return: response with exit code, stdout and stderr of the run
+     :rtype: dict
+    """
+    request = {'command': 'run', 'args': args, 'cwd': os.getcwd() if cwd is None else cwd}
+    return _send_request(socket_path, request)
+
+
+def shutdown_daemon(socket_path):
+    """
+    :param socket_path:
+    :return:
+     :rtype: dict
+    """
+    return _send_request(socket_path, {'command': 'shutdown'})
+
+
+def _send_request(socket_path, request):
+    """
+    :param socket_path:
+    :param request:
+    :return:
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as infile:
+            response = infile.readline()
+    assert response, 'Pied Piper daemon closed connection w/o response'
+    return json.loads(response.decode('utf-8'))
@@ -0,0 +1,141 @@
+# coding=utf-8
+
+"""
+Module to resolve the effect of activating a (Conda) environment once and to reuse
+the resulting set of environment variables for all jobs. Instead of wrapping each
+command in "source activate ENV && ... ; source deactivate", the snapshot is passed
+directly as job environment. This removes the activation overhead from every job
+and avoids running the activation scripts concurrently.
+The snapshot is resolved from a clean base environment, i.e. variables that
+describe the submitting host or login session are not passed on to the jobs.
+The snapshot is cached in memory and optionally on disk; the disk cache is invalidated
+if the environment itself changes (modification time of its conda-meta folder).
+"""
+
+import os as os
+import json as json
+import hashlib as hsl
+import threading as thd
+import subprocess as sp
+
+# shell-internal variables that must not be part of a job environment
+_EXCLUDE_VARS = ('_', 'SHLVL', 'PWD', 'OLDPWD', 'PS1')
+
+# variables describing the host, the login session or the grid job of the
+# process resolving the snapshot; they are set anew for each job, and would
+# otherwise change the cache key with every login
+_HOST_VARS = ('HOSTNAME', 'HOST', 'TMPDIR', 'TMP', 'TEMP', 'DISPLAY', 'TERM', 'MAIL',
+              'NHOSTS', 'NSLOTS', 'NQUEUES', 'QUEUE', 'REQUEST', 'ENVIRONMENT', 'RESTARTED', 'ARC')
+_HOST_PREFIXES = ('SSH_', 'XDG_', 'JOB_', 'SGE_', 'PE_', 'SLURM_', 'KRB5', 'DBUS_')
+
+# default base environment: the current environment reduced to these variables
+_BASE_VARS = ('PATH', 'HOME', 'USER', 'LOGNAME', 'SHELL', 'LANG', 'LANGUAGE', 'TZ')
+_BASE_PREFIXES = ('LC_', 'CONDA')
+
+
+def _is_host_var(var):
+    """
+    :param var:
+    :return: True if the variable is specific to host or session
+     :rtype: bool
+    """
+    return var in _HOST_VARS or var.startswith(_HOST_PREFIXES) or var.startswith('BASH_FUNC_')
+
+
+def _base_environment(base_env):
+    """
+    :param base_env: environment to start from, None = allowlisted
+     variables of the current environment (see _BASE_VARS)
+    :return: base environment w/o host and session variables
+     :rtype: dict
+    """
+    if base_env is None:
+        base_env = dict([(var, val) for var, val in os.environ.items()
+                         if var in _BASE_VARS or var.startswith(_BASE_PREFIXES)])
+    return dict([(var, val) for var, val in base_env.items() if not _is_host_var(var)])
+
+_SNAPSHOTS = dict()
+_SNAPSHOT_LOCK = thd.Lock()
+
+
+def _env_state(snapshot):
+    """
+    :param snapshot:
+    :return: mtime of the conda-meta folder of the activated environment
+    """
+    prefix = snapshot.get('CONDA_PREFIX', None)
+    if prefix is None:
+        return None
+    try:
+        return os.stat(os.path.join(prefix, 'conda-meta')).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _activate_environment(env, base_env):
+    """
+    :param env: name or path of the environment
+    :param base_env: environment in which the activation is executed
+    :return: all environment variables after activation
+     :rtype: dict
+    """
+    cmd = 'source activate {} > /dev/null && env -0'.format(env)
+    proc = sp.Popen(cmd, env=base_env, shell=True, stdout=sp.PIPE,
+                    stderr=sp.PIPE, executable='/bin/bash')
+    out, err = proc.communicate()
+    assert proc.returncode == 0, 'Activating environment {} failed with exit code {}:' \
+                                 ' {}'.format(env, proc.returncode, err.decode('utf-8'))
+    snapshot = dict()
+    for item in out.decode('utf-8').split('\0'):
+        if '=' not in item:
+            continue
+        var, val = item.split('=', 1)
+        if var not in _EXCLUDE_VARS and not _is_host_var(var):
+            snapshot[var] = val
+    return snapshot
+
+
+def resolve_environment(env, base_env=None, cachedir=None):
+    """
+    Activate the environment once in a shell and return the resulting set of
+    environment variables, which can then be used as job environment
+
+    :param env: name or path of the environment (as for "source activate")
+    :param base_env: environment in which the activation is resolved, e.g.
+     the configured job environment; defaults to a clean environment with
+     a few variables (PATH, HOME, USER, locale, Conda) of the current one.
+     Host, session and grid engine variables are always removed
+     :type: dict
+    :param cachedir: folder for the on-disk cache, None = memory only
+    :return: environment variables after activation
+     :rtype: dict
+    """
+    base_env = _base_environment(base_env)
+    key = json.dumps([env, sorted(base_env.items())])
+    key = hsl.sha1(key.encode('utf-8')).hexdigest()
+    with _SNAPSHOT_LOCK:
+        if key in _SNAPSHOTS:
+            return dict(_SNAPSHOTS[key])
+        cachefile = None
+        if cachedir:
+            cachefile = os.path.join(cachedir, 'ppenv_{}.json'.format(key))
+            try:
+                with open(cachefile, 'r') as infile:
+                    cached = json.load(infile)
+                if cached['state'] is not None and cached['state'] == _env_state(cached['snapshot']):
+                    _SNAPSHOTS[key] = cached['snapshot']
+                    return dict(cached['snapshot'])
+            except (OSError, ValueError, KeyError):
+                pass
+        snapshot = _activate_environment(env, base_env)
+        _SNAPSHOTS[key] = snapshot
+        if cachefile is not None:
+            try:
+                os.makedirs(cachedir, exist_ok=True)
+                tmpfile = '{}.{}.tmp'.format(cachefile, os.getpid())
+                with open(tmpfile, 'w') as outfile:
+                    json.dump({'state': _env_state(snapshot), 'snapshot': snapshot}, outfile)
+                os.replace(tmpfile, cachefile)
+            except OSError:
+                pass
+    return dict(snapshot)
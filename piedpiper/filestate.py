@@ -0,0 +1,174 @@
+# coding=utf-8
+
+"""
+Module to keep track of the state of files in a set of folders between repeated
+executions of a pipeline (see --run-repeat). The index records modification time
+and size of all files and reports the set of changed (new, modified or removed)
+files since the last update. This way, the runner can skip iterations that would
+not find anything to do. Within an iteration, Ruffus pipelines can restrict the
+up-to-date checks to the jobs whose files changed by passing needs_update to
+@check_if_uptodate (the index is available as args.file_index).
+To keep the number of stat calls on shared file systems low, a folder is only
+listed again (and its files checked) if its own modification time changed, i.e.
+if files were created, removed or renamed in it. Files that are rewritten in place
+are thus only detected when scanning in full (with staged outputs, see jobfunctions,
+all outputs are renamed into place).
+"""
+
+import os as os
+import time as time
+import fnmatch as fnm
+
+# folders modified less than this many seconds before a scan are
+# listed again in the next scan (coarse timestamp resolution)
+_SETTLE_TIME = 2
+
+
+class FileStateIndex(object):
+    """
+    Stat cache for all files below a set of top folders
+    """
+    def __init__(self, folders, filtpat='*', full=False):
+        """
+        :param folders: list of top folders to watch (recursively)
+        :param filtpat: only record files matching this pattern
+        :param full: check all files in each scan, not only those in modified folders
+        """
+        self.folders = [os.path.abspath(f) for f in folders]
+        self.filtpat = filtpat
+        self.full = full
+        self.state = None
+        self.changed = None
+        self._dirs = dict()
+
+    def _list_folder(self, folder):
+        """
+        :param folder:
+        :return: states of matching files (path -> (mtime in ns, size)) and subfolders
+         :rtype: dict, list of str
+        """
+        files, subdirs = dict(), []
+        for entry in list(os.scandir(folder)):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif fnm.fnmatch(entry.name, self.filtpat):
+                    st = entry.stat()
+                    files[entry.path] = st.st_mtime_ns, st.st_size
+            except OSError:
+                continue
+        return files, subdirs
+
+    def _scan_folder(self, folder, state, dirs, now):
+        """
+        :param folder:
+        :param state: file path -> (mtime in ns, size)
+         :type: dict
+        :param dirs: folder -> (mtime in ns, files, subfolders) of this scan
+         :type: dict
+        :param now: time of the scan in ns
+        :return: None
+        """
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+            cached = self._dirs.get(folder, None)
+            if self.full or cached is None or cached[0] != mtime:
+                files, subdirs = self._list_folder(folder)
+            else:
+                files, subdirs = cached[1], cached[2]
+        except OSError:
+            return  # folder does not (yet) exist or vanished
+        if now - mtime > _SETTLE_TIME * 1e9:
+            dirs[folder] = mtime, files, subdirs
+        state.update(files)
+        for sub in subdirs:
+            self._scan_folder(sub, state, dirs, now)
+        return
+
+    def snapshot(self):
+        """
+        :return: current state of all watched files
+         :rtype: dict
+        """
+        state, dirs = dict(), dict()
+        now = time.time() * 1e9
+        for folder in self.folders:
+            self._scan_folder(folder, state, dirs, now)
+        self._dirs = dirs
+        return state
+
+    def update(self):
+        """
+        Rescan all folders and record the new state
+
+        :return: paths of files that are new, modified or removed
+         since the last update (all files for the first update)
+         :rtype: set of str
+        """
+        current = self.snapshot()
+        if self.state is None:
+            changed = set(current.keys())
+        else:
+            changed = set(self.state.keys()) ^ set(current.keys())
+            for path, state in current.items():
+                if path in self.state and self.state[path] != state:
+                    changed.add(path)
+        self.state = current
+        self.changed = changed
+        return changed
+
+    def _is_watched(self, path):
+        """
+        :param path: absolute path
+        :return: True if the path is below one of the watched folders and matches the filter
+         :rtype: bool
+        """
+        return fnm.fnmatch(os.path.basename(path), self.filtpat) and \
+            any([path.startswith(f + os.sep) for f in self.folders])
+
+    def needs_update(self, inputs, outputs, *extras):
+        """
+        Can be used with Ruffus' @check_if_uptodate(args.file_index.needs_update):
+        a job whose (watched) input and output files all exist and did not change
+        in the previous iteration is up to date without checking any timestamps.
+        All other jobs are checked as by Ruffus' default check, i.e. they have to
+        be run if any output is missing or older than any of the inputs
+
+        :param inputs: input file(s) of the job
+        :param outputs: output file(s) of the job
+        :param extras: ignored
+        :return: True if the job has to be run, and the reason
+         :rtype: bool, str
+        """
+        inputs, outputs = _flatten(inputs), _flatten(outputs)
+        if self.changed is not None and outputs and \
+                all([self._is_watched(f) and f in self.state for f in outputs]) and \
+                all([self._is_watched(f) for f in inputs]) and \
+                not any([f in self.changed for f in inputs + outputs]):
+            return False, 'No input or output file changed since last iteration'
+        try:
+            oldest = min([os.stat(f).st_mtime_ns for f in outputs])
+        except (OSError, ValueError):
+            return True, 'Missing output file(s): {}'.format(outputs)
+        for f in inputs:
+            try:
+                if os.stat(f).st_mtime_ns > oldest:
+                    return True, 'Input file is newer than output: {}'.format(f)
+            except OSError:
+                continue
+        return False, 'All output files up to date'
+
+
+def _flatten(paths):
+    """
+    :param paths: path or (nested) list of paths, other values are ignored
+    :return: list of absolute paths
+     :rtype: list of str
+    """
+    if isinstance(paths, str):
+        return [os.path.abspath(paths)]
+    flat = []
+    if isinstance(paths, (list, tuple, set)):
+        for p in paths:
+            flat.extend(_flatten(p))
+    return flat
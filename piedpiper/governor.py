@@ -0,0 +1,250 @@
+# coding=utf-8
+
+"""
+Module to throttle job submissions to the grid engine. The governor limits
+the rate of submissions (submissions per second) and the number of jobs that
+are queued or running at the same time (backpressure), and retries failed
+submissions with exponential backoff. All limits are optional; an unconfigured
+governor does not restrict submissions at all.
+"""
+
+import sys as sys
+import time as time
+import threading as thd
+import collections as col
+
+
+class SubmissionGovernor(object):
+    """
+    Shared by all job submission callables of a SysCallInterface
+    (and of all interfaces derived from it). Submissions waiting for
+    room are queued per owner (pipeline, see for_owner) and the queues
+    are served round-robin
+    """
+    def __init__(self, max_rate=0., max_active=0, retries=0, backoff=1., max_backoff=60.):
+        """
+        :param max_rate: maximal number of submissions per second, 0 = no limit
+        :param max_active: maximal number of jobs queued or running, 0 = no limit
+        :param retries: number of retries if a submission fails
+        :param backoff: initial waiting time in seconds before retrying a submission
+        :param max_backoff: maximal waiting time in seconds before retrying
+        """
+        self._cond = thd.Condition(thd.Lock())
+        self._active = 0
+        self._waiting = col.OrderedDict()
+        self._next_submit = 0.
+        self.max_rate = 0.
+        self.max_active = 0
+        self.retries = 0
+        self.backoff = 1.
+        self.max_backoff = 60.
+        self.configure(max_rate, max_active, retries, backoff, max_backoff)
+
+    def configure(self, max_rate=None, max_active=None, retries=None, backoff=None, max_backoff=None):
+        """
+        Change limits, None leaves the respective value unchanged. Can be called
+        at any time, waiting submissions are re-evaluated against the new limits
+
+        :return: None
+        """
+        with self._cond:
+            if max_rate is not None:
+                self.max_rate = float(max_rate)
+            if max_active is not None:
+                self.max_active = int(max_active)
+            if retries is not None:
+                self.retries = int(retries)
+            if backoff is not None:
+                self.backoff = float(backoff)
+            if max_backoff is not None:
+                self.max_backoff = float(max_backoff)
+            assert self.max_rate >= 0 and self.max_active >= 0 and self.retries >= 0, \
+                'Submission limits must not be negative: rate {} - active {} - retries {}'.format(self.max_rate,
+                                                                                                  self.max_active,
+                                                                                                  self.retries)
+            self._cond.notify_all()
+        return
+
+    def reset(self):
+        """
+        Remove all limits (as for a new governor), e.g. before
+        a new run that does not configure any limits
+
+        :return: None
+        """
+        self.configure(0., 0, 0, 1., 60.)
+        return
+
+    @property
+    def active(self):
+        """
+        :return: number of jobs currently counted as queued or running
+         :rtype: int
+        """
+        return self._active
+
+    def acquire(self, num_jobs=1, owner=None):
+        """
+        Block until there is room for num_jobs more active jobs. A single
+        submission with more jobs than allowed in total (e.g. a large array
+        job) has to wait until no other job is active anymore
+
+        :param num_jobs:
+        :param owner: any hashable identifying the pipeline
+        :return: None
+        """
+        token = object()
+        with self._cond:
+            self._waiting.setdefault(owner, col.deque()).append(token)
+            while next(iter(self._waiting.values()))[0] is not token or \
+                    (0 < self.max_active < self._active + num_jobs and self._active > 0):
+                self._cond.wait()
+            queue = self._waiting.pop(owner)
+            _ = queue.popleft()
+            if queue:
+                # served last, i.e. moved to the end
+                self._waiting[owner] = queue
+            self._active += num_jobs
+            self._cond.notify_all()
+        return
+
+    def release(self, num_jobs=1):
+        """
+        :param num_jobs:
+        :return: None
+        """
+        with self._cond:
+            self._active = max(0, self._active - num_jobs)
+            self._cond.notify_all()
+        return
+
+    def throttle(self):
+        """
+        Reserve the next submission time slot and
+        sleep until it has come
+
+        :return: None
+        """
+        with self._cond:
+            if self.max_rate <= 0:
+                return
+            now = time.monotonic()
+            slot = max(now, self._next_submit)
+            self._next_submit = slot + 1. / self.max_rate
+        if slot > now:
+            time.sleep(slot - now)
+        return
+
+    def submit(self, submit_fun, *args, **kwargs):
+        """
+        Call the submission function respecting the rate limit. If the call
+        raises an exception, retry with exponential backoff
+
+        :param submit_fun: e.g. session.runJob
+        :return: return value of submit_fun
+        """
+        attempt = 0
+        while True:
+            self.throttle()
+            try:
+                return submit_fun(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                wait = min(self.max_backoff, self.backoff * 2 ** attempt)
+                sys.stderr.write('\nJob submission failed: {} - retrying in {} s\n'.format(e, wait))
+                time.sleep(wait)
+                attempt += 1
+
+    def for_owner(self, owner):
+        """
+        :param owner:
+        :return: governor object acquiring on behalf of the given owner
+         :rtype: OwnedGovernor
+        """
+        return OwnedGovernor(self, owner)
+
+
+class OwnedGovernor(object):
+    """
+    View on a SubmissionGovernor for a single owner (pipeline),
+    all limits are those of the shared governor
+    """
+    def __init__(self, governor, owner):
+        """
+        :param governor: the shared governor
+         :type: SubmissionGovernor
+        :param owner: any hashable identifying the pipeline
+        """
+        self.governor = governor
+        self.owner = owner
+
+    @property
+    def active(self):
+        """
+        :return: number of jobs of all owners currently counted as queued or running
+         :rtype: int
+        """
+        return self.governor.active
+
+    def configure(self, **limits):
+        """
+        Change the limits of the shared governor, see SubmissionGovernor.configure
+
+        :param limits: max_rate, max_active, retries, backoff, max_backoff
+        :return: None
+        """
+        self.governor.configure(**limits)
+        return
+
+    def reset(self):
+        """
+        Remove all limits of the shared governor
+
+        :return: None
+        """
+        self.governor.reset()
+        return
+
+    def acquire(self, num_jobs=1):
+        """
+        Block until there is room for num_jobs more active jobs,
+        queued behind the other submissions of this owner
+
+        :param num_jobs:
+        :return: None
+        """
+        self.governor.acquire(num_jobs, self.owner)
+        return
+
+    def release(self, num_jobs=1):
+        """
+        :param num_jobs:
+        :return: None
+        """
+        self.governor.release(num_jobs)
+        return
+
+    def throttle(self):
+        """
+        Wait for the next submission time slot of the shared governor
+
+        :return: None
+        """
+        self.governor.throttle()
+        return
+
+    def submit(self, submit_fun, *args, **kwargs):
+        """
+        :param submit_fun: e.g. session.runJob
+        :return: return value of submit_fun
+        """
+        return self.governor.submit(submit_fun, *args, **kwargs)
+
+    def for_owner(self, owner):
+        """
+        :param owner:
+        :return: governor object of the shared governor acquiring on behalf of the given owner
+         :rtype: OwnedGovernor
+        """
+        return self.governor.for_owner(owner)
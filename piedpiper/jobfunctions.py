@@ -12,8 +12,21 @@ containing these functions has to be imported in each pipeline script (separatio
 """
 
 import os as os
+import errno as errno
+import shlex as shlex
+import shutil as shutil
+import tempfile as tempfile
 import itertools as itt
 import fnmatch as fnm
+import string as string
+import functools as fnt
+import contextlib as ctl
+
+from piedpiper.ledger import job_signature
+from piedpiper.journal import journal_key
+from piedpiper.runhistory import longest_first, predict_jobs, predict_runtimes
+from piedpiper.packing import pack_jobs
+from piedpiper.visibility import missing_files, wait_visible
 
 # TODO Refactor some functions
 # there is no necessity to keep single- and multi-input functions separate
@@ -89,29 +102,470 @@ def _check_job(out, err):
     return out, err
 
 
-def _run_command(cmd, formatter, syscall, posrep=False):
+class _ShellWord(str):
+    """
+    Marks a substitution value that is already a valid shell word
+    (e.g. a quoted path to node-local scratch space) and must not
+    be quoted again
+    """
+    pass
+
+
+class CommandTemplate(object):
+    """
+    A command line (as read from the configuration) that is parsed once
+    and can then be rendered for many jobs. The placeholder names can be
+    validated up front (see validate and JOBFUN_FIELDS), i.e. a malformed
+    command line is caught before any job is submitted. Optionally, all
+    substituted values are quoted for the shell; lists of values (e.g. the
+    inputfiles of merge jobs) are quoted per element and joined by spaces.
+    Objects of this class can be passed as cmd to all job functions.
+    """
+    def __init__(self, cmd, quote=False):
+        """
+        :param cmd: the command line with format placeholders
+        :param quote: quote substituted values for the shell
+        """
+        # repeatedly ran into my own imbecility...
+        # Python's configparser allows multiline values,
+        # need to replace line breaks in order to have them
+        # correctly interpreted as commands by the shell
+        self.cmd = cmd.replace('\n', ' ')
+        self.quote = quote
+        self._formatter = string.Formatter()
+        self._parts = []
+        self.fields = set()
+        auto_idx, manual = 0, False
+        for literal, field, spec, conv in self._formatter.parse(self.cmd):
+            if field is None:
+                self._parts.append((literal, None, None, None, None))
+                continue
+            field, auto_idx, manual = self._number_field(field, auto_idx, manual)
+            if '{' in spec:
+                # nested placeholders in the format spec, e.g. {0:>{1}},
+                # are numbered as well and substituted when rendering
+                nested = []
+                for lit, fld, spc, cnv in self._formatter.parse(spec):
+                    nested.append(lit.replace('{', '{{').replace('}', '}}'))
+                    if fld is None:
+                        continue
+                    fld, auto_idx, manual = self._number_field(fld, auto_idx, manual)
+                    nested.append('{' + fld + ('!' + cnv if cnv else '') + (':' + spc if spc else '') + '}')
+                spec = ''.join(nested)
+            # plain names are looked up directly when rendering
+            key = None
+            if '.' not in field and '[' not in field:
+                key = self._field_name(field)
+            self._parts.append((literal, field, key, spec, conv))
+
+    def _number_field(self, field, auto_idx, manual):
+        """
+        :param field: placeholder as parsed
+        :param auto_idx: next automatic index
+        :param manual: manual numbering used so far
+        :return: placeholder with explicit index, next automatic index, manual numbering used
+        """
+        if field == '' or field[0] in '.[':
+            field = str(auto_idx) + field
+            auto_idx += 1
+        elif isinstance(self._field_name(field), int):
+            manual = True
+        assert auto_idx == 0 or not manual, 'Mixed automatic and manual placeholder' \
+                                            ' numbering: {}'.format(self.cmd)
+        self.fields.add(self._field_name(field))
+        return field, auto_idx, manual
+
+    @staticmethod
+    def _field_name(field):
+        """
+        :param field: placeholder, e.g. inputfile or 0[1] or x.y
+        :return: top-level name, int for positional placeholders
+        """
+        name = field.split('.', 1)[0].split('[', 1)[0]
+        return int(name) if name.isdigit() else name
+
+    def __str__(self):
+        return self.cmd
+
+    def __repr__(self):
+        return 'CommandTemplate({!r}, quote={})'.format(self.cmd, self.quote)
+
+    def validate(self, names, positional=0):
+        """
+        :param names: allowed placeholder names
+        :param positional: number of allowed positional placeholders
+        :return: self
+        :raises AssertionError: if the command contains unknown placeholders
+        """
+        unknown = [f for f in self.fields if (isinstance(f, int) and f >= positional) or
+                   (not isinstance(f, int) and f not in names)]
+        assert not unknown, 'Unknown placeholder(s) {} in command line: {}' \
+                            ' - supported are: {}'.format(sorted(map(str, unknown)), self.cmd, sorted(names))
+        return self
+
+    def _render_value(self, value, spec):
+        if isinstance(value, (list, tuple)):
+            return ' '.join([self._render_value(v, spec) for v in value])
+        if isinstance(value, _ShellWord):
+            return value
+        return shlex.quote(self._formatter.format_field(value, spec))
+
+    def render(self, *args, **kwargs):
+        """
+        The command line is assembled from the parsed parts, i.e.
+        it is not parsed again for each job
+
+        :return: the command line for a single job
+         :rtype: str
+        """
+        rendered = []
+        for literal, field, key, spec, conv in self._parts:
+            rendered.append(literal)
+            if field is None:
+                continue
+            if key is None:
+                if not self.quote:
+                    # as for plain str.format, lists are joined before indexing
+                    args = [' '.join(map(str, a)) if isinstance(a, (list, tuple)) else a for a in args]
+                    kwargs = dict((k, ' '.join(map(str, v)) if isinstance(v, (list, tuple)) else v)
+                                  for k, v in kwargs.items())
+                value, _ = self._formatter.get_field(field, args, kwargs)
+            elif isinstance(key, int):
+                value = args[key]
+            else:
+                value = kwargs[key]
+            if not self.quote and isinstance(value, (list, tuple)):
+                value = ' '.join(map(str, value))
+            if conv:
+                value = self._formatter.convert_field(value, conv)
+            if '{' in spec:
+                spec = self._formatter.vformat(spec, args, kwargs)
+            if self.quote:
+                rendered.append(self._render_value(value, spec))
+            elif spec or not isinstance(value, str):
+                rendered.append(format(value, spec))
+            else:
+                rendered.append(value)
+        return ''.join(rendered)
+
+
+@fnt.lru_cache(maxsize=256)
+def _compile_command(cmd):
     """
+    Command lines passed as plain strings are only parsed once
+
     :param cmd:
+    :return:
+     :rtype: CommandTemplate
+    """
+    return CommandTemplate(cmd)
+
+
+def _call_syscall(syscall, cmdline, outputs=None, **kwargs):
+    """
+    Grid job callables of the SysCallInterface (marked by takes_outputs)
+    record the expected output files in the job journal, i.e. a restarted
+    runner can collect jobs that finished while it was down
+
+    :param syscall:
+    :param cmdline:
+    :param outputs: output files written by the job
+    :param kwargs: passed to syscall
+    :return: output of syscall
+    """
+    if outputs is not None and getattr(syscall, 'takes_outputs', False):
+        kwargs['outputs'] = list(outputs)
+    return syscall(cmdline, **kwargs)
+
+
+def _wait_visible(syscall, paths):
+    """
+    :param syscall: grid job callables of the SysCallInterface set the
+     timeout (visibility_timeout); outputs of local jobs are checked once
+    :param paths: output files
+    :return: paths that are still missing after the timeout, see wait_visible
+     :rtype: list of str
+    """
+    return wait_visible(paths, getattr(syscall, 'visibility_timeout', 0))
+
+
+def _run_command(cmd, formatter, syscall, posrep=False, wrap=None, outputs=None):
+    """
+    :param cmd:
+     :type: str or CommandTemplate
     :param formatter:
     :param syscall:
     :param posrep:
+    :param wrap: callable applied to the formatted command line
+    :param outputs: output files written by the job (see _call_syscall)
     :return: None
     :rtype: NoneType
     """
-    # repeatedly ran into my own imbecility...
-    # Python's configparser allows multiline values,
-    # need to replace line breaks in order to have them
-    # correctly interpreted as commands by the shell
-    tmp = cmd.replace('\n', ' ')
+    if not isinstance(cmd, CommandTemplate):
+        cmd = _compile_command(cmd)
     if posrep:
-        tmp = tmp.format(*formatter)
+        tmp = cmd.render(*formatter)
     else:
-        tmp = tmp.format(**formatter)
-    out, err = syscall(tmp)
+        tmp = cmd.render(**formatter)
+    if wrap is not None:
+        tmp = wrap(tmp)
+    out, err = _call_syscall(syscall, tmp, outputs)
     out, err = _check_job(out, err)
     return None
 
 
+def _ledger_begin(ledger, cmd, inputs, outputs):
+    """
+    Write-ahead step for jobs with known output files
+
+    :param ledger:
+     :type: OutputLedger or NoneType
+    :param cmd:
+    :param inputs: list of input files
+    :param outputs: list of output files
+    :return: True if all outputs are committed for this job, i.e. the job can be skipped
+     :rtype: bool
+    """
+    if ledger is None:
+        return False
+    signature = job_signature(cmd, inputs)
+    if ledger.is_committed(outputs, signature, verify=ledger.checksum):
+        return True
+    ledger.begin(outputs, signature)
+    return False
+
+
+def _ledger_commit(ledger, outputs):
+    """
+    :param ledger:
+    :param outputs:
+    :return: None
+    """
+    if ledger is not None:
+        ledger.commit(outputs)
+    return
+
+
+def _move_atomic(source, dest):
+    """
+    Move a file to its final location such that dest is never visible
+    as a partially written file: within the same file system, this is
+    a plain rename; otherwise, the file is copied next to dest first
+    and then renamed
+
+    :param source:
+    :param dest:
+    :return: None
+    """
+    try:
+        os.replace(source, dest)
+    except OSError as oe:
+        if oe.errno != errno.EXDEV:
+            raise
+        partial = '{}.{}.part'.format(dest, os.getpid())
+        try:
+            shutil.copy2(source, partial)
+            os.replace(partial, dest)
+        finally:
+            if os.path.isfile(partial):
+                os.unlink(partial)
+        os.unlink(source)
+    return
+
+
+def _make_staging_dir(stage, syscall, anchor, outputs):
+    """
+    Jobs of grid and pilot callables (marked by remote) run on another host,
+    i.e. cannot share the $TMPDIR of the runner. By default, their outputs
+    are staged in a hidden folder next to the final output (same filesystem).
+    The folder name only depends on the outputs, i.e. is the same for a
+    restarted runner (see job journal)
+
+    :param stage: True to use the default folder, or path to a folder
+    :param syscall:
+    :param anchor: final output path the staging folder is placed next to
+    :param outputs: final output paths
+    :return: path to new staging folder
+    """
+    if stage is True and getattr(syscall, 'remote', False):
+        parent = os.path.dirname(os.path.abspath(anchor))
+        stagedir = os.path.join(parent, '.pp_stage_{}'.format(journal_key('stage', outputs)[:12]))
+        os.makedirs(stagedir, exist_ok=True)
+        return stagedir
+    return tempfile.mkdtemp(prefix='pp_stage_', dir=None if stage is True else stage)
+
+
+@ctl.contextmanager
+def _staged_outputs(stage, outputs, syscall):
+    """
+    Opt-in staging of output files: the command writes to temporary
+    paths in a staging folder (default: $TMPDIR for local jobs, next
+    to the output for remote jobs), and the outputs are only moved
+    into place if the job finished successfully. An explicitly given
+    staging folder must be accessible from both the runner and the
+    compute node in grid mode. Job functions record the final paths
+    in the job journal, not the staged ones.
+
+    :param stage: False/None (no staging), True or path to staging folder
+    :param outputs: list of final output paths
+    :param syscall: see _make_staging_dir
+    :return: list of paths the command should write to
+    :raises: AssertionError if a staged output is missing after the job
+    """
+    if not stage:
+        yield list(outputs)
+        return
+    stagedir = _make_staging_dir(stage, syscall, outputs[0], outputs)
+    try:
+        # prefix avoids collisions for outputs with identical basenames
+        staged = [os.path.join(stagedir, '{}_{}'.format(idx, os.path.basename(f))) for idx, f in enumerate(outputs)]
+        yield staged
+        missing = _wait_visible(syscall, staged)
+        assert not missing, 'Staged output path is not a file: {} - job failed?'.format(missing[0])
+        for tmp, final in zip(staged, outputs):
+            _move_atomic(tmp, final)
+    finally:
+        shutil.rmtree(stagedir, ignore_errors=True)
+
+
+@ctl.contextmanager
+def _staged_outdir(stage, outdir, filtpat, syscall, rec=False):
+    """
+    Same as above for output patterns: the command writes into a staging
+    folder (referenced as {outdir} in the command line), and all files
+    matching the filter pattern are moved to outdir if the job finished
+    successfully
+
+    :param stage:
+    :param outdir:
+    :param filtpat:
+    :param syscall:
+    :param rec: collect recursively and keep relative paths
+    :return: path of the folder the command should write to
+    """
+    if not stage:
+        yield outdir
+        return
+    stagedir = _make_staging_dir(stage, syscall, outdir, [os.path.join(outdir, filtpat)])
+    try:
+        yield stagedir
+        if rec:
+            staged = recursive_collect(stagedir, filtpat)
+        else:
+            staged = [os.path.join(stagedir, f) for f in fnm.filter(os.listdir(stagedir), filtpat)]
+        for tmp in staged:
+            final = os.path.join(outdir, os.path.relpath(tmp, stagedir))
+            os.makedirs(os.path.dirname(final), exist_ok=True)
+            _move_atomic(tmp, final)
+    finally:
+        shutil.rmtree(stagedir, ignore_errors=True)
+
+
+class NodeLocalStaging(object):
+    """
+    Data locality for grid jobs: the job function declares its input,
+    output and reference files, and the command is wrapped such that
+    all inputs are copied to node-local scratch space first, the command
+    runs on the local copies and the outputs are copied back afterwards.
+    Reference files can be kept in a per-node cache folder that is shared
+    by all jobs running on the node, i.e. a reference file is copied to
+    each node only once (the cached name includes size and mtime of the
+    reference file, so changed references are never reused). Cached files
+    are not removed automatically.
+    """
+    def __init__(self, scratch='${TMPDIR:-/tmp}', cachedir=None):
+        """
+        :param scratch: node-local base folder, evaluated on the node (shell expression)
+        :param cachedir: node-local cache folder for reference files, None = no cache
+        """
+        self.scratch = scratch
+        self.cachedir = cachedir
+        self.inputs = []
+        self.outputs = []
+        self.references = []
+
+    def job(self):
+        """
+        :return: fresh (per-job) copy of this configuration
+         :rtype: NodeLocalStaging
+        """
+        return NodeLocalStaging(self.scratch, self.cachedir)
+
+    def _local_path(self, var, name):
+        return _ShellWord('"${}"/{}'.format(var, shlex.quote(name)))
+
+    def input(self, path):
+        """
+        :param path: shared path of input file
+        :return: node-local path to be used in the command line
+        """
+        local = self._local_path('PP_SCRATCH', 'in{}_{}'.format(len(self.inputs), os.path.basename(path)))
+        self.inputs.append((os.path.abspath(path), local))
+        return local
+
+    def output(self, path):
+        """
+        :param path: shared path of output file
+        :return: node-local path to be used in the command line
+        """
+        local = self._local_path('PP_SCRATCH', 'out{}_{}'.format(len(self.outputs), os.path.basename(path)))
+        self.outputs.append((os.path.abspath(path), local))
+        return local
+
+    def reference(self, path):
+        """
+        :param path: shared path of reference file
+        :return: node-local path to be used in the command line
+        """
+        if self.cachedir is None:
+            return self.input(path)
+        st = os.stat(path)
+        name = '{}_{}_{}'.format(st.st_size, st.st_mtime_ns, os.path.basename(path))
+        local = self._local_path('PP_CACHE', name)
+        self.references.append((os.path.abspath(path), local, shlex.quote(name)))
+        return local
+
+    def wrap(self, cmd):
+        """
+        :param cmd: the formatted command line using the node-local paths
+        :return: command line including staging in and out
+        """
+        q = shlex.quote
+        script = ['PP_SCRATCH=$(mktemp -d -p "{}" pp_node_XXXXXX) || exit 1'.format(self.scratch),
+                  'trap \'rm -rf "$PP_SCRATCH"\' EXIT']
+        for shared, local in self.inputs:
+            script.append('cp {} {} || exit 1'.format(q(shared), local))
+        if self.references:
+            script.append('PP_CACHE={} && mkdir -p "$PP_CACHE" || exit 1'.format(q(self.cachedir)))
+        for shared, local, name in self.references:
+            # copy once per node, concurrent jobs wait for the first one
+            script.append('( flock -x 9 && ( [ -f {local} ] || ( cp {shared} {local}.$$ &&'
+                          ' mv {local}.$$ {local} ) ) ) 9>"$PP_CACHE"/{name}.lock'
+                          ' || exit 1'.format(local=local, shared=q(shared), name=name))
+        script.append('( {} ) || exit $?'.format(cmd))
+        for shared, local in self.outputs:
+            part = q(shared + '.part') + '.$$'
+            script.append('cp {local} {part} && mv {part} {shared} || exit 1'.format(local=local, part=part,
+                                                                                 shared=q(shared)))
+        return ' ; '.join(script)
+
+
+def _local_paths(nodelocal, inputs, outputs, references=None):
+    """
+    :param nodelocal: None or NodeLocalStaging
+    :return: paths to be used in the command line for inputs, outputs and
+     references, and the wrapper for the formatted command line
+    """
+    references = [] if references is None else references
+    if nodelocal is None:
+        return inputs, outputs, references, None
+    job = nodelocal.job()
+    inputs = [job.input(f) for f in inputs]
+    outputs = [job.output(f) for f in outputs]
+    references = [job.reference(f) for f in references]
+    return inputs, outputs, references, job.wrap
+
+
 def recursive_collect(basedir, filtpat):
     """
     :param basedir:
@@ -143,41 +597,56 @@ def syscall_raw(cmd, syscall):
     return None
 
 
-def syscall_in_out(inputfile, outputfile, cmd, syscall, posrep=False):
+def syscall_in_out(inputfile, outputfile, cmd, syscall, posrep=False, ledger=None, stage=None, nodelocal=None):
     """
     :param inputfile:
     :param outputfile:
     :param cmd:
     :param syscall:
     :param posrep: use positional replacement for input and output when formatting command
+    :param ledger: skip job if output is committed, record job start and commit otherwise
+     :type: OutputLedger
+    :param stage: write output to staging folder first, move into place after success
+     :type: bool or str (path to staging folder, default: see _make_staging_dir)
+    :param nodelocal: run the job on node-local copies of input and output
+     :type: NodeLocalStaging
     :return:
      :rtype: str
     """
     assert os.path.isfile(inputfile), 'Input path is not a file: {}'.format(inputfile)
     assert outputfile, 'Received no output file'
-    if posrep:
-        formatter = (inputfile, outputfile)
-    else:
-        formatter = {'inputfile': inputfile, 'outputfile': outputfile}
-    _ = _run_command(cmd, formatter, syscall, posrep)
-    assert os.path.isfile(outputfile), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    if _ledger_begin(ledger, cmd, [inputfile], [outputfile]):
+        return outputfile
+    with _staged_outputs(stage, [outputfile], syscall) as staged:
+        ins, outs, _, wrap = _local_paths(nodelocal, [inputfile], staged)
+        if posrep:
+            formatter = (ins[0], outs[0])
+        else:
+            formatter = {'inputfile': ins[0], 'outputfile': outs[0]}
+        _ = _run_command(cmd, formatter, syscall, posrep, wrap, [outputfile])
+    assert not _wait_visible(syscall, [outputfile]), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    _ledger_commit(ledger, [outputfile])
     return outputfile
 
 
-def syscall_in_pat(inputfile, outputfiles, outdir, filter, cmd, syscall, posrep=False, rec=False):
+def syscall_in_pat(inputfile, outputfiles, outdir, filter, cmd, syscall, posrep=False, rec=False, stage=None):
     """
     System call for cases where a single input file is split
     into multiple output files (number determined at runtime), hence
-    outputfiles represents a matching pattern rather than a filename
+    outputfiles represents a matching pattern rather than a filename.
+    The output folder is available as {outdir} (second positional
+    argument) in the command line; the command has to use it if
+    the outputs should be staged
 
     :return: list of files
     """
     assert os.path.isfile(inputfile), 'Input path is not a file: {}'.format(inputfile)
-    if posrep:
-        formatter = inputfile,
-    else:
-        formatter = {'inputfile': inputfile}
-    _ = _run_command(cmd, formatter, syscall, posrep)
+    with _staged_outdir(stage, outdir, filter, syscall, rec) as staged:
+        if posrep:
+            formatter = inputfile, staged
+        else:
+            formatter = {'inputfile': inputfile, 'outdir': staged}
+        _ = _run_command(cmd, formatter, syscall, posrep)
     if rec:
         outfiles = recursive_collect(outdir, filter)
     else:
@@ -188,48 +657,66 @@ def syscall_in_pat(inputfile, outputfiles, outdir, filter, cmd, syscall, posrep=
     return outfiles
 
 
-def syscall_in_out_ref(inputfile, outputfile, reference, cmd, syscall):
+def syscall_in_out_ref(inputfile, outputfile, reference, cmd, syscall, ledger=None, stage=None, nodelocal=None):
     """
     :param inputfile:
     :param outputfile:
     :param reference:
     :param cmd:
     :param syscall:
+    :param ledger:
+    :param stage:
+    :param nodelocal:
     :return:
     """
     assert os.path.isfile(inputfile), 'Input path is not a file: {}'.format(inputfile)
     assert outputfile, 'Received no output file'
     assert os.path.isfile(reference), 'Reference path is not a file: {}'.format(outputfile)
-    fmt = {'inputfile': inputfile, 'outputfile': outputfile, 'referencefile': reference}
-    _ = _run_command(cmd, fmt, syscall)
-    assert os.path.isfile(outputfile), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    if _ledger_begin(ledger, cmd, [inputfile, reference], [outputfile]):
+        return outputfile
+    with _staged_outputs(stage, [outputfile], syscall) as staged:
+        ins, outs, refs, wrap = _local_paths(nodelocal, [inputfile], staged, [reference])
+        fmt = {'inputfile': ins[0], 'outputfile': outs[0], 'referencefile': refs[0]}
+        _ = _run_command(cmd, fmt, syscall, wrap=wrap, outputs=[outputfile])
+    assert not _wait_visible(syscall, [outputfile]), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    _ledger_commit(ledger, [outputfile])
     return outputfile
 
 
-def syscall_ins_out_ref(inputfiles, outputfile, reference, cmd, syscall):
+def syscall_ins_out_ref(inputfiles, outputfile, reference, cmd, syscall, ledger=None, stage=None, nodelocal=None):
     """
     :param inputfiles:
     :param outputfile:
     :param reference:
     :param cmd:
     :param syscall:
+    :param ledger:
+    :param stage:
+    :param nodelocal:
     :return:
     """
     flattened = _flatten_nested_iterable(inputfiles)
     assert all([os.path.isfile(f) for f in flattened]), 'Not all input paths are files: {}'.format(flattened)
     assert os.path.isfile(reference), 'Invalid path to reference file: {}'.format(reference)
-    fmt = {'inputfiles': ' '.join(flattened), 'outputfile': outputfile, 'referencefile': reference}
-    _ = _run_command(cmd, fmt, syscall)
-    assert os.path.isfile(outputfile), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    if _ledger_begin(ledger, cmd, flattened + [reference], [outputfile]):
+        return outputfile
+    with _staged_outputs(stage, [outputfile], syscall) as staged:
+        ins, outs, refs, wrap = _local_paths(nodelocal, flattened, staged, [reference])
+        fmt = {'inputfiles': ins, 'outputfile': outs[0], 'referencefile': refs[0]}
+        _ = _run_command(cmd, fmt, syscall, wrap=wrap, outputs=[outputfile])
+    assert not _wait_visible(syscall, [outputfile]), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    _ledger_commit(ledger, [outputfile])
     return outputfile
 
 
-def syscall_inref_out(inputpair, outputfile, cmd, refext, syscall):
+def syscall_inref_out(inputpair, outputfile, cmd, refext, syscall, ledger=None, stage=None):
     """
     :param inputpair:
     :param outputfile:
     :param cmd:
     :param syscall:
+    :param ledger:
+    :param stage:
     :return:
     """
     assert len(inputpair) == 2, 'Too many (or not enough) input files: {}'.format(inputpair)
@@ -239,38 +726,50 @@ def syscall_inref_out(inputpair, outputfile, cmd, refext, syscall):
     else:
         reference = inputpair[0]
         inputfile = inputpair[1]
-    fmt = {'inputfile': inputfile, 'outputfile': outputfile, 'referencefile': reference}
-    _ = _run_command(cmd, fmt, syscall)
-    assert os.path.isfile(outputfile), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    if _ledger_begin(ledger, cmd, [inputfile, reference], [outputfile]):
+        return outputfile
+    with _staged_outputs(stage, [outputfile], syscall) as staged:
+        fmt = {'inputfile': inputfile, 'outputfile': staged[0], 'referencefile': reference}
+        _ = _run_command(cmd, fmt, syscall, outputs=[outputfile])
+    assert not _wait_visible(syscall, [outputfile]), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    _ledger_commit(ledger, [outputfile])
     return outputfile
 
 
-def syscall_ins_out(inputfiles, outputfile, cmd, syscall, posrep=False):
+def syscall_ins_out(inputfiles, outputfile, cmd, syscall, posrep=False, ledger=None, stage=None, nodelocal=None):
     """
     Merge/join job, several input files create a single output file
 
     :param inputfiles:
     :param outputfile:
+    :param ledger:
+    :param stage:
+    :param nodelocal:
     :return:
     """
     flattened = _flatten_nested_iterable(inputfiles)
     assert all([os.path.isfile(f) for f in flattened]), 'Not all input paths are files: {}'.format(flattened)
     assert outputfile, 'Received no output file'
-    flattened = ' '.join(flattened)
-    if posrep:
-        fmt = (flattened, outputfile)
-    else:
-        fmt = {'inputfiles': flattened, 'outputfile': outputfile}
-    _ = _run_command(cmd, fmt, syscall, posrep)
-    assert os.path.isfile(outputfile), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    if _ledger_begin(ledger, cmd, flattened, [outputfile]):
+        return outputfile
+    with _staged_outputs(stage, [outputfile], syscall) as staged:
+        ins, outs, _, wrap = _local_paths(nodelocal, flattened, staged)
+        if posrep:
+            fmt = (ins, outs[0])
+        else:
+            fmt = {'inputfiles': ins, 'outputfile': outs[0]}
+        _ = _run_command(cmd, fmt, syscall, posrep, wrap, [outputfile])
+    assert not _wait_visible(syscall, [outputfile]), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    _ledger_commit(ledger, [outputfile])
     return outputfile
 
 
-def syscall_ins_pat(inputfiles, outputpattern, outdir, filter, cmd, syscall, posrep=False, rec=False):
+def syscall_ins_pat(inputfiles, outputpattern, outdir, filter, cmd, syscall, posrep=False, rec=False, stage=None):
     """
     System call for cases where a set of input files is split
     into multiple output files (number determined at runtime), hence
-    outputfiles represents a matching pattern rather than a filename
+    outputfiles represents a matching pattern rather than a filename.
+    See syscall_in_pat for staging the outputs
 
     :return: list of files
     """
@@ -281,11 +780,12 @@ def syscall_ins_pat(inputfiles, outputpattern, outdir, filter, cmd, syscall, pos
     outfiles = fnm.filter(outfiles, filter)
     if len(outfiles) > 0:
         return [os.path.join(outdir, f) for f in outfiles]
-    if posrep:
-        fmt = ' '.join(flattened),
-    else:
-        fmt = {'inputfiles': ' '.join(flattened)}
-    _ = _run_command(cmd, fmt, syscall, posrep)
+    with _staged_outdir(stage, outdir, filter, syscall, rec) as staged:
+        if posrep:
+            fmt = flattened, staged
+        else:
+            fmt = {'inputfiles': flattened, 'outdir': staged}
+        _ = _run_command(cmd, fmt, syscall, posrep)
     if rec:
         outfiles = recursive_collect(outdir, filter)
     else:
@@ -296,42 +796,471 @@ def syscall_ins_pat(inputfiles, outputpattern, outdir, filter, cmd, syscall, pos
     return outfiles
 
 
-def syscall_inpair_out(inputpair, outputfile, cmd, syscall):
+def syscall_inpair_out(inputpair, outputfile, cmd, syscall, ledger=None, stage=None):
     """
     :param inputpair:
     :param outputfile:
     :param cmd:
     :param syscall:
+    :param ledger:
+    :param stage:
     :return:
     """
     if len(inputpair) == 1:  # stumble across nested structure every now and then
         inputpair = inputpair[0]
     assert len(inputpair) == 2, 'Missing paired input: {}'.format(inputpair)
     assert all([os.path.isfile(f) for f in inputpair]), 'Not all input paths are files: {}'.format(inputpair)
-    fmt = {'inputfile1': inputpair[0], 'inputfile2': inputpair[1], 'outputfile': outputfile}
-    _ = _run_command(cmd, fmt, syscall)
-    assert os.path.isfile(outputfile), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    if _ledger_begin(ledger, cmd, list(inputpair), [outputfile]):
+        return outputfile
+    with _staged_outputs(stage, [outputfile], syscall) as staged:
+        fmt = {'inputfile1': inputpair[0], 'inputfile2': inputpair[1], 'outputfile': staged[0]}
+        _ = _run_command(cmd, fmt, syscall, outputs=[outputfile])
+    assert not _wait_visible(syscall, [outputfile]), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    _ledger_commit(ledger, [outputfile])
     return outputfile
 
 
-def syscall_in_outpair(inputfile, outputpair, cmd, syscall):
+def syscall_in_outpair(inputfile, outputpair, cmd, syscall, ledger=None, stage=None):
     """
     :param inputfile:
     :param outputpair:
     :param cmd:
     :param syscall:
+    :param ledger:
+    :param stage:
     :return:
     """
     if len(outputpair) == 1:
         outputpair = outputpair[0]
     assert len(outputpair) == 2, 'Missing paired output: {}'.format(outputpair)
     assert os.path.isfile(inputfile), 'Invalid path to input file: {}'.format(inputfile)
-    fmt = {'inputfile': inputfile, 'outputfile1': outputpair[0], 'outputfile2': outputpair[1]}
-    _ = _run_command(cmd, fmt, syscall)
-    assert all([os.path.isfile(f) for f in outputpair]), 'No output files created - job failed?'
+    if _ledger_begin(ledger, cmd, [inputfile], list(outputpair)):
+        return outputpair
+    with _staged_outputs(stage, outputpair, syscall) as staged:
+        fmt = {'inputfile': inputfile, 'outputfile1': staged[0], 'outputfile2': staged[1]}
+        _ = _run_command(cmd, fmt, syscall, outputs=list(outputpair))
+    assert not _wait_visible(syscall, outputpair), 'No output files created - job failed?'
+    _ledger_commit(ledger, list(outputpair))
     return outputpair
 
 
+def _fuse_commands(cmds, inputfile, outputfile, pipe=False, scratch='${TMPDIR:-/tmp}'):
+    """
+    Build a single shell script from a chain of in->out steps: the first
+    step reads the input file, the last one writes the output file, and
+    the intermediates are either files in node-local scratch space (steps
+    run one after another) or FIFOs (all steps run concurrently, each step
+    has to read/write its input/output sequentially, i.e. no seeking)
+
+    :param cmds: command templates with placeholders inputfile and outputfile
+    :param inputfile:
+    :param outputfile:
+    :param pipe: connect the steps via FIFOs
+    :param scratch: node-local base folder, evaluated on the node (shell expression)
+    :return: command line
+    """
+    templates = [c if isinstance(c, CommandTemplate) else _compile_command(c) for c in cmds]
+    for t in templates:
+        _ = t.validate(('inputfile', 'outputfile'))
+    inter = [_ShellWord('"$PP_FUSE"/step{}'.format(idx)) for idx in range(1, len(templates))]
+    steps = [t.render(inputfile=i, outputfile=o) for t, i, o in zip(templates, [inputfile] + inter,
+                                                                     inter + [outputfile])]
+    script = ['PP_FUSE=$(mktemp -d -p "{}" pp_fuse_XXXXXX) || exit 1'.format(scratch),
+              'trap \'rm -rf "$PP_FUSE"\' EXIT']
+    if not pipe or not inter:
+        script.extend(['( {} ) || exit $?'.format(step) for step in steps])
+        return ' ; '.join(script)
+    script.append('mkfifo {} || exit 1'.format(' '.join(inter)))
+    for idx, step in enumerate(steps[:-1]):
+        script.append('( {} ) & PP_PID{}=$!'.format(step, idx))
+    script.append('( {} ) ; PP_RC=$?'.format(steps[-1]))
+    for idx in range(len(steps) - 1):
+        script.append('wait $PP_PID{} || {{ [ $PP_RC -ne 0 ] || PP_RC=1 ; }}'.format(idx))
+    script.append('exit $PP_RC')
+    return ' ; '.join(script)
+
+
+def syscall_fused_in_out(inputfile, outputfile, cmds, syscall, pipe=False, scratch='${TMPDIR:-/tmp}',
+                         ledger=None, stage=None):
+    """
+    Run a chain of in->out steps as a single job: only the input of the
+    first and the output of the last step live on shared storage, the
+    intermediates are kept in node-local scratch space (or streamed through
+    FIFOs if all tools in the chain support it). Note that in pipe mode,
+    a step that fails before opening its FIFO can block the other steps
+
+    :param inputfile:
+    :param outputfile:
+    :param cmds: list of command lines, each using {inputfile} and {outputfile}
+    :param syscall:
+    :param pipe: stream intermediates through FIFOs
+    :param scratch: node-local base folder for the intermediates
+    :param ledger:
+    :param stage:
+    :return:
+     :rtype: str
+    """
+    assert os.path.isfile(inputfile), 'Input path is not a file: {}'.format(inputfile)
+    assert outputfile, 'Received no output file'
+    assert len(cmds) > 0, 'Received no commands to fuse'
+    signature = ' | '.join(map(str, cmds))
+    if _ledger_begin(ledger, signature, [inputfile], [outputfile]):
+        return outputfile
+    with _staged_outputs(stage, [outputfile], syscall) as staged:
+        script = _fuse_commands(cmds, inputfile, staged[0], pipe, scratch)
+        out, err = _call_syscall(syscall, script, [outputfile])
+        _ = _check_job(out, err)
+    assert not _wait_visible(syscall, [outputfile]), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    _ledger_commit(ledger, [outputfile])
+    return outputfile
+
+
+def _callable_name(func):
+    """
+    :param func:
+    :return: identifies the callable (e.g. in the ledger)
+    """
+    return '{}.{}'.format(getattr(func, '__module__', ''), getattr(func, '__qualname__', repr(func)))
+
+
+def syscall_py_in_out(inputfile, outputfile, func, syscall, ledger=None, stage=None):
+    """
+    Same contract as syscall_in_out, but instead of a command line, a Python
+    callable is executed as func(inputfile, outputfile) in a worker of a
+    persistent process pool (see SysCallInterface.python_job). The callable
+    has to be defined at module level (picklable)
+
+    :param inputfile:
+    :param outputfile:
+    :param func:
+    :param syscall: callable executing func in the pool
+    :param ledger:
+    :param stage:
+    :return:
+     :rtype: str
+    """
+    assert os.path.isfile(inputfile), 'Input path is not a file: {}'.format(inputfile)
+    assert outputfile, 'Received no output file'
+    if _ledger_begin(ledger, _callable_name(func), [inputfile], [outputfile]):
+        return outputfile
+    with _staged_outputs(stage, [outputfile], syscall) as staged:
+        _ = syscall(func, inputfile, staged[0])
+    assert not _wait_visible(syscall, [outputfile]), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    _ledger_commit(ledger, [outputfile])
+    return outputfile
+
+
+def syscall_py_ins_out(inputfiles, outputfile, func, syscall, ledger=None, stage=None):
+    """
+    Same as syscall_py_in_out for merge/join jobs, the callable
+    is executed as func(inputfiles, outputfile)
+
+    :param inputfiles:
+    :param outputfile:
+    :param func:
+    :param syscall:
+    :param ledger:
+    :param stage:
+    :return:
+     :rtype: str
+    """
+    flattened = _flatten_nested_iterable(inputfiles)
+    assert all([os.path.isfile(f) for f in flattened]), 'Not all input paths are files: {}'.format(flattened)
+    assert outputfile, 'Received no output file'
+    if _ledger_begin(ledger, _callable_name(func), flattened, [outputfile]):
+        return outputfile
+    with _staged_outputs(stage, [outputfile], syscall) as staged:
+        _ = syscall(func, flattened, staged[0])
+    assert not _wait_visible(syscall, [outputfile]), 'Output path is not a file: {} - job failed?'.format(outputfile)
+    _ledger_commit(ledger, [outputfile])
+    return outputfile
+
+
+# optional second argument: folder to record the runtime of each task
+_BULK_DRIVER = """#!/bin/bash
+CMD=$(sed -n "${SGE_TASK_ID}p" "$1")
+[ -n "$CMD" ] || { echo "No command for task ${SGE_TASK_ID} in table $1" >&2 ; exit 1 ; }
+START=$(date +%s.%N)
+eval "$CMD"
+RC=$?
+[ -z "$2" ] || echo "$START $(date +%s.%N)" > "$2/${SGE_TASK_ID}"
+exit $RC
+"""
+
+
+def _read_task_times(timedir):
+    """
+    :param timedir:
+    :return: runtime in seconds per task ID
+     :rtype: dict
+    """
+    runtimes = dict()
+    for name in os.listdir(timedir):
+        try:
+            with open(os.path.join(timedir, name), 'r') as infile:
+                start, end = infile.read().split()
+            runtimes[int(name)] = float(end) - float(start)
+        except (OSError, ValueError):
+            continue
+    return runtimes
+
+
+def _copy_output(output):
+    """
+    :param output: shared path of output file
+    :return: path of the output in the private folder of a task copy (see _isolate_copy)
+    """
+    folder, name = os.path.split(output)
+    return _ShellWord('{}/"$PP_COPY"/{}'.format(shlex.quote(folder or '.'), shlex.quote(name)))
+
+
+def _isolate_copy(cmdline, outputs, token):
+    """
+    Speculative execution (see monitor): several copies of a task may run
+    at the same time. Each copy writes its outputs into a private folder
+    next to the output (named after the grid job ID of the copy) and moves
+    them into place after the command succeeded, i.e. the outputs of the
+    copies do not interfere and are always complete
+
+    :param cmdline: command line rendered with the paths of _copy_output
+    :param outputs: shared paths of output files
+    :param token: identifies the private folders of this array job
+    :return: wrapped command line
+    """
+    q = shlex.quote
+    folders = sorted(set([os.path.dirname(o) or '.' for o in outputs]))
+    script = ['PP_COPY=.pp_copy_{}_${{JOB_ID:-$HOSTNAME.$$}}'.format(token),
+              'mkdir -p ' + ' '.join(['{}/"$PP_COPY"'.format(q(f)) for f in folders]),
+              '( {} )'.format(cmdline)]
+    script.extend(['mv {} {}'.format(_copy_output(o), q(o)) for o in outputs])
+    return ' && '.join(script)
+
+
+def _remove_copies(outputs, token):
+    """
+    Remove the private folders of all task copies, i.e.
+    the leftovers of terminated copies (see _isolate_copy)
+
+    :param outputs:
+    :param token:
+    :return: None
+    """
+    for folder in set([os.path.dirname(o) or '.' for o in outputs]):
+        try:
+            names = fnm.filter(os.listdir(folder), '.pp_copy_{}_*'.format(token))
+        except OSError:
+            continue
+        for name in names:
+            shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+    return
+
+
+def _run_bulk(commands, syscall, tabledir=None, keeptable=False, timing=False, outputs=None,
+              speculate=False):
+    """
+    Write all command lines into a table (one per line), and submit
+    a single array job; each task executes the command in the line
+    given by its task ID (SGE_TASK_ID)
+
+    :param commands: rendered command lines
+    :param syscall: array job callable, see SysCallInterface.drmaa_arrayjob_argv
+    :param tabledir: folder for table and driver script, must be accessible
+     from the compute nodes (default: current working directory)
+    :param keeptable: do not delete table and driver script after the jobs finished
+    :param timing: record the runtime of each task
+    :param outputs: output files of all jobs (see _call_syscall)
+    :param speculate: copies of a task write to separate outputs (see _isolate_copy)
+    :return: output on stdout and stderr, runtime per task ID (empty w/o timing)
+    """
+    # one line per task, i.e. neither paths nor the command itself may contain line breaks
+    multiline = [c for c in commands if '\n' in c]
+    assert not multiline, 'Command lines must not contain line breaks' \
+                          ' ({} tasks): {}'.format(len(multiline), multiline[0])
+    tabledir = tempfile.mkdtemp(prefix='pp_bulk_', dir=os.getcwd() if tabledir is None else tabledir)
+    try:
+        table = os.path.join(tabledir, 'commands.txt')
+        with open(table, 'w') as outfile:
+            _ = outfile.write('\n'.join(commands) + '\n')
+        driver = os.path.join(tabledir, 'driver.sh')
+        with open(driver, 'w') as outfile:
+            _ = outfile.write(_BULK_DRIVER)
+        os.chmod(driver, 0o755)
+        argv = [table]
+        if timing:
+            argv.append(os.path.join(tabledir, 'times'))
+            os.makedirs(argv[-1])
+        kwargs = {'argv': argv, 'start': 1, 'end': len(commands), 'step': 1}
+        if getattr(syscall, 'takes_outputs', False):
+            # the table folder differs between runs, the commands do not
+            kwargs['jobkey'] = journal_key('bulk', commands)
+        if speculate:
+            kwargs['speculate'] = True
+        out, err = _call_syscall(syscall, driver, outputs, **kwargs)
+        runtimes = _read_task_times(argv[-1]) if timing else dict()
+    finally:
+        if not keeptable:
+            shutil.rmtree(tabledir, ignore_errors=True)
+    return out, err, runtimes
+
+
+def _bulk_jobs(jobs, cmd, syscall, infield, posrep, tabledir, keeptable, history=None, lpt=False,
+               capacity=None, bundles=None):
+    """
+    :param jobs: list of (input(s), output) pairs
+    :param cmd:
+    :param syscall:
+    :param infield: inputfile or inputfiles
+    :param posrep:
+    :param tabledir:
+    :param keeptable:
+    :param history: predict runtimes from and record runtimes to this history
+     :type: RuntimeHistory
+    :param lpt: submit jobs longest (expected) first; implied by history
+    :param capacity: pack jobs into bundles of this total weight (input size
+     in bytes or, with history, predicted runtime in seconds); each bundle is one task.
+     With history, jobs are not bundled unless the runtime of all jobs can be predicted
+    :param bundles: pack jobs into this number of balanced bundles
+    :return: output files in the order of jobs
+     :rtype: list of str
+    """
+    if not jobs:
+        return []
+    if not isinstance(cmd, CommandTemplate):
+        cmd = _compile_command(cmd)
+    inputs = [_flatten_nested_iterable(i) if infield == 'inputfiles' else [i] for i, _ in jobs]
+    outputs = [o for _, o in jobs]
+    assert all(outputs), 'Received no output file for some job(s)'
+    assert len(set(outputs)) == len(outputs), 'Output files are not unique'
+    missing = missing_files(set(itt.chain.from_iterable(inputs)))
+    assert not missing, 'Not all input paths are files ({} missing): {}'.format(len(missing), sorted(missing)[:10])
+    weights = None
+    if history is not None and (capacity is not None or bundles is not None):
+        weights = predict_runtimes(inputs, cmd, history)
+        if weights is None:
+            # capacity is a runtime, input sizes cannot be used instead
+            capacity = None
+    if capacity is not None or bundles is not None:
+        tasks = pack_jobs(predict_jobs(inputs, cmd) if weights is None else weights, capacity, bundles)
+    elif history is not None or lpt:
+        tasks = [[idx] for idx in longest_first(inputs, cmd, history)]
+    else:
+        tasks = [[idx] for idx in range(len(jobs))]
+    # straggling tasks may be started twice if the copies write to separate outputs
+    speculate = getattr(syscall, 'speculative', False)
+    token = journal_key('copy', outputs)[:12]
+    commands = []
+    for task in tasks:
+        rendered = []
+        for idx in task:
+            value = inputs[idx] if infield == 'inputfiles' else inputs[idx][0]
+            outputfile = _copy_output(outputs[idx]) if speculate else outputs[idx]
+            if posrep:
+                rendered.append(cmd.render(value, outputfile))
+            else:
+                rendered.append(cmd.render(**{infield: value, 'outputfile': outputfile}))
+            if speculate:
+                rendered[-1] = _isolate_copy(rendered[-1], [outputs[idx]], token)
+        if len(rendered) == 1:
+            commands.append(rendered[0])
+        else:
+            # all jobs of a bundle are executed, the task fails if any of them fails
+            commands.append('PP_RC=0 ; ' + ' ; '.join(['( {} ) || PP_RC=1'.format(c) for c in rendered]) +
+                            ' ; ( exit $PP_RC )')
+    try:
+        out, err, runtimes = _run_bulk(commands, syscall, tabledir, keeptable, history is not None, outputs,
+                                       speculate)
+    finally:
+        if speculate:
+            _remove_copies(outputs, token)
+    missing = set(_wait_visible(syscall, outputs))
+    for num, task in enumerate(tasks, start=1):
+        # runtimes of bundles cannot be attributed to single jobs
+        if num in runtimes and len(task) == 1 and outputs[task[0]] not in missing:
+            history.record(cmd, inputs[task[0]], runtimes[num])
+    if missing:
+        failed = [(num, outputs[idx]) for num, task in enumerate(tasks, start=1)
+                  for idx in task if outputs[idx] in missing]
+        raise RuntimeError('Output paths are not files for {} of {} tasks - jobs failed?\n'
+                           'First failed (task, output): {}\n{}'.format(len(failed), len(outputs),
+                                                                         failed[:10], err))
+    _ = _check_job(out, err)
+    return outputs
+
+
+def syscall_bulk_in_out(jobs, cmd, syscall, posrep=False, tabledir=None, keeptable=False, history=None, lpt=False,
+                        capacity=None, bundles=None):
+    """
+    Task-level counterpart of syscall_in_out: all jobs of a (Ruffus) task
+    are validated and rendered at once and submitted as a single array job
+
+    :param jobs: list of (inputfile, outputfile) pairs
+    :param cmd:
+    :param syscall: array job callable, see SysCallInterface.drmaa_arrayjob_argv
+    :param posrep:
+    :param tabledir: folder for the command table, must be accessible from the
+     compute nodes (default: current working directory)
+    :param keeptable:
+    :param history: order the jobs by predicted runtime (longest first)
+     and record the runtimes of this run
+     :type: RuntimeHistory
+    :param lpt: order the jobs by total input size (longest first) if no history is given
+    :param capacity: run small jobs together as one task, up to this total input size
+     (bytes) or, if a history is given, predicted runtime (seconds); larger jobs run alone.
+     With history, jobs are only bundled once the runtime of all jobs can be predicted
+    :param bundles: alternatively, pack the jobs into this number of balanced tasks
+    :return: output files in the order of jobs
+     :rtype: list of str
+    """
+    return _bulk_jobs(jobs, cmd, syscall, 'inputfile', posrep, tabledir, keeptable, history, lpt,
+                      capacity, bundles)
+
+
+def syscall_bulk_ins_out(jobs, cmd, syscall, posrep=False, tabledir=None, keeptable=False, history=None, lpt=False,
+                         capacity=None, bundles=None):
+    """
+    Task-level counterpart of syscall_ins_out, see syscall_bulk_in_out
+
+    :param jobs: list of (inputfiles, outputfile) pairs
+    :return: output files in the order of jobs
+     :rtype: list of str
+    """
+    return _bulk_jobs(jobs, cmd, syscall, 'inputfiles', posrep, tabledir, keeptable, history, lpt,
+                      capacity, bundles)
+
+
+# placeholders supported by the job functions and
+# whether or not positional replacement is supported
+JOBFUN_FIELDS = {'raw': ((), False),
+                 'in_out': (('inputfile', 'outputfile'), True),
+                 'inref_out': (('inputfile', 'outputfile', 'referencefile'), False),
+                 'in_pat': (('inputfile', 'outdir'), True),
+                 'in_out_ref': (('inputfile', 'outputfile', 'referencefile'), False),
+                 'ins_out': (('inputfiles', 'outputfile'), True),
+                 'ins_pat': (('inputfiles', 'outdir'), True),
+                 'ins_out_ref': (('inputfiles', 'outputfile', 'referencefile'), False),
+                 'inpair_out': (('inputfile1', 'inputfile2', 'outputfile'), False),
+                 'in_outpair': (('inputfile', 'outputfile1', 'outputfile2'), False),
+                 'bulk_in_out': (('inputfile', 'outputfile'), True),
+                 'bulk_ins_out': (('inputfiles', 'outputfile'), True)}
+
+
+def compile_command(cmd, jfname=None, quote=False):
+    """
+    :param cmd: command line
+    :param jfname: name of the job function the command is used with,
+     if given, the placeholders are validated
+    :param quote: quote substituted values for the shell
+    :return:
+     :rtype: CommandTemplate
+    """
+    template = CommandTemplate(cmd, quote)
+    if jfname is not None:
+        assert jfname in JOBFUN_FIELDS, 'No placeholder information for job function: {}'.format(jfname)
+        names, posrep = JOBFUN_FIELDS[jfname]
+        template.validate(names, len(names) if posrep else 0)
+    return template
+
+
 JOBFUN_REGISTRY = {'raw': syscall_raw,
                    'in_out': syscall_in_out,
                    'inref_out': syscall_inref_out,
@@ -341,4 +1270,9 @@ JOBFUN_REGISTRY = {'raw': syscall_raw,
                    'ins_pat': syscall_ins_pat,
                    'ins_out_ref': syscall_ins_out_ref,
                    'inpair_out': syscall_inpair_out,
-                   'in_outpair': syscall_in_outpair}
+                   'in_outpair': syscall_in_outpair,
+                   'bulk_in_out': syscall_bulk_in_out,
+                   'bulk_ins_out': syscall_bulk_ins_out,
+                   'py_in_out': syscall_py_in_out,
+                   'py_ins_out': syscall_py_ins_out,
+                   'fused_in_out': syscall_fused_in_out}
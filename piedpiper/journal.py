@@ -0,0 +1,165 @@
+# coding=utf-8
+
+"""
+Module implementing a journal of submitted grid jobs. Each submission and each
+collected job is appended to a local file (one JSON record per line). If the runner
+process dies, a restarted runner can look up jobs that were submitted but never
+collected and reattach to them instead of submitting the same command again.
+The journal also stores the DRMAA session contact string so that the session
+can be reopened if the DRMAA implementation supports it.
+"""
+
+import os as os
+import json as json
+import time as time
+import hashlib as hsl
+import threading as thd
+
+
+def journal_key(cmd, argv=None):
+    """
+    Jobs are identified by their command line (and arguments)
+
+    :param cmd:
+    :param argv:
+    :return:
+     :rtype: str
+    """
+    argv = [] if argv is None else list(map(str, argv))
+    key = '\0'.join([cmd] + argv)
+    return hsl.sha1(key.encode('utf-8')).hexdigest()
+
+
+class JobJournal(object):
+    """
+    Append-only journal file, records are of type
+    session (DRMAA contact string), submit and collect
+    """
+    def __init__(self, path):
+        """
+        :param path: journal file, created if it does not exist
+        """
+        self.path = os.path.abspath(path)
+        self.contact = None
+        self.pending = dict()
+        self._lock = thd.Lock()
+        self._load()
+        self._compact()
+
+    def _load(self):
+        """
+        Read all records, keep track of submitted
+        jobs that have not been collected
+
+        :return: None
+        """
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'r') as infile:
+            for line in infile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # incomplete last line, runner died while writing
+                if record['event'] == 'session':
+                    self.contact = record['contact']
+                elif record['event'] == 'submit':
+                    self.pending[record['key']] = record
+                elif record['event'] == 'collect':
+                    try:
+                        if self.pending[record['key']]['jobid'] == record['jobid']:
+                            del self.pending[record['key']]
+                    except KeyError:
+                        pass
+        return
+
+    def _compact(self):
+        """
+        Rewrite journal with the records that are still relevant
+
+        :return: None
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmpfile = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmpfile, 'w') as outfile:
+            if self.contact is not None:
+                _ = outfile.write(json.dumps({'event': 'session', 'contact': self.contact}) + '\n')
+            for record in self.pending.values():
+                _ = outfile.write(json.dumps(record) + '\n')
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmpfile, self.path)
+        return
+
+    def _append(self, record):
+        """
+        :param record:
+        :return: None
+        """
+        record['time'] = time.time()
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as outfile:
+                _ = outfile.write(line)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        return
+
+    def record_session(self, contact):
+        """
+        :param contact: DRMAA session contact string
+        :return: None
+        """
+        if contact and contact != self.contact:
+            self.contact = contact
+            self._append({'event': 'session', 'contact': contact})
+        return
+
+    def record_submit(self, key, jobid, cmd, jobtemplate, outputs=None):
+        """
+        :param key: see journal_key
+        :param jobid:
+        :param cmd:
+        :param jobtemplate: the DRMAA JobTemplate used for submission
+        :param outputs: list of expected output files (if known)
+        :return: None
+        """
+        template = dict()
+        for attr in ['jobName', 'workingDirectory', 'outputPath', 'errorPath',
+                     'nativeSpecification', 'args']:
+            try:
+                template[attr] = getattr(jobtemplate, attr)
+            except Exception:
+                pass
+        if 'args' in template:
+            template['args'] = list(map(str, template['args']))
+        record = {'event': 'submit', 'key': key, 'jobid': jobid, 'cmd': cmd,
+                  'outputs': [] if outputs is None else list(outputs), 'template': template}
+        self._append(record)
+        with self._lock:
+            self.pending[key] = record
+        return
+
+    def record_collect(self, key, jobid):
+        """
+        :param key:
+        :param jobid:
+        :return: None
+        """
+        self._append({'event': 'collect', 'key': key, 'jobid': jobid})
+        with self._lock:
+            try:
+                if self.pending[key]['jobid'] == jobid:
+                    del self.pending[key]
+            except KeyError:
+                pass
+        return
+
+    def pending_job(self, key):
+        """
+        :param key:
+        :return: the submit record of a job that was never collected
+         :rtype: dict or None
+        """
+        with self._lock:
+            return self.pending.get(key, None)
@@ -0,0 +1,251 @@
+# coding=utf-8
+
+"""
+Module implementing a write-ahead ledger for the output files of job functions.
+Before a job is started, its output files are marked as "started" in a small SQLite
+database; after the job finished and the outputs have been verified, they are marked
+as "committed" together with their size, modification time and (optionally) checksum.
+An output file that is still marked as "started" belongs to a job that was interrupted,
+i.e. it may be incomplete and is removed before the job is run again. A committed output
+is trusted as long as the command, the inputs and the output itself are unchanged.
+Since Ruffus decides from file timestamps whether a job has to be run at all, a partial
+output that is newer than its inputs would never be passed to a job function again. Hence,
+all uncommitted outputs are removed when the ledger is opened by a new run (see recover),
+or, alternatively, the ledger decides for Ruffus (see needs_update, @check_if_uptodate).
+
+Note that SQLite locking is not reliable on some network file systems, i.e. the
+ledger database should be placed on a local disk.
+"""
+
+import os as os
+import json as json
+import time as time
+import sqlite3 as sql
+import hashlib as hsl
+import threading as thd
+
+_SCHEMA = 'CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, state TEXT NOT NULL,' \
+          ' signature TEXT NOT NULL, size INTEGER, mtime_ns INTEGER, checksum TEXT,' \
+          ' started REAL, committed REAL)'
+
+
+def _file_checksum(filepath, blocksize=1024 * 1024):
+    """
+    :param filepath:
+    :param blocksize:
+    :return: MD5 hex digest
+     :rtype: str
+    """
+    md5 = hsl.md5()
+    with open(filepath, 'rb') as infile:
+        while True:
+            block = infile.read(blocksize)
+            if not block:
+                break
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _flatten(paths):
+    """
+    :param paths: path or (nested) list of paths
+    :return: list of paths
+    """
+    if isinstance(paths, str):
+        return [paths]
+    flat = []
+    for p in paths:
+        flat.extend(_flatten(p))
+    return flat
+
+
+def job_signature(cmd, inputs):
+    """
+    A committed output is only valid for the same
+    command and the same (unchanged) input files
+
+    :param cmd:
+    :param inputs: list of input file paths
+    :return:
+     :rtype: str
+    """
+    states = []
+    for f in inputs:
+        try:
+            st = os.stat(f)
+            states.append([f, st.st_mtime_ns, st.st_size])
+        except OSError:
+            states.append([f, None, None])
+    sig = json.dumps([str(cmd), states])
+    return hsl.sha1(sig.encode('utf-8')).hexdigest()
+
+
+class OutputLedger(object):
+    """
+    Can be passed to the job functions (keyword: ledger). The object
+    can be pickled (e.g. for multiprocessing in Ruffus), each process
+    opens its own connection to the database
+    """
+    def __init__(self, path, checksum=False):
+        """
+        :param path: path to the SQLite database file
+        :param checksum: compute and store MD5 checksum of committed outputs
+        """
+        self.path = os.path.abspath(path)
+        self.checksum = checksum
+        self._lock = thd.Lock()
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'checksum': self.checksum}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['checksum'])
+
+    def _connection(self):
+        """
+        :return: connection for the current process
+        """
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sql.connect(self.path, timeout=60, check_same_thread=False)
+            self._conn.execute(_SCHEMA)
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def is_committed(self, outputs, signature, verify=False):
+        """
+        :param outputs: list of output file paths
+        :param signature: see job_signature
+        :param verify: recompute and compare checksums (if recorded)
+        :return: True if all outputs are committed for this job signature
+         and have not been changed since
+         :rtype: bool
+        """
+        with self._lock:
+            conn = self._connection()
+            for f in outputs:
+                row = conn.execute('SELECT state, signature, size, mtime_ns, checksum'
+                                   ' FROM outputs WHERE path = ?', (f, )).fetchone()
+                if row is None or row[0] != 'committed' or row[1] != signature:
+                    return False
+                try:
+                    st = os.stat(f)
+                except OSError:
+                    return False
+                if st.st_size != row[2] or st.st_mtime_ns != row[3]:
+                    return False
+                if verify and row[4] is not None and _file_checksum(f) != row[4]:
+                    return False
+        return True
+
+    def begin(self, outputs, signature):
+        """
+        Mark outputs as started (write-ahead). Leftovers of interrupted
+        jobs, i.e. files that were never committed, are removed
+
+        :param outputs:
+        :param signature:
+        :return: None
+        """
+        with self._lock:
+            conn = self._connection()
+            for f in outputs:
+                row = conn.execute('SELECT state FROM outputs WHERE path = ?', (f, )).fetchone()
+                if row is not None and row[0] == 'started' and os.path.isfile(f):
+                    os.unlink(f)
+                conn.execute('INSERT OR REPLACE INTO outputs (path, state, signature, started)'
+                             ' VALUES (?, ?, ?, ?)', (f, 'started', signature, time.time()))
+            conn.commit()
+        return
+
+    def commit(self, outputs):
+        """
+        Mark outputs as committed, i.e. as complete
+
+        :param outputs:
+        :return: None
+        """
+        records = []
+        for f in outputs:
+            st = os.stat(f)
+            chk = _file_checksum(f) if self.checksum else None
+            records.append(('committed', st.st_size, st.st_mtime_ns, chk, time.time(), f))
+        with self._lock:
+            conn = self._connection()
+            conn.executemany('UPDATE outputs SET state = ?, size = ?, mtime_ns = ?,'
+                             ' checksum = ?, committed = ? WHERE path = ?', records)
+            conn.commit()
+        return
+
+    def uncommitted(self):
+        """
+        :return: all outputs that have been started but never committed
+         :rtype: list of str
+        """
+        with self._lock:
+            conn = self._connection()
+            rows = conn.execute('SELECT path FROM outputs WHERE state = ?', ('started', )).fetchall()
+        return [r[0] for r in rows]
+
+    def recover(self, before=None):
+        """
+        Startup step for a new run: remove all outputs that have been
+        started but never committed, i.e. outputs of interrupted jobs.
+        Must not be called while jobs recording to this ledger are running
+
+        :param before: only outputs started before this time (seconds
+         since the epoch), default: now
+        :return: removed output files
+         :rtype: list of str
+        """
+        before = time.time() if before is None else before
+        removed = []
+        with self._lock:
+            conn = self._connection()
+            rows = conn.execute('SELECT path FROM outputs WHERE state = ? AND started < ?',
+                                ('started', before)).fetchall()
+            for row in rows:
+                if os.path.isfile(row[0]):
+                    os.unlink(row[0])
+                    removed.append(row[0])
+            conn.executemany('DELETE FROM outputs WHERE path = ?', rows)
+            conn.commit()
+        return removed
+
+    def needs_update(self, inputs, outputs, *extras):
+        """
+        Can be used with Ruffus' @check_if_uptodate(ledger.needs_update):
+        a job has to be run if any of its outputs is missing or uncommitted,
+        or (as for Ruffus' default check) older than any of its inputs. If the
+        ledger records checksums, committed outputs must also match their checksum
+
+        :param inputs: input file(s) of the job
+        :param outputs: output file(s) of the job
+        :param extras: ignored
+        :return: True if the job has to be run, and the reason
+         :rtype: bool, str
+        """
+        inputs, outputs = _flatten(inputs), _flatten(outputs)
+        with self._lock:
+            conn = self._connection()
+            for f in outputs:
+                row = conn.execute('SELECT state, checksum FROM outputs WHERE path = ?', (f, )).fetchone()
+                if row is None:
+                    continue
+                if row[0] == 'started':
+                    return True, 'Output file not committed: {}'.format(f)
+                if self.checksum and row[1] is not None and os.path.isfile(f) and _file_checksum(f) != row[1]:
+                    return True, 'Output file changed since commit: {}'.format(f)
+        try:
+            oldest = min([os.stat(f).st_mtime_ns for f in outputs])
+        except (OSError, ValueError):
+            return True, 'Missing output file(s): {}'.format(outputs)
+        for f in inputs:
+            try:
+                if os.stat(f).st_mtime_ns > oldest:
+                    return True, 'Input file is newer than output: {}'.format(f)
+            except OSError:
+                continue
+        return False, 'All output files committed and up to date'
@@ -0,0 +1,190 @@
+# coding=utf-8
+
+"""
+Module to collect the stdout/stderr files of grid jobs (*.o<jobid> / *.e<jobid>)
+into a single compressed archive per pipeline run. Each log is stored as an independent
+zlib stream in the archive data file, and an index file (one JSON record per line)
+maps job ID and stream to offset and length in the data file. This allows random access
+to the log of any job without decompressing the whole archive. Identical logs (e.g. empty
+stderr files or the same warning over and over again) are stored only once.
+The original files are deleted after they have been archived.
+"""
+
+import os as os
+import re as re
+import json as json
+import zlib as zlib
+import fcntl as fcntl
+import hashlib as hsl
+import fnmatch as fnm
+import threading as thd
+
+# SGE naming scheme: JOBNAME.o12345 or, for array jobs, JOBNAME.o12345.7
+_LOG_NAME = re.compile('\\.(?P<stream>[oe])(?P<jobid>[0-9]+(\\.[0-9]+)?)$')
+
+_CHUNK = 1024 * 1024
+
+
+class LogArchive(object):
+    """
+    Append-only archive; safe to use from several threads
+    and processes (writes are protected by a file lock)
+    """
+    def __init__(self, path, level=6):
+        """
+        :param path: path to the archive data file; the index is stored in <path>.idx
+        :param level: zlib compression level
+        """
+        self.path = os.path.abspath(path)
+        self.index_path = self.path + '.idx'
+        self.level = level
+        self._lock = thd.Lock()
+        self._index = dict()
+        self._blobs = dict()
+        self._index_pos = 0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'ab'):
+            pass
+        self._read_index()
+
+    def _read_index(self):
+        """
+        Read all index records that have been added
+        (possibly by other processes) since the last call
+
+        :return: None
+        """
+        if not os.path.isfile(self.index_path):
+            return
+        with open(self.index_path, 'r') as idx:
+            _ = idx.seek(self._index_pos)
+            for line in idx:
+                if not line.endswith('\n'):
+                    break  # being written by another process
+                self._index_pos += len(line.encode('utf-8'))
+                entry = json.loads(line)
+                self._index[(entry['jobid'], entry['stream'])] = entry
+                self._blobs[entry['digest']] = entry
+        return
+
+    @staticmethod
+    def _file_digest(filepath):
+        """
+        :param filepath:
+        :return: SHA1 digest and size of file content
+        """
+        sha1 = hsl.sha1()
+        size = 0
+        with open(filepath, 'rb') as infile:
+            while True:
+                chunk = infile.read(_CHUNK)
+                if not chunk:
+                    break
+                sha1.update(chunk)
+                size += len(chunk)
+        return sha1.hexdigest(), size
+
+    def add_file(self, filepath, jobid, stream, remove=True):
+        """
+        :param filepath: the log file
+        :param jobid: grid engine job ID (including task ID for array jobs)
+        :param stream: 'o' (stdout) or 'e' (stderr)
+        :param remove: delete the log file after archiving
+        :return: None
+        """
+        digest, size = self._file_digest(filepath)
+        with self._lock, open(self.path, 'ab') as data:
+            fcntl.flock(data, fcntl.LOCK_EX)
+            try:
+                self._read_index()
+                if digest in self._blobs:
+                    blob = self._blobs[digest]
+                    offset, length = blob['offset'], blob['length']
+                else:
+                    offset = data.seek(0, os.SEEK_END)
+                    comp = zlib.compressobj(self.level)
+                    with open(filepath, 'rb') as infile:
+                        while True:
+                            chunk = infile.read(_CHUNK)
+                            if not chunk:
+                                break
+                            data.write(comp.compress(chunk))
+                    data.write(comp.flush())
+                    data.flush()
+                    length = data.tell() - offset
+                entry = {'jobid': str(jobid), 'stream': stream, 'name': os.path.basename(filepath),
+                         'offset': offset, 'length': length, 'size': size, 'digest': digest}
+                line = json.dumps(entry) + '\n'
+                with open(self.index_path, 'a') as idx:
+                    idx.write(line)
+                self._read_index()
+            finally:
+                fcntl.flock(data, fcntl.LOCK_UN)
+        if remove:
+            os.unlink(filepath)
+        return
+
+    def add_output_files(self, folder, endpattern, remove=True):
+        """
+        Archive all log files in folder matching the pattern, e.g.,
+        '*o12345' as used when reading job output (_read_output_file)
+
+        :param folder:
+        :param endpattern:
+        :param remove:
+        :return: number of archived files
+        """
+        if not os.path.isdir(folder):
+            return 0
+        count = 0
+        for name in fnm.filter(os.listdir(folder), endpattern):
+            mobj = _LOG_NAME.search(name)
+            if mobj is None:
+                continue
+            self.add_file(os.path.join(folder, name), mobj.group('jobid'), mobj.group('stream'), remove)
+            count += 1
+        return count
+
+    def add_directory(self, folder, remove=True):
+        """
+        Archive all job log files in folder, e.g., to clean up the
+        output folder of a pipeline run after the fact
+
+        :param folder:
+        :param remove:
+        :return: number of archived files
+        """
+        return self.add_output_files(folder, '*', remove)
+
+    def jobs(self):
+        """
+        :return: all archived (job ID, stream) pairs
+         :rtype: list of tuple
+        """
+        with self._lock:
+            self._read_index()
+            return list(self._index.keys())
+
+    def get(self, jobid, stream='o'):
+        """
+        :param jobid:
+        :param stream: 'o' (stdout) or 'e' (stderr)
+        :return: log content
+         :rtype: str
+        """
+        with self._lock:
+            self._read_index()
+            entry = self._index[(str(jobid), stream)]
+        decomp = zlib.decompressobj()
+        content = []
+        with open(self.path, 'rb') as data:
+            _ = data.seek(entry['offset'])
+            remaining = entry['length']
+            while remaining > 0:
+                chunk = data.read(min(_CHUNK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                content.append(decomp.decompress(chunk))
+        content.append(decomp.flush())
+        return b''.join(content).decode('utf-8', errors='replace')
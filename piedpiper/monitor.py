@@ -0,0 +1,283 @@
+# coding=utf-8
+
+"""
+Module to monitor the tasks of DRMAA array jobs while they are running. Instead
+of blocking in a single call to synchronize until all tasks are done, the state
+of each task is polled. A task that runs considerably longer than its siblings
+(e.g. because it was scheduled on a slow or overloaded node) is started a second
+time, and whichever copy finishes first is used, the other one is killed.
+Copies are only started if the outputs of the copies are isolated from each
+other (see syscalls.drmaa_arrayjob, argument speculate), otherwise both copies
+would write to the same output files.
+Runtimes are measured by polling from the first time a task is seen running,
+i.e. with a resolution of the poll interval.
+Similarly, hanging jobs are detected by polling: as long as a job is running,
+its stdout/stderr files have to grow every now and then, otherwise the job is
+terminated (and optionally submitted again) after a configurable period of time.
+"""
+
+import os as os
+import re as re
+import sys as sys
+import time as time
+import math as math
+import itertools as itt
+import collections as col
+
+# DRMAA job states (drmaa.JobState)
+_FINISHED = ('done', 'failed')
+_RUNNING = 'running'
+
+# SGE naming scheme of job output files: JOBNAME.o12345 or JOBNAME.e12345.7
+_LOG_NAME = re.compile('\\.[oe](?P<jobid>[0-9]+(\\.[0-9]+)?)$')
+
+
+def _job_status(session, jid):
+    """
+    :param session:
+    :param jid:
+    :return: DRMAA job state, 'failed' if the job is no longer known
+    """
+    try:
+        return session.jobStatus(jid)
+    except Exception:
+        return 'failed'
+
+
+def _percentile(values, pct):
+    """
+    :param values: non-empty list of numbers
+    :param pct: percentile in (0, 100]
+    :return: nearest-rank percentile
+    """
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100. * len(values)))
+    return values[max(0, min(rank, len(values)) - 1)]
+
+
+class StragglerMonitor(object):
+    """
+    Speculative re-execution of straggling array tasks; the object does not
+    keep state between calls of wait, i.e. it can be shared by several jobs
+    """
+    def __init__(self, percentile=90, factor=1.5, min_done=0.5, min_runtime=60,
+                 poll=30, max_copies=2):
+        """
+        :param percentile: percentile of the runtimes of all finished tasks...
+        :param factor: ...times this factor is the runtime after which a task is considered a straggler
+        :param min_done: fraction of tasks that must have finished before stragglers are detected
+        :param min_runtime: never start copies of tasks running for less than this many seconds
+        :param poll: seconds between status checks
+        :param max_copies: maximal number of (concurrent) copies of a task, including the original
+        """
+        assert 0 < percentile <= 100, 'Percentile must be in (0, 100]: {}'.format(percentile)
+        assert max_copies > 0, 'Maximal number of task copies must be positive: {}'.format(max_copies)
+        self.percentile = percentile
+        self.factor = factor
+        self.min_done = min_done
+        self.min_runtime = min_runtime
+        self.poll = poll
+        self.max_copies = max_copies
+
+    def _threshold(self, runtimes, num_tasks):
+        """
+        :param runtimes: runtimes of finished tasks
+        :param num_tasks: total number of tasks
+        :return: runtime in seconds after which a task is a straggler, None if undetermined
+        """
+        if not runtimes or len(runtimes) < self.min_done * num_tasks:
+            return None
+        return max(self.min_runtime, self.factor * _percentile(runtimes, self.percentile))
+
+    @staticmethod
+    def _kill(session, jids, waitforever):
+        """
+        Terminate copies that are no longer needed, and
+        wait for them to release resources in the session
+        """
+        for jid in jids:
+            try:
+                session.control(jid, 'terminate')
+            except Exception:
+                pass  # already finished
+        for jid in jids:
+            try:
+                _ = session.wait(jid, waitforever)
+            except Exception as e:
+                sys.stderr.write('\nWaiting for terminated task {} failed: {}\n'.format(jid, e))
+        return
+
+    def wait(self, jids, session, resubmit, waitforever):
+        """
+        Block until all tasks are finished
+
+        :param jids: job ID combined with task ID (one per task)
+        :param session: DRMAA session
+        :param resubmit: callable taking a task ID and returning the job IDs
+         of the new submission (see syscalls._task_resubmitter)
+        :param waitforever: DRMAA timeout
+        :return: for each task, the job ID of the copy that finished first
+         :rtype: list of str
+        """
+        copies = [[jid] for jid in jids]
+        last_poll = time.time()
+        started = dict()
+        runtimes = []
+        winners = [None] * len(jids)
+        pending = set(range(len(jids)))
+        no_copy = set()
+        while pending:
+            now = time.time()
+            threshold = self._threshold(runtimes, len(jids))
+            for idx in sorted(pending):
+                states = [(jid, _job_status(session, jid)) for jid in copies[idx]]
+                done = [jid for jid, stat in states if stat == 'done']
+                if done or all([stat in _FINISHED for _, stat in states]):
+                    winner = done[0] if done else copies[idx][0]
+                    winners[idx] = winner
+                    pending.remove(idx)
+                    # not seen running: started after the last poll
+                    runtimes.append(now - started.get(winner, last_poll))
+                    losers = [jid for jid in copies[idx] if jid != winner]
+                    if losers:
+                        self._kill(session, losers, waitforever)
+                    continue
+                for jid, stat in states:
+                    if stat == _RUNNING and jid not in started:
+                        started[jid] = now
+                if threshold is None or len(copies[idx]) >= self.max_copies or idx in no_copy:
+                    continue
+                first = copies[idx][0]
+                if first in started and now - started[first] > threshold:
+                    task = int(first.rsplit('.', 1)[1])
+                    try:
+                        copies[idx].extend(resubmit(task))
+                    except Exception as e:
+                        no_copy.add(idx)
+                        sys.stderr.write('\nSubmitting copy of task {} failed: {}\n'.format(first, e))
+            last_poll = now
+            if pending:
+                time.sleep(self.poll)
+        return winners
+
+
+class HeartbeatMonitor(object):
+    """
+    Detect jobs that hang without exiting: a running job has to write to its
+    stdout or stderr file at least once within the timeout. If the output of
+    the jobs is discarded (/dev/null), jobs cannot be monitored
+    """
+    def __init__(self, timeout=3600, retries=0, poll=60):
+        """
+        :param timeout: seconds without growth of the output files after which a job is terminated
+        :param retries: how often a terminated job is submitted again
+        :param poll: seconds between checks
+        """
+        assert timeout > 0, 'Heartbeat timeout must be positive: {}'.format(timeout)
+        self.timeout = timeout
+        self.retries = retries
+        self.poll = poll
+
+    @staticmethod
+    def _output_sizes(folders, jids, jobname=None):
+        """
+        :param folders: folders containing job output files
+        :param jids: job IDs of interest
+        :param jobname: if known, only the output files of the jobs (JOBNAME.o<jid>
+         and JOBNAME.e<jid>) are checked, otherwise the folders are listed
+        :return: combined size and latest mtime of output files per job
+         :rtype: dict
+        """
+        sizes = dict()
+        if jobname:
+            for jid in jids:
+                for folder, ext in itt.product(folders, ('o', 'e')):
+                    try:
+                        st = os.stat(os.path.join(folder, '{}.{}{}'.format(jobname, ext, jid)))
+                    except OSError:
+                        continue
+                    size, mtime = sizes.get(jid, (0, 0))
+                    sizes[jid] = size + st.st_size, max(mtime, st.st_mtime_ns)
+            return sizes
+        for folder in folders:
+            try:
+                names = os.listdir(folder)
+            except OSError:
+                continue
+            for name in names:
+                mobj = _LOG_NAME.search(name)
+                if mobj is None or mobj.group('jobid') not in jids:
+                    continue
+                try:
+                    st = os.stat(os.path.join(folder, name))
+                except OSError:
+                    continue
+                size, mtime = sizes.get(mobj.group('jobid'), (0, 0))
+                sizes[mobj.group('jobid')] = size + st.st_size, max(mtime, st.st_mtime_ns)
+        return sizes
+
+    def watch(self, jids, session, resubmit, outpath, errpath, waitforever, jobname=None):
+        """
+        Block until all jobs are finished or have been terminated
+
+        :param jids: job IDs (or job IDs combined with task IDs)
+        :param session: DRMAA session
+        :param resubmit: callable taking a job ID and returning the ID of the new
+         submission; None = no resubmission
+        :param outpath: stdout path of the job template
+        :param errpath: stderr path of the job template
+        :param waitforever: DRMAA timeout
+        :param jobname: name of the jobs (job template), see _output_sizes
+        :return: current job IDs (resubmitted jobs replaced) and notes on terminated
+         jobs (list of messages per index in jids)
+         :rtype: list of str, dict
+        """
+        folders = [f for f in set([outpath.strip(':'), errpath.strip(':')]) if os.path.isdir(f)]
+        current = list(jids)
+        notes = col.defaultdict(list)
+        if not folders:
+            return current, notes
+        attempts = [0] * len(current)
+        progress = [None] * len(current)
+        pending = set(range(len(current)))
+        while pending:
+            now = time.time()
+            running = dict()
+            for idx in sorted(pending):
+                stat = _job_status(session, current[idx])
+                if stat in _FINISHED:
+                    pending.remove(idx)
+                elif stat != _RUNNING:
+                    progress[idx] = None  # waiting time in queue does not count
+                else:
+                    running[current[idx]] = idx
+            sizes = self._output_sizes(folders, running, jobname) if running else dict()
+            for jid, idx in running.items():
+                state = sizes.get(jid, (0, 0))
+                if progress[idx] is None or progress[idx][0] != state:
+                    progress[idx] = state, now
+                    continue
+                if now - progress[idx][1] <= self.timeout:
+                    continue
+                hung = 'job {} terminated: no output for more than {} seconds'.format(jid, self.timeout)
+                try:
+                    session.control(jid, 'terminate')
+                except Exception as e:
+                    notes[idx].append('Terminating job {} failed: {}'.format(jid, e))
+                if resubmit is None or attempts[idx] >= self.retries:
+                    # reported as error, the job output is incomplete
+                    notes[idx].append('Error: ' + hung)
+                    pending.remove(idx)
+                    continue
+                try:
+                    _ = session.wait(jid, waitforever)
+                    current[idx] = resubmit(jid)
+                    attempts[idx] += 1
+                    progress[idx] = None
+                    notes[idx].append('Warning: {} - submitted again as job {}'.format(hung, current[idx]))
+                except Exception as e:
+                    notes[idx].append('Error: {} - submitting again failed: {}'.format(hung, e))
+                    pending.remove(idx)
+            if pending:
+                time.sleep(self.poll)
+        return current, notes
@@ -0,0 +1,73 @@
+# coding=utf-8
+
+"""
+Module to pack many small jobs into fewer, balanced bundles; each bundle
+is then executed as a single grid job (or array task). The weight of a job is
+either the total size of its input files or its predicted runtime (see runhistory).
+Bundles are filled first-fit-decreasing up to a capacity, jobs at or above the
+capacity always form a bundle of their own. Alternatively, the jobs are distributed
+over a fixed number of bundles longest-first, each job is added to the currently
+lightest bundle (LPT).
+"""
+
+import heapq as hpq
+
+
+def pack_jobs(weights, capacity=None, num_bundles=None, max_jobs=None):
+    """
+    :param weights: weight per job (e.g. bytes or seconds)
+    :param capacity: maximal total weight of a bundle
+    :param num_bundles: if no capacity is given, number of bundles (fewer
+     if there are fewer jobs, more if max_jobs does not permit this number)
+    :param max_jobs: maximal number of jobs per bundle
+    :return: bundles (lists of job indices), heaviest bundle first
+     :rtype: list of list of int
+    """
+    assert capacity is not None or num_bundles is not None, 'Packing jobs requires capacity or number of bundles'
+    if not weights:
+        return []
+    assert max_jobs is None or max_jobs > 0, 'Maximal number of jobs per bundle must be positive: {}'.format(max_jobs)
+    if capacity is None:
+        assert num_bundles > 0, 'Number of bundles must be positive: {}'.format(num_bundles)
+        return _pack_lpt(weights, num_bundles, max_jobs)
+    bundles, loads = [], []
+    for idx in sorted(range(len(weights)), key=lambda i: weights[i], reverse=True):
+        w = weights[idx]
+        if w >= capacity:
+            bundles.append([idx])
+            loads.append(w)
+            continue
+        for b, load in enumerate(loads):
+            if load + w <= capacity and (max_jobs is None or len(bundles[b]) < max_jobs):
+                bundles[b].append(idx)
+                loads[b] += w
+                break
+        else:
+            bundles.append([idx])
+            loads.append(w)
+    order = sorted(range(len(bundles)), key=lambda b: loads[b], reverse=True)
+    return [bundles[b] for b in order]
+
+
+def _pack_lpt(weights, num_bundles, max_jobs=None):
+    """
+    :param weights:
+    :param num_bundles:
+    :param max_jobs:
+    :return: bundles (lists of job indices), heaviest bundle first
+     :rtype: list of list of int
+    """
+    num_bundles = min(num_bundles, len(weights))
+    if max_jobs is not None:
+        num_bundles = max(num_bundles, -(-len(weights) // max_jobs))
+    bundles = [[] for _ in range(num_bundles)]
+    # lightest bundle first, ties are broken by number of jobs (e.g. all weights zero)
+    heap = [(0, 0, b) for b in range(num_bundles)]
+    for idx in sorted(range(len(weights)), key=lambda i: weights[i], reverse=True):
+        load, count, b = hpq.heappop(heap)
+        bundles[b].append(idx)
+        if max_jobs is None or count + 1 < max_jobs:
+            hpq.heappush(heap, (load + weights[idx], count + 1, b))
+    loads = [sum([weights[idx] for idx in bundle]) for bundle in bundles]
+    order = sorted(range(num_bundles), key=lambda b: loads[b], reverse=True)
+    return [bundles[b] for b in order]
@@ -0,0 +1,376 @@
+# coding=utf-8
+
+"""
+Module implementing a pool of pilot jobs: a small number of long-lived worker
+processes is started once (as grid jobs via DRMAA or as local processes) and the
+workers then pull the actual commands from a queue served by the pipeline runner.
+Short tasks thus do not pay the scheduling latency of the grid engine for each
+single job, but only for starting the workers.
+The workers connect to the runner via TCP (multiprocessing.connection, authenticated
+with a random key). A worker is started as
+
+python -m piedpiper.pilot HOST PORT KEYFILE
+
+The key is read from KEYFILE (hex-encoded, only readable by the owner); it is
+not passed in the job environment, which any user can inspect via qstat -j
+"""
+
+import os as os
+import sys as sys
+import time as time
+import queue as queue
+import socket as socket
+import threading as thd
+import tempfile as tempfile
+import subprocess as sp
+import concurrent.futures as cf
+import multiprocessing.connection as mpc
+
+from piedpiper.syscalls import exec_env, custom_systemcall
+
+
+class PilotPool(object):
+    """
+    Runner side of the pilot pool. Commands are dispatched to
+    whichever worker is idle; if a worker is lost while running
+    a command, the command is handed to another worker (once).
+    If no worker is connected, pending commands fail once all started
+    workers are gone or after the timeout (i.e. they do not wait forever
+    for workers that never start, e.g. stuck in the grid queue)
+    """
+    def __init__(self, host=None, max_attempts=2, timeout=600, poll=5):
+        """
+        :param host: address the workers connect to; default: the
+         fully qualified name of this host, must be reachable from the compute nodes
+        :param max_attempts: how often a command is dispatched if workers are lost
+        :param timeout: seconds w/o any connected worker before pending commands
+         fail, None = wait forever
+        :param poll: seconds between checks for connected workers
+        """
+        self.authkey = os.urandom(32)
+        host = socket.getfqdn() if host is None else host
+        self.listener = mpc.Listener((host, 0), family='AF_INET', authkey=self.authkey)
+        self.address = self.listener.address
+        self.max_attempts = max_attempts
+        self._tasks = queue.Queue()
+        self._lock = thd.Lock()
+        self._handlers = []
+        self._processes = []
+        self._jobids = []
+        self._session = None
+        self._keyfile = None
+        self._closed = False
+        self.timeout = timeout
+        self._poll = poll
+        self._stop = thd.Event()
+        self._acceptor = thd.Thread(target=self._accept_workers, daemon=True)
+        self._acceptor.start()
+        self._watchdog = thd.Thread(target=self._watch_workers, daemon=True)
+        self._watchdog.start()
+
+    def write_authkey(self, keydir=None):
+        """
+        Write the key to a file only readable by the owner (created once)
+
+        :param keydir: folder for the key file, must be accessible from
+         the compute nodes (default: current working directory)
+        :return: path to the key file
+        """
+        if self._keyfile is None:
+            # mkstemp creates the file with mode 0600
+            fd, self._keyfile = tempfile.mkstemp(prefix='pp_pilot_', suffix='.key',
+                                                 dir=os.getcwd() if keydir is None else keydir)
+            with os.fdopen(fd, 'w') as outfile:
+                _ = outfile.write(self.authkey.hex())
+        return self._keyfile
+
+    def worker_command(self, keydir=None):
+        """
+        :param keydir: folder for the key file, see write_authkey
+        :return: command (argv) to start a worker
+         :rtype: list of str
+        """
+        return [sys.executable, '-m', 'piedpiper.pilot', str(self.address[0]), str(self.address[1]),
+                self.write_authkey(keydir)]
+
+    def worker_env(self, env=None):
+        """
+        :param env: base environment, default: current environment
+        :return: environment for a worker process
+         :rtype: dict
+        """
+        env = dict(os.environ) if env is None else dict(env)
+        # make sure the worker can import this package
+        pkgpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        pypath = env.get('PYTHONPATH', '')
+        env['PYTHONPATH'] = pkgpath + (os.pathsep + pypath if pypath else '')
+        return env
+
+    def start_local(self, num_workers, env=None):
+        """
+        Start workers as local processes, e.g., as stand-in for grid jobs
+
+        :param num_workers:
+        :param env:
+        :return: None
+        """
+        keydir = tempfile.gettempdir()
+        for _ in range(num_workers):
+            proc = sp.Popen(self.worker_command(keydir), env=self.worker_env(env), stdin=sp.DEVNULL)
+            self._processes.append(proc)
+        return
+
+    def start_grid(self, num_workers, session, jobtemplate, keydir=None):
+        """
+        Submit workers as array job via DRMAA; the job template
+        should request the resources needed by the commands and
+        a runtime limit that covers the lifetime of the pool
+
+        :param num_workers:
+        :param session: DRMAA session
+        :param jobtemplate: configured job template
+        :param keydir: folder for the key file, see write_authkey
+        :return: None
+        """
+        cmd = self.worker_command(keydir)
+        jobtemplate.remoteCommand = cmd[0]
+        jobtemplate.args = cmd[1:]
+        jobtemplate.jobEnvironment = self.worker_env(jobtemplate.jobEnvironment)
+        self._session = session
+        self._jobids.extend(session.runBulkJobs(jobtemplate, 1, num_workers, 1))
+        return
+
+    def _accept_workers(self):
+        """
+        Accept worker connections until the pool is closed
+        """
+        while not self._closed:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, mpc.AuthenticationError):
+                if self._closed:
+                    break
+                continue
+            handler = thd.Thread(target=self._serve_worker, args=(conn, ), daemon=True)
+            with self._lock:
+                self._handlers.append(handler)
+            handler.start()
+        return
+
+    def _workers_gone(self):
+        """
+        :return: all started workers have terminated (False if none were started)
+         :rtype: bool
+        """
+        if self._processes:
+            return all([proc.poll() is not None for proc in self._processes])
+        if self._session is not None and self._jobids:
+            for jid in self._jobids:
+                try:
+                    if self._session.jobStatus(jid) not in ('done', 'failed'):
+                        return False
+                except Exception:
+                    pass  # unknown to the grid engine, i.e. finished long ago
+            return True
+        return False
+
+    def _fail_pending(self, reason):
+        """
+        :param reason: error message for all commands waiting for a worker
+        :return: None
+        """
+        while True:
+            try:
+                task = self._tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is None:
+                continue
+            future, _, cmd, _, _ = task
+            if future.set_running_or_notify_cancel():
+                future.set_result(('', 'ERROR during call: {}\nMessage: {}'.format(cmd, reason)))
+        return
+
+    def _watch_workers(self):
+        """
+        Fail pending commands if no worker is connected and
+        none can be expected to connect anymore
+        """
+        idle_since = time.time()
+        while not self._stop.wait(self._poll):
+            with self._lock:
+                connected = any([h.is_alive() for h in self._handlers])
+            if connected:
+                idle_since = time.time()
+                continue
+            if self._tasks.empty():
+                continue
+            if self._workers_gone():
+                self._fail_pending('all pilot workers have terminated')
+            elif self.timeout is not None and time.time() - idle_since > self.timeout:
+                self._fail_pending('no pilot worker connected within {} seconds'.format(self.timeout))
+        return
+
+    def _serve_worker(self, conn):
+        """
+        Feed commands to a single worker
+
+        :param conn: connection to the worker
+        """
+        try:
+            while True:
+                task = self._tasks.get()
+                if task is None:
+                    conn.send(('stop', ))
+                    break
+                future, attempt, cmd, workdir, env = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    conn.send(('run', cmd, workdir, env))
+                    result = conn.recv()
+                except (OSError, EOFError) as e:
+                    if attempt + 1 < self.max_attempts and not self._closed:
+                        # hand over to another worker
+                        retry = cf.Future()
+                        self._tasks.put((retry, attempt + 1, cmd, workdir, env))
+                        retry.add_done_callback(lambda f, fut=future: _transfer_result(f, fut))
+                    else:
+                        future.set_result(('', 'ERROR during call: {}\nMessage: pilot worker lost:'
+                                               ' {}'.format(cmd, e)))
+                    break
+                future.set_result(result)
+        except (OSError, EOFError):
+            pass
+        finally:
+            conn.close()
+        return
+
+    def submit(self, cmd, workdir=None, env=None):
+        """
+        :param cmd:
+        :param workdir:
+        :param env:
+        :return: future for output on stdout and stderr
+         :rtype: concurrent.futures.Future
+        """
+        assert not self._closed, 'Pilot pool has been closed'
+        future = cf.Future()
+        self._tasks.put((future, 0, cmd, workdir, env))
+        return future
+
+    def run(self, cmd, workdir=None, env=None):
+        """
+        Blocking call, same semantics as the local system call
+
+        :param cmd:
+        :param workdir:
+        :param env:
+        :return: output on stdout and stderr
+         :rtype: 2-tuple of str
+        """
+        return self.submit(cmd, workdir, env).result()
+
+    def close(self):
+        """
+        Stop all workers and the listener
+
+        :return: None
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        with self._lock:
+            handlers = list(self._handlers)
+        for _ in handlers:
+            self._tasks.put(None)
+        for handler in handlers:
+            handler.join(timeout=10)
+        try:
+            self.listener.close()
+        except OSError:
+            pass
+        for proc in self._processes:
+            try:
+                proc.wait(timeout=10)
+            except sp.TimeoutExpired:
+                proc.terminate()
+        if self._session is not None:
+            for jid in self._jobids:
+                try:
+                    self._session.control(jid, 'terminate')
+                except Exception:
+                    pass  # already finished
+        self._fail_pending('pilot pool has been closed')
+        if self._keyfile is not None:
+            try:
+                os.unlink(self._keyfile)
+            except OSError:
+                pass
+        return
+
+
+def _transfer_result(source, target):
+    """
+    :param source: finished future
+    :param target: future waited on by the caller
+    """
+    target.set_result(source.result())
+    return
+
+
+@exec_env
+def pilot_systemcall(cmd, pool, workdir=None, env=None):
+    """
+    Run the command on a worker of the pilot pool
+
+    :param cmd:
+    :param pool:
+     :type: PilotPool
+    :param workdir:
+    :param env:
+    :return:
+    """
+    return pool.run(cmd, workdir, env)
+
+
+def read_authkey(keyfile):
+    """
+    :param keyfile: file written by PilotPool.write_authkey
+    :return: the key
+     :rtype: bytes
+    """
+    with open(keyfile, 'r') as infile:
+        return bytes.fromhex(infile.read().strip())
+
+
+def run_worker(host, port, authkey):
+    """
+    Worker loop: request commands from the runner and execute
+    them until the runner sends the stop signal or goes away
+
+    :param host:
+    :param port:
+    :param authkey:
+     :type: bytes
+    :return: None
+    """
+    conn = mpc.Client((host, port), family='AF_INET', authkey=authkey)
+    try:
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                break
+            if msg[0] != 'run':
+                break
+            _, cmd, workdir, env = msg
+            conn.send(custom_systemcall(cmd, workdir=workdir, env=env))
+    finally:
+        conn.close()
+    return
+
+
+if __name__ == '__main__':
+    run_worker(sys.argv[1], int(sys.argv[2]), read_authkey(sys.argv[3]))
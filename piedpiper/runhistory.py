@@ -0,0 +1,164 @@
+# coding=utf-8
+
+"""
+Module to record the runtime of jobs and to predict the runtime of future jobs
+in order to submit the jobs of a task longest-first (LPT scheduling). This shortens
+the time until the last job of a task finishes if the runtimes differ a lot.
+A job is identified by its command template and its input files; for jobs without
+recorded runtime, the prediction is based on the total size of the input files
+(scaled by the median runtime per byte of all recorded jobs of the same template).
+If the runtime cannot be predicted for all jobs of a task, all jobs of the task
+are weighted by input size instead, i.e. seconds and bytes are never compared.
+Runtimes are appended to a local file (one JSON record per line).
+"""
+
+import os as os
+import json as json
+import time as time
+import hashlib as hsl
+import threading as thd
+import statistics as stat
+import collections as col
+
+
+def _digest(*parts):
+    """
+    :return: SHA1 hex digest of the JSON representation of parts
+    """
+    return hsl.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+
+def _input_size(inputs):
+    """
+    :param inputs: list of file paths
+    :return: total size in bytes (missing files count as zero)
+    """
+    size = 0
+    for f in inputs:
+        try:
+            size += os.stat(f).st_size
+        except OSError:
+            pass
+    return size
+
+
+class RuntimeHistory(object):
+    """
+    Runtimes recorded in the history file; for repeated
+    measurements of the same job, the most recent one is used
+    """
+    def __init__(self, path):
+        """
+        :param path: history file, created if it does not exist
+        """
+        self.path = os.path.abspath(path)
+        self._lock = thd.Lock()
+        self._runtimes = dict()
+        self._rates = col.defaultdict(list)
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as infile:
+                for line in infile:
+                    try:
+                        self._add(json.loads(line))
+                    except (ValueError, KeyError):
+                        continue  # incomplete last line
+
+    def _add(self, record):
+        self._runtimes[record['job']] = record['runtime']
+        if record['size'] > 0:
+            self._rates[record['template']].append(record['runtime'] / record['size'])
+        return
+
+    def record(self, cmd, inputs, runtime):
+        """
+        :param cmd: command template (not the rendered command line)
+        :param inputs: list of input files
+        :param runtime: in seconds
+        :return: None
+        """
+        inputs = list(map(str, inputs))
+        record = {'template': _digest(str(cmd)), 'job': _digest(str(cmd), inputs),
+                  'size': _input_size(inputs), 'runtime': runtime, 'time': time.time()}
+        with self._lock:
+            self._add(record)
+            with open(self.path, 'a') as outfile:
+                _ = outfile.write(json.dumps(record) + '\n')
+        return
+
+    def predict(self, cmd, inputs):
+        """
+        :param cmd: command template
+        :param inputs: list of input files
+        :return: predicted runtime in seconds, None if nothing
+         is known about the command
+         :rtype: float or NoneType
+        """
+        inputs = list(map(str, inputs))
+        with self._lock:
+            job = _digest(str(cmd), inputs)
+            if job in self._runtimes:
+                return self._runtimes[job]
+            rates = self._rates.get(_digest(str(cmd)), None)
+            rate = stat.median(rates) if rates else None
+        return None if rate is None else rate * _input_size(inputs)
+
+
+def predict_runtimes(jobs, cmd, history):
+    """
+    :param jobs: list of input file lists (one per job)
+    :param cmd: command template
+    :param history:
+     :type: RuntimeHistory
+    :return: predicted runtime per job, None if the runtime
+     of any job cannot be predicted
+     :rtype: list of float or NoneType
+    """
+    predicted = [history.predict(cmd, inputs) for inputs in jobs]
+    if any([p is None for p in predicted]):
+        return None
+    return predicted
+
+
+def predict_jobs(jobs, cmd, history=None):
+    """
+    :param jobs: list of input file lists (one per job)
+    :param cmd: command template
+    :param history: if None, the total input size is used
+     :type: RuntimeHistory
+    :return: predicted runtime per job or, if the runtime of any
+     job cannot be predicted, input size per job
+     :rtype: list of float
+    """
+    predicted = None if history is None else predict_runtimes(jobs, cmd, history)
+    if predicted is None:
+        predicted = [float(_input_size(inputs)) for inputs in jobs]
+    return predicted
+
+
+def longest_first(jobs, cmd, history=None):
+    """
+    :param jobs: list of input file lists (one per job)
+    :param cmd: command template
+    :param history: if None, jobs are ordered by total input size
+     :type: RuntimeHistory
+    :return: indices of jobs, longest (expected) job first
+     :rtype: list of int
+    """
+    predicted = predict_jobs(jobs, cmd, history)
+    return sorted(range(len(jobs)), key=lambda idx: predicted[idx], reverse=True)
+
+
+def order_inputs(inputs, cmd=None, history=None):
+    """
+    Reorder the inputs of a (Ruffus) task such that the jobs expected to
+    run longest are started first, e.g. @transform(order_inputs(files), ...)
+
+    :param inputs: list of input files (or lists of input files)
+    :param cmd: command template, needed to use the history
+    :param history:
+     :type: RuntimeHistory
+    :return: inputs in new order
+     :rtype: list
+    """
+    jobs = [[i] if isinstance(i, str) else list(i) for i in inputs]
+    return [inputs[idx] for idx in longest_first(jobs, cmd, history)]
@@ -13,11 +13,20 @@ import functools as fnt
 import copy as copy
 import random as rand
 import importlib as imp
+import multiprocessing as mp
 from string import ascii_uppercase as ASCII
-from threading import Lock
 
 import piedpiper.syscalls as sc
-from piedpiper.syscalls import exec_env
+from piedpiper.syscalls import exec_env, FairLock
+from piedpiper.governor import SubmissionGovernor
+from piedpiper.journal import JobJournal
+from piedpiper.logarchive import LogArchive
+from piedpiper.envsnapshot import resolve_environment
+from piedpiper.pilot import PilotPool, pilot_systemcall
+from piedpiper.monitor import StragglerMonitor, HeartbeatMonitor
+from piedpiper.runhistory import RuntimeHistory
+from piedpiper.ledger import OutputLedger
+from piedpiper.visibility import VISIBILITY_TIMEOUT
 import piedpiper.jobfunctions as jf
 
 # For reference
@@ -42,11 +51,12 @@ class SysCallInterface(object):
      shutdown of the DRMAA session
     """
     def __init__(self, import_ruffus_drmaa=False,
-                 import_drmaa=False, norm_env=True):
+                 import_drmaa=False, norm_env=True, journal=None):
         """
         :param import_ruffus_drmaa: Import Ruffus' DRMAA wrapper
         :param import_drmaa: Import the Python DRMAA bindings
         :param norm_env: Should the names of the environment variables all be made UPPERCASE?
+        :param journal: Path to a job journal file to resume DRMAA jobs after a crash
         :return:
         """
         self.ruffus_drmaa = None
@@ -60,15 +70,24 @@ class SysCallInterface(object):
             self.drmaa_ver = self.drmaa_mod.__version__
         self.norm_env = norm_env
         self._str_args = ('workdir', 'inpath', 'outpath', 'errpath',
-                          'jobname', 'native_spec', 'scriptdir')
+                          'jobname', 'native_spec', 'scriptdir', 'logarchive', 'envcache',
+                          'runhistory', 'ledger')
         self._complex_args = ('env',)
-        self._bool_args = ('keepscripts', 'joinfiles')
+        self._bool_args = ('keepscripts', 'joinfiles', 'activate_native', 'rusage', 'redirect',
+                           'ledger_checksum')
         self.supported_args = self._str_args + self._complex_args + self._bool_args
         self.config = None
         # these members are cleaned up upon exit
-        self.lock = Lock()
+        self.lock = FairLock()
+        self.governor = SubmissionGovernor()
+        self.journal = None if not journal else JobJournal(journal)
         self.session = None
         self.jobtemplates = []
+        self.logarchives = dict()
+        self.pilots = dict()
+        self.runhistories = dict()
+        self.ledgers = dict()
+        self.pypools = dict()
 
     def __enter__(self):
         """
@@ -76,7 +95,19 @@ class SysCallInterface(object):
         """
         if self.drmaa_mod is not None:
             self.session = self.drmaa_mod.Session()
-            self.session.initialize()
+            contact = None if self.journal is None else self.journal.contact
+            try:
+                self.session.initialize(contact)
+            except Exception as e:
+                if contact is None:
+                    raise
+                sys.stderr.write('\nReopening DRMAA session {} failed: {}\n'.format(contact, e))
+                self.session.initialize()
+            if self.journal is not None:
+                try:
+                    self.journal.record_session(self.session.contact)
+                except Exception as e:
+                    sys.stderr.write('\nCannot record DRMAA session contact: {}\n'.format(e))
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -89,6 +120,14 @@ class SysCallInterface(object):
         :param exc_tb:
         :return:
         """
+        for pool in self.pypools.values():
+            pool.close()
+            pool.join()
+        for pool in self.pilots.values():
+            try:
+                pool.close()
+            except Exception as e:
+                sys.stderr.write('\nShutting down pilot workers failed: {}\n'.format(e))
         if self.session is not None:
             for jt in self.jobtemplates:
                 try:
@@ -101,6 +140,28 @@ class SysCallInterface(object):
             except Exception as e:
                 sys.stderr.write('\nClosing DRMAA session failed: {}\n'.format(e))
 
+    def derive(self):
+        """
+        Create a new interface object that shares the DRMAA session,
+        the submission lock and the list of JobTemplates with this one,
+        but has its own configuration (the submission governor
+        is shared as well). This way, several pipelines can
+        be executed concurrently in the same process using a single
+        DRMAA session. Submissions of each derived object are queued
+        separately, and the queues are served round-robin.
+        Derived objects must not be used as context manager,
+        cleaning up is done by the original object
+
+        :return:
+         :rtype: SysCallInterface
+        """
+        derived = copy.copy(self)
+        derived.config = None
+        owner = object()
+        derived.lock = self.lock.for_owner(owner)
+        derived.governor = self.governor.for_owner(owner)
+        return derived
+
     def _sanity_check(self):
         """
         The sanity check function performs some
@@ -146,6 +207,122 @@ class SysCallInterface(object):
         jobtemplate.joinFiles = bool(int(self.config.get('joinfiles', False)))
         return jobtemplate
 
+    def _get_logarchive(self):
+        """
+        If configured, all DRMAA job callables move the stdout/stderr
+        files of finished jobs into a compressed archive (one per path)
+
+        :return:
+         :rtype: LogArchive or NoneType
+        """
+        path = self.config.get('logarchive', '')
+        if not path:
+            return None
+        if path not in self.logarchives:
+            self.logarchives[path] = LogArchive(path)
+        return self.logarchives[path]
+
+    def get_runhistory(self):
+        """
+        Runtime history (path set by runhistory) to order the jobs of
+        a task longest-first, see bulk job functions and runhistory.order_inputs
+
+        :return:
+         :rtype: RuntimeHistory or NoneType
+        """
+        path = self.config.get('runhistory', '')
+        if not path:
+            return None
+        if path not in self.runhistories:
+            self.runhistories[path] = RuntimeHistory(path)
+        return self.runhistories[path]
+
+    def get_ledger(self):
+        """
+        Output ledger (path set by ledger, optionally with ledger_checksum)
+        to be passed to the job functions (keyword: ledger). When the ledger
+        is opened, all outputs of jobs that were interrupted in a previous
+        run are removed, i.e. Ruffus considers these jobs out of date
+
+        :return:
+         :rtype: OutputLedger or NoneType
+        """
+        path = self.config.get('ledger', '')
+        if not path:
+            return None
+        if path not in self.ledgers:
+            ledger = OutputLedger(path, bool(int(self.config.get('ledger_checksum', False))))
+            removed = ledger.recover()
+            if removed:
+                sys.stderr.write('\nRemoved {} uncommitted output file(s) of interrupted'
+                                 ' jobs: {}\n'.format(len(removed), removed[:10]))
+            self.ledgers[path] = ledger
+        return self.ledgers[path]
+
+    def _get_excerpt(self):
+        """
+        Number of bytes read from the start (log_head) and the end (log_tail)
+        of job output files - set to -1 to always read the full file
+
+        :return: keyword arguments for reading job output files
+         :rtype: dict
+        """
+        excerpt = dict()
+        for key, arg in [('log_head', 'head'), ('log_tail', 'tail')]:
+            if key in self.config:
+                val = int(self.config[key])
+                excerpt[arg] = None if val < 0 else val
+        return excerpt
+
+    def _visibility_timeout(self):
+        """
+        Output files of grid jobs may not be visible immediately on shared
+        filesystems; the job functions wait up to visibility_timeout seconds
+
+        :return:
+         :rtype: float
+        """
+        return float(self.config.get('visibility_timeout', VISIBILITY_TIMEOUT))
+
+    def _get_monitor(self):
+        """
+        Speculative execution of straggling array tasks is enabled by
+        setting straggler_percentile; optional: straggler_factor,
+        straggler_min_runtime (seconds) and straggler_poll (seconds).
+        Copies are only started if the caller isolates the outputs of
+        the copies (argument speculate), e.g. the bulk job functions
+
+        :return:
+         :rtype: StragglerMonitor or NoneType
+        """
+        if 'straggler_percentile' not in self.config:
+            return None
+        kwargs = {'percentile': float(self.config['straggler_percentile'])}
+        for key, arg in [('straggler_factor', 'factor'), ('straggler_min_runtime', 'min_runtime'),
+                         ('straggler_poll', 'poll')]:
+            if key in self.config:
+                kwargs[arg] = float(self.config[key])
+        return StragglerMonitor(**kwargs)
+
+    def _get_heartbeat(self):
+        """
+        Terminate DRMAA jobs that do not write to stdout/stderr for
+        heartbeat_timeout seconds; optional: heartbeat_retries (number of
+        resubmissions, default 0) and heartbeat_poll (seconds).
+        Requires outpath/errpath to be folders (not /dev/null)
+
+        :return:
+         :rtype: HeartbeatMonitor or NoneType
+        """
+        if 'heartbeat_timeout' not in self.config:
+            return None
+        kwargs = {'timeout': float(self.config['heartbeat_timeout'])}
+        if 'heartbeat_retries' in self.config:
+            kwargs['retries'] = int(self.config['heartbeat_retries'])
+        if 'heartbeat_poll' in self.config:
+            kwargs['poll'] = float(self.config['heartbeat_poll'])
+        return HeartbeatMonitor(**kwargs)
+
     def summarize_status(self):
         """
         Return a summary string of the current status, i.e.
@@ -167,20 +344,138 @@ class SysCallInterface(object):
         if env is not None:
             self.config['env'] = copy.deepcopy(env)
         self._sanity_check()
+        self._resolve_activation()
         return
 
+    def _native_activation(self):
+        """
+        :return: True if the environment is activated natively, i.e. by
+         setting the job environment instead of wrapping each command
+         :rtype: bool
+        """
+        return bool(int(self.config.get('activate_native', False)))
+
+    def _resolve_activation(self):
+        """
+        If native activation is configured, the environment to activate
+        is resolved once (cached) and the resulting set of variables
+        replaces the job environment
+        """
+        env = self.config.get('activate', None)
+        if env and self._native_activation():
+            self.config['env'] = resolve_environment(env, self.config.get('env', None),
+                                                     self.config.get('envcache', None))
+        return
+
+    def _shell_activation(self):
+        """
+        :return: name of the environment to activate in the shell for
+         each command, None if not configured or activated natively
+        """
+        if self._native_activation():
+            return None
+        return self.config.get('activate', None)
+
     def local_job(self):
         """
         Basic system call using Python's subprocess class
         Callable object returns stdout and stderr
         This is semantically equivalent to the ruffus_localjob
         below - just w/o depending on Ruffus obviously
+        Optional: report resource usage of each job (rusage) and
+        limit memory (max_mem, e.g. 4G) and CPU time (max_cputime, seconds)
+        With redirect, stdout/stderr are written to files in outpath/errpath
+        (as for grid jobs) and only head and tail are read afterwards
         """
         kwargs = dict()
         kwargs['workdir'] = self.config.get('workdir', None)
         kwargs['env'] = self.config.get('env', None)
-        kwargs['activate'] = self.config.get('activate', None)
+        kwargs['activate'] = self._shell_activation()
+        kwargs['rusage'] = bool(int(self.config.get('rusage', False)))
+        if 'max_mem' in self.config:
+            kwargs['max_mem'] = sc.parse_memory(self.config['max_mem'])
+        if 'max_cputime' in self.config:
+            kwargs['max_cputime'] = int(self.config['max_cputime'])
+        if bool(int(self.config.get('redirect', False))):
+            assert os.path.isdir(self.config.get('outpath', '')), 'Redirecting output of local jobs' \
+                                                                 ' requires outpath to be a folder'
+            kwargs['outpath'] = self.config['outpath']
+            kwargs['errpath'] = self.config.get('errpath', None)
+            kwargs['jobname'] = self.config.get('jobname', 'SCIjob')
+            kwargs['excerpt'] = self._get_excerpt()
         call_me = fnt.partial(sc.custom_systemcall, **kwargs)
+        call_me.visibility_timeout = 0
+        return call_me
+
+    def _get_pilots(self):
+        """
+        Start the pilot pool with the first request: the number of
+        workers is set by 'pilots' (default 1). With an active DRMAA
+        session, the workers are submitted as a single array job using
+        the current configuration (native_spec should request the
+        resources of the commands and a sufficient runtime limit),
+        otherwise they are started as local processes. The key to connect
+        to the pool is written to scriptdir (or workdir). Commands fail if
+        no worker connects within 'pilot_timeout' seconds (default 600)
+
+        :return:
+         :rtype: PilotPool
+        """
+        if 'default' not in self.pilots:
+            num_workers = int(self.config.get('pilots', 1))
+            assert num_workers > 0, 'Number of pilot workers must be positive: {}'.format(num_workers)
+            timeout = float(self.config.get('pilot_timeout', 600))
+            if self.session is not None:
+                pool = PilotPool(timeout=timeout)
+                jt = self.session.createJobTemplate()
+                jt = self._configure_jobtemplate(jt)
+                self.jobtemplates.append(jt)
+                keydir = self.config.get('scriptdir', self.config.get('workdir', None))
+                with self.lock:
+                    pool.start_grid(num_workers, self.session, jt, keydir)
+            else:
+                pool = PilotPool(host='127.0.0.1', timeout=timeout)
+                pool.start_local(num_workers)
+            self.pilots['default'] = pool
+        return self.pilots['default']
+
+    def pilot_job(self):
+        """
+        Commands are dispatched to long-running pilot workers instead of
+        being submitted as individual grid jobs, i.e. short commands do not
+        pay the scheduling latency. Callable object returns stdout and stderr
+        (same as local_job). The workers are shut down upon exit
+        """
+        kwargs = dict()
+        kwargs['pool'] = self._get_pilots()
+        kwargs['workdir'] = self.config.get('workdir', None)
+        kwargs['env'] = self.config.get('env', None)
+        kwargs['activate'] = self._shell_activation()
+        call_me = fnt.partial(pilot_systemcall, **kwargs)
+        call_me.visibility_timeout = self._visibility_timeout()
+        call_me.remote = True
+        return call_me
+
+    def python_job(self):
+        """
+        Python callables are executed in a persistent pool of worker
+        processes (py_workers, default: number of CPUs); the modules
+        listed in py_preload (comma-separated) are imported once per worker.
+        Callable object expects the Python callable followed by its arguments
+        and returns its return value (see job functions py_in_out and py_ins_out).
+        The workers are not forked from this (multi-threaded) process but
+        started by a fork server (or spawned), i.e. the callables must be
+        importable, and the main script must not start a pipeline on import
+        """
+        workers = int(self.config.get('py_workers', 0)) or None
+        preload = [m.strip() for m in self.config.get('py_preload', '').split(',') if m.strip()]
+        key = workers, tuple(preload)
+        if key not in self.pypools:
+            method = 'forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn'
+            self.pypools[key] = mp.get_context(method).Pool(processes=workers, initializer=sc.preload_modules,
+                                                            initargs=(preload, ))
+        call_me = fnt.partial(sc.python_call, pool=self.pypools[key])
+        call_me.visibility_timeout = 0
         return call_me
 
     def _wraps_ruffus(self, cmd, **kwargs):
@@ -194,6 +489,31 @@ class SysCallInterface(object):
         cmdtmp = 'source activate {} && '.format(env) + cmd + ' ; source deactivate'
         return self.ruffus_drmaa.run_job(cmdtmp, **kwtmp)
 
+    def configure_governor(self, **limits):
+        """
+        Set limits for job submissions to the grid engine, see
+        SubmissionGovernor for the available keywords
+        (max_rate, max_active, retries, backoff, max_backoff)
+
+        :return: None
+        """
+        limits = dict((k, v) for k, v in limits.items() if v is not None)
+        self.governor.configure(**limits)
+        return
+
+    def _governed_ruffus(self, cmd, **kwargs):
+        """
+        Respect rate limit and number of active jobs for
+        Ruffus' run_job. No retries here since Ruffus does
+        not distinguish between failed submissions and failed jobs
+        """
+        self.governor.acquire()
+        try:
+            self.governor.throttle()
+            return self.ruffus_drmaa.run_job(cmd, **kwargs)
+        finally:
+            self.governor.release()
+
     def ruffus_gridjob(self):
         """
         This job type is suitable for arbitrary command lines
@@ -213,12 +533,16 @@ class SysCallInterface(object):
         # it is currently not possible to use Conda environments in parallel
         # The solution is scheduled for Conda 4.3
         # Hard workaround for the time being...
+        # Note that native activation (activate_native) is not affected,
+        # the resolved environment is part of the job environment
         use_env = None
         if use_env is None:
-            call_me = fnt.partial(self.ruffus_drmaa.run_job, **kwargs)
+            call_me = fnt.partial(self._governed_ruffus, **kwargs)
         else:
             kwargs['activate'] = use_env
             call_me = fnt.partial(self._wraps_ruffus, **kwargs)
+        call_me.visibility_timeout = self._visibility_timeout()
+        call_me.remote = True
         return call_me
 
     def ruffus_localjob(self):
@@ -237,12 +561,15 @@ class SysCallInterface(object):
         # it is currently not possible to use Conda environments in parallel
         # The solution is scheduled for Conda 4.3
         # Hard workaround for the time being...
+        # Note that native activation (activate_native) is not affected,
+        # the resolved environment is part of the job environment
         use_env = None
         if use_env is None:
             call_me = fnt.partial(self.ruffus_drmaa.run_job, **kwargs)
         else:
             kwargs['activate'] = use_env
             call_me = fnt.partial(self._wraps_ruffus, *(self.ruffus_drmaa.run_job, ), **kwargs)
+        call_me.visibility_timeout = 0
         return call_me
 
     def drmaa_singlejob(self):
@@ -251,6 +578,8 @@ class SysCallInterface(object):
         interfaces with the Grid Engine and can thus only be used
         for proper commands (shell scripts or binaries if the native
         specification is set appropriately)
+        The job functions pass the expected output files of each job
+        (keyword: outputs, see takes_outputs), which are recorded in the journal
         """
         jt = self.session.createJobTemplate()
         jt = self._configure_jobtemplate(jt)
@@ -260,9 +589,17 @@ class SysCallInterface(object):
         kwargs['session'] = self.session
         kwargs['waitforever'] = self.drmaa_mod.Session.TIMEOUT_WAIT_FOREVER
         kwargs['lock'] = self.lock
-        kwargs['activate'] = self.config.get('activate', None)
+        kwargs['governor'] = self.governor
+        kwargs['archive'] = self._get_logarchive()
+        kwargs['excerpt'] = self._get_excerpt()
+        kwargs['journal'] = self.journal
+        kwargs['heartbeat'] = self._get_heartbeat()
+        kwargs['activate'] = self._shell_activation()
         call_me = fnt.partial(sc.drmaa_singlejob, **kwargs)
-        raise call_me
+        call_me.takes_outputs = True
+        call_me.visibility_timeout = self._visibility_timeout()
+        call_me.remote = True
+        return call_me
 
     def drmaa_singlejob_argv(self):
         """
@@ -278,49 +615,125 @@ class SysCallInterface(object):
         kwargs['session'] = self.session
         kwargs['waitforever'] = self.drmaa_mod.Session.TIMEOUT_WAIT_FOREVER
         kwargs['lock'] = self.lock
-        kwargs['activate'] = self.config.get('activate', None)
+        kwargs['governor'] = self.governor
+        kwargs['archive'] = self._get_logarchive()
+        kwargs['excerpt'] = self._get_excerpt()
+        kwargs['journal'] = self.journal
+        kwargs['heartbeat'] = self._get_heartbeat()
+        kwargs['activate'] = self._shell_activation()
         call_me = fnt.partial(sc.drmaa_singlejob_argv, **kwargs)
-        raise call_me
+        call_me.takes_outputs = True
+        call_me.visibility_timeout = self._visibility_timeout()
+        call_me.remote = True
+        return call_me
+
+    @staticmethod
+    def _task_range(start, end, step):
+        """
+        :param start: first task ID (1-based)
+        :param end: last task ID (inclusive)
+        :param step:
+        :return: keyword arguments for array job calls, empty if start is None
+         :rtype: dict
+        """
+        if start is None:
+            return dict()
+        end = start if end is None else end
+        assert 0 < start <= end and step > 0, 'Number of tasks in ArrayJob not well-defined:' \
+                                              ' {}-{}-{}'.format(start, end, step)
+        return {'start': start, 'end': end, 'step': step}
 
-    def drmaa_arrayjob(self, start, end, step=1):
+    def drmaa_arrayjob(self, start=None, end=None, step=1):
         """
         This job type can be used w/o Ruffus, i.e. it directly
         interfaces with the Grid Engine and can thus only be used
         for proper commands (very likely only shell scripts or specialized
         tools aware of the SGE_TASK_ID variable)
+        If no task range is specified, it has to be passed (start, end, step)
+        when calling the job
         """
-        assert 0 < start < start + step < end, 'Number of tasks in ArrayJob not well-defined:' \
-                                               ' {}-{}-{}'.format(start, end, step)
+        kwargs = self._task_range(start, end, step)
         jt = self.session.createJobTemplate()
         jt = self._configure_jobtemplate(jt)
         self.jobtemplates.append(jt)
-        kwargs = dict()
         kwargs['jobtemplate'] = jt
         kwargs['session'] = self.session
         kwargs['waitforever'] = self.drmaa_mod.Session.TIMEOUT_WAIT_FOREVER
         kwargs['lock'] = self.lock
-        kwargs['activate'] = self.config.get('activate', None)
+        kwargs['governor'] = self.governor
+        kwargs['archive'] = self._get_logarchive()
+        kwargs['excerpt'] = self._get_excerpt()
+        kwargs['monitor'] = self._get_monitor()
+        kwargs['heartbeat'] = self._get_heartbeat()
+        kwargs['journal'] = self.journal
+        kwargs['activate'] = self._shell_activation()
         call_me = fnt.partial(sc.drmaa_arrayjob, **kwargs)
-        raise call_me
+        call_me.takes_outputs = True
+        call_me.speculative = kwargs['monitor'] is not None
+        call_me.visibility_timeout = self._visibility_timeout()
+        call_me.remote = True
+        return call_me
 
-    def drmaa_arrayjob_argv(self, start, end, step=1):
+    def drmaa_arrayjob_argv(self, start=None, end=None, step=1):
         """
         Same as drmaa_arrayjob, but command line arguments can
         be passed to the job (list of strings). These are then
         accessible via $1, $2 and so on
+        If no task range is specified, it has to be passed (start, end, step)
+        when calling the job, e.g. by the bulk job functions
         """
-        assert 0 < start < start + step < end, 'Number of tasks in ArrayJob not well-defined:' \
-                                               ' {}-{}-{}'.format(start, end, step)
+        kwargs = self._task_range(start, end, step)
         jt = self.session.createJobTemplate()
         jt = self._configure_jobtemplate(jt)
         self.jobtemplates.append(jt)
-        kwargs = dict()
         kwargs['jobtemplate'] = jt
         kwargs['session'] = self.session
         kwargs['waitforever'] = self.drmaa_mod.Session.TIMEOUT_WAIT_FOREVER
         kwargs['lock'] = self.lock
-        kwargs['activate'] = self.config.get('activate', None)
+        kwargs['governor'] = self.governor
+        kwargs['archive'] = self._get_logarchive()
+        kwargs['excerpt'] = self._get_excerpt()
+        kwargs['monitor'] = self._get_monitor()
+        kwargs['heartbeat'] = self._get_heartbeat()
+        kwargs['journal'] = self.journal
+        kwargs['activate'] = self._shell_activation()
         call_me = fnt.partial(sc.drmaa_arrayjob_argv, **kwargs)
+        call_me.takes_outputs = True
+        call_me.speculative = kwargs['monitor'] is not None
+        call_me.visibility_timeout = self._visibility_timeout()
+        call_me.remote = True
+        return call_me
+
+    def drmaa_arrayjob_table(self):
+        """
+        Array job with individual command line arguments per task:
+        the callable expects the command and a list of argument lists
+        (one per task) and returns a list of per-task results (TaskResult).
+        The argument table is written to scriptdir (or workdir), which
+        must be accessible from the compute nodes
+        """
+        jt = self.session.createJobTemplate()
+        jt = self._configure_jobtemplate(jt)
+        self.jobtemplates.append(jt)
+        kwargs = dict()
+        kwargs['jobtemplate'] = jt
+        kwargs['session'] = self.session
+        kwargs['waitforever'] = self.drmaa_mod.Session.TIMEOUT_WAIT_FOREVER
+        kwargs['lock'] = self.lock
+        kwargs['tabledir'] = self.config.get('scriptdir', self.config.get('workdir', None))
+        kwargs['governor'] = self.governor
+        kwargs['archive'] = self._get_logarchive()
+        kwargs['excerpt'] = self._get_excerpt()
+        kwargs['activate'] = self._shell_activation()
+        kwargs['keeptable'] = bool(int(self.config.get('keepscripts', False)))
+        kwargs['monitor'] = self._get_monitor()
+        kwargs['heartbeat'] = self._get_heartbeat()
+        kwargs['journal'] = self.journal
+        call_me = fnt.partial(sc.drmaa_arrayjob_table, **kwargs)
+        call_me.takes_outputs = True
+        call_me.speculative = kwargs['monitor'] is not None
+        call_me.visibility_timeout = self._visibility_timeout()
+        call_me.remote = True
         return call_me
 
     @staticmethod
@@ -338,3 +751,21 @@ class SysCallInterface(object):
             # not sure what would be best here...
             sys.stderr.write('\nRequested non-existing job function: {}\n'.format(jfname))
         return jf.JOBFUN_REGISTRY[jfname]
+
+    @staticmethod
+    def get_command(cmd, jfname=None, quote=False):
+        """
+        Parse a command line once for use with the generic job functions.
+        If the name of the job function is given, the placeholders are
+        validated immediately, i.e., before any job is submitted
+
+        :param cmd:
+         :type: str
+        :param jfname: name of the job function
+         :type: str
+        :param quote: quote all substituted paths for the shell
+         :type: bool
+        :return:
+         :rtype: CommandTemplate
+        """
+        return jf.compile_command(cmd, jfname, quote)
@@ -6,33 +6,196 @@ Module for convenience wrappers to schedule DRMAA jobs or local system calls
 
 import os as os
 import io as io
+import re as re
+import mmap as mmap
+import time as time
+import shlex as shlex
+import shutil as shutil
+import tempfile as tempfile
 import subprocess as sp
 import traceback as trb
+import itertools as itt
+import collections as col
 import fnmatch as fnm
 import functools as fnt
+import threading as thd
+import importlib as imp
+
+from piedpiper.governor import SubmissionGovernor
+from piedpiper.journal import journal_key
 
 # As note to self from DRMAA Python docs
 # JobInfo = namedtuple("JobInfo",
 #                     """jobId hasExited hasSignal terminatedSignal hasCoreDump
 #                        wasAborted exitStatus resourceUsage""")
 
+# Result of a single task of an array job
+TaskResult = col.namedtuple('TaskResult', 'task jobid exitstatus aborted out err')
+
 
-def _read_output_file(filepath, endpattern, attempts=3):
+class FairLock(object):
     """
+    Lock for job submission shared by several pipelines: waiting
+    acquire calls are queued per owner (pipeline) and the queues are
+    served round-robin, FIFO within each queue. This way, a pipeline
+    with many concurrent jobs cannot take most of the submission slots
+    from others. Each pipeline should use its own view (see for_owner)
+    """
+    def __init__(self):
+        self._cond = thd.Condition(thd.Lock())
+        # owner -> waiting tokens, the owner served last is moved to the end
+        self._queues = col.OrderedDict()
+        self._locked = False
+
+    def acquire(self, owner=None):
+        """
+        :param owner: any hashable identifying the pipeline
+        :return: True
+        """
+        token = object()
+        with self._cond:
+            self._queues.setdefault(owner, col.deque()).append(token)
+            while self._locked or next(iter(self._queues.values()))[0] is not token:
+                self._cond.wait()
+            queue = self._queues.pop(owner)
+            _ = queue.popleft()
+            if queue:
+                self._queues[owner] = queue
+            self._locked = True
+        return True
+
+    def release(self):
+        """
+        :return: None
+        """
+        with self._cond:
+            self._locked = False
+            self._cond.notify_all()
+        return
+
+    def for_owner(self, owner):
+        """
+        :param owner:
+        :return: lock object acquiring for the given owner
+         :rtype: OwnedLock
+        """
+        return OwnedLock(self, owner)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class OwnedLock(object):
+    """
+    View on a FairLock that acquires on behalf of a single owner
+    """
+    def __init__(self, lock, owner):
+        self.lock = lock
+        self.owner = owner
+
+    def acquire(self):
+        return self.lock.acquire(self.owner)
+
+    def release(self):
+        self.lock.release()
+
+    def for_owner(self, owner):
+        return self.lock.for_owner(owner)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+# by default, only the first and last 64 kB of job output files
+# are read, plus all lines in between containing these keywords
+OUTPUT_HEAD = 64 * 1024
+OUTPUT_TAIL = 64 * 1024
+OUTPUT_KEYWORDS = ('error', 'fail', 'segfault', 'abort')
+OUTPUT_MAX_LINES = 1000
+
+
+def _read_excerpt(filepath, head, tail, keywords):
+    """
+    Read head and tail of a file (w/o reading the part in between) and
+    all lines in between that contain any of the keywords (searched
+    in a memory-mapped view of the file, i.e. w/o loading it)
+
+    :param filepath:
+    :param head: number of bytes from the start of the file, None = read all
+    :param tail: number of bytes from the end of the file, None = read all
+    :param keywords: case-insensitive keywords
+    :return:
+     :rtype: str
+    """
+    with open(filepath, 'rb') as infile:
+        size = os.fstat(infile.fileno()).st_size
+        if head is None or tail is None or size <= head + tail:
+            return infile.read().decode('utf-8', errors='replace').strip()
+        first = infile.read(head)
+        _ = infile.seek(size - tail)
+        last = infile.read(tail)
+        matched = []
+        if keywords:
+            kwpat = re.compile(b'^.*(' + b'|'.join([re.escape(k.encode('utf-8')) for k in keywords]) + b').*$',
+                               re.MULTILINE | re.IGNORECASE)
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for mobj in kwpat.finditer(mm, head, size - tail):
+                    matched.append(mobj.group(0))
+                    if len(matched) >= OUTPUT_MAX_LINES:
+                        break
+    parts = [first,
+             '\n[ ... skipped {} bytes - {} lines matching keywords ... ]\n'.format(size - head - tail,
+                                                                                    len(matched)).encode('utf-8')]
+    if matched:
+        parts.append(b'\n'.join(matched))
+        parts.append(b'\n[ ... ]\n')
+    parts.append(last)
+    return b''.join(parts).decode('utf-8', errors='replace').strip()
+
+
+def _read_output_file(filepath, endpattern, attempts=4, head=OUTPUT_HEAD,
+                      tail=OUTPUT_TAIL, keywords=OUTPUT_KEYWORDS, delay=0.5, expected=False):
+    """
+    On shared filesystems, output files of jobs that just finished
+    may not be visible (or readable) yet; reading is attempted again
+    after a delay that is doubled for each attempt
+
     :param filepath:
     :param endpattern:
+    :param attempts:
+    :param head: see _read_excerpt
+    :param tail: see _read_excerpt
+    :param keywords: see _read_excerpt
+    :param delay: seconds before the second attempt
+    :param expected: a matching file must exist, i.e. list the folder
+     again if there is none (stderr files are missing if joinFiles is set)
     :return:
     """
-    allfiles = os.listdir(filepath)
-    outfiles = fnm.filter(allfiles, endpattern)
+    if not os.path.isdir(filepath):
+        return ''  # e.g. /dev/null
+    outfiles = fnm.filter(os.listdir(filepath), endpattern)
+    a = 1
+    while expected and not outfiles and a < attempts:
+        time.sleep(delay * 2 ** (a - 1))
+        outfiles = fnm.filter(os.listdir(filepath), endpattern)
+        a += 1
     content = ''
     for of in outfiles:
-        a = attempts
-        while a > 0:
+        a = 1
+        while True:
             try:
-                tmp = open(os.path.join(filepath, of), 'r').read().strip()
+                tmp = _read_excerpt(os.path.join(filepath, of), head, tail, keywords)
             except IOError:
-                a -= 1
+                if a >= attempts:
+                    break
+                time.sleep(delay * 2 ** (a - 1))
+                a += 1
                 continue
             else:
                 tmp += '\n'
@@ -54,82 +217,334 @@ def exec_env(syscall):
         :return:
         """
         kwtmp = dict(kwargs)
-        assert len(args) == 1, 'Expecting command line as single positional argument'
+        assert len(args) >= 1, 'Expecting command line as first positional argument'
         cmdtmp = args[0]
         if 'activate' in kwtmp:
             env = kwtmp['activate']
             if env is not None:
                 cmdtmp = 'source activate {} && '.format(env) + cmdtmp + ' ; source deactivate'
             del kwtmp['activate']
-        return syscall(cmdtmp, **kwtmp)
+        return syscall(cmdtmp, *args[1:], **kwtmp)
     return wrap_env
 
 
 @exec_env
-def drmaa_singlejob(cmd, jobtemplate, session, waitforever, lock):
+def drmaa_singlejob(cmd, jobtemplate, session, waitforever, lock, governor=None, journal=None, outputs=None,
+                    archive=None, excerpt=None, heartbeat=None):
     """
     :param cmd:
     :param jobtemplate:
     :param session:
     :param waitforever:
+    :param governor: throttles submissions, no limits if None
+    :param journal: record submission to resume after a crash
+     :type: JobJournal
+    :param outputs: expected output files of the job (recorded in journal)
+    :param archive: move job stdout/stderr files into this archive
+     :type: LogArchive
+    :param excerpt: keyword arguments for reading job output files (head, tail, keywords)
+     :type: dict
+    :param heartbeat: terminate (and resubmit) jobs that stop writing output
+     :type: HeartbeatMonitor
     :return:
     """
     out, err = '', ''
+    governor = SubmissionGovernor() if governor is None else governor
+    governor.acquire()
     try:
-        with lock:
+        key, result = journal_key(cmd), None
+        if journal is not None:
+            result = _resume_from_journal(journal, key, session, waitforever, jobtemplate, archive, excerpt)
+        if result is None:
             outpath = jobtemplate.outputPath
             errpath = jobtemplate.errorPath
-            jobtemplate.remoteCommand = cmd
-            jobid = session.runJob(jobtemplate)
-        out, err = _handle_drmaa_singlejob(jobid, session, waitforever, outpath, errpath)
+            entry = _JournalEntry(journal, key, cmd, jobtemplate, outputs)
+            jobid = governor.submit(_locked_submit(lock, jobtemplate, cmd, None, session.runJob,
+                                                   record=entry.submitted))
+            resubmit = _job_resubmitter(session, jobtemplate, lock, cmd, None, governor, entry.submitted)
+            result = _handle_drmaa_singlejob(jobid, session, waitforever, outpath, errpath, archive, excerpt,
+                                             heartbeat, resubmit, jobtemplate.jobName)
+            entry.collected()
+        out, err = result
     except Exception as e:
         err = 'Error for SingleJob call: {}\nMessage: {}'.format(cmd, e)
     finally:
+        governor.release()
         return out, err
 
 
 @exec_env
-def drmaa_singlejob_argv(cmd, argv, jobtemplate, session, waitforever, lock):
+def drmaa_singlejob_argv(cmd, argv, jobtemplate, session, waitforever, lock, governor=None, journal=None,
+                         outputs=None, archive=None, excerpt=None, heartbeat=None):
     """
     :param cmd:
     :param argv:
     :param jobtemplate:
     :param session:
     :param waitforever:
+    :param governor: throttles submissions, no limits if None
+    :param journal: record submission to resume after a crash
+     :type: JobJournal
+    :param outputs: expected output files of the job (recorded in journal)
+    :param archive: move job stdout/stderr files into this archive
+     :type: LogArchive
+    :param excerpt: keyword arguments for reading job output files (head, tail, keywords)
+     :type: dict
+    :param heartbeat: terminate (and resubmit) jobs that stop writing output
+     :type: HeartbeatMonitor
     :return:
     """
     out, err = '', ''
+    governor = SubmissionGovernor() if governor is None else governor
+    governor.acquire()
     try:
-        with lock:
-            argv = list(map(str, argv))
+        argv = list(map(str, argv))
+        key, result = journal_key(cmd, argv), None
+        if journal is not None:
+            result = _resume_from_journal(journal, key, session, waitforever, jobtemplate, archive, excerpt)
+        if result is None:
             outpath = jobtemplate.outputPath
             errpath = jobtemplate.errorPath
-            jobtemplate.remoteCommand = cmd
-            jobtemplate.args = argv
-            jobid = session.runJob(jobtemplate)
-        out, err = _handle_drmaa_singlejob(jobid, session, waitforever, outpath, errpath)
+            entry = _JournalEntry(journal, key, cmd, jobtemplate, outputs)
+            jobid = governor.submit(_locked_submit(lock, jobtemplate, cmd, argv, session.runJob,
+                                                   record=entry.submitted))
+            resubmit = _job_resubmitter(session, jobtemplate, lock, cmd, argv, governor, entry.submitted)
+            result = _handle_drmaa_singlejob(jobid, session, waitforever, outpath, errpath, archive, excerpt,
+                                             heartbeat, resubmit, jobtemplate.jobName)
+            entry.collected()
+        out, err = result
     except Exception as e:
         err = 'Error for SingleJob argV call: {}\nMessage: {}'.format(cmd, e)
     finally:
+        governor.release()
         return out, err
 
 
-def _handle_drmaa_singlejob(jid, session, waitforever, outpath, errpath):
+def _resume_from_journal(journal, key, session, waitforever, jobtemplate, archive=None, excerpt=None, poll=10):
+    """
+    Check if the job has already been submitted by a previous (crashed)
+    runner process. If so, reattach to the job if it is still known to
+    the grid engine. If the job is no longer known, its exit status is lost;
+    in this case, the results are collected if all expected outputs exist
+
+    :param journal:
+    :param key:
+    :param session:
+    :param waitforever:
+    :param jobtemplate:
+    :param archive:
+    :param excerpt:
+    :param poll: seconds between status checks of a reattached job
+    :return: job output or None if the job has to be submitted (again)
+     :rtype: 2-tuple of str or NoneType
+    """
+    record = journal.pending_job(key)
+    if record is None:
+        return None
+    jid = record['jobid']
+    outpath = record['template'].get('outputPath', jobtemplate.outputPath)
+    errpath = record['template'].get('errorPath', jobtemplate.errorPath)
+    try:
+        stat = session.jobStatus(jid)
+        while stat not in ('done', 'failed'):
+            time.sleep(poll)
+            stat = session.jobStatus(jid)
+    except Exception:
+        outputs = record['outputs']
+        if not outputs or not all([os.path.isfile(f) for f in outputs]):
+            return None
+        out = 'Job {} (from journal) finished before restart, all outputs present'.format(jid)
+        excerpt = dict() if excerpt is None else excerpt
+        out += '\n' + _read_output_file(outpath.strip(':'), '*o' + jid, expected=True, **excerpt)
+        err = _read_output_file(errpath.strip(':'), '*e' + jid, **excerpt)
+        _archive_output_files(archive, outpath, errpath, jid)
+        result = out, err
+    else:
+        result = _handle_drmaa_singlejob(jid, session, waitforever, outpath, errpath, archive, excerpt)
+    journal.record_collect(key, jid)
+    return result
+
+
+class _JournalEntry(object):
+    """
+    Keeps the journal up to date with the current job ID(s) of a submission,
+    including jobs (or tasks of array jobs) that are submitted again by the
+    heartbeat or straggler monitor. Without journal, nothing is recorded
+    """
+    def __init__(self, journal, key, cmd, jobtemplate, outputs=None):
+        self.journal = journal
+        self.key = key
+        self.cmd = cmd
+        self.jobtemplate = jobtemplate
+        self.outputs = outputs
+        self.jobid = None
+
+    def submitted(self, jobid):
+        """
+        Called while holding the submission lock (template unchanged)
+
+        :param jobid: job ID or list of job IDs (array job)
+        :return: None
+        """
+        self.jobid = jobid
+        if self.journal is not None:
+            self.journal.record_submit(self.key, jobid, self.cmd, self.jobtemplate, self.outputs)
+        return
+
+    def task_submitted(self, jobids):
+        """
+        A single task of the array job was submitted again
+
+        :param jobids: job ID of the new task (as list)
+        :return: None
+        """
+        task = _task_id(jobids[0])
+        self.submitted([jobids[0] if _task_id(j) == task else j for j in self.jobid])
+        return
+
+    def collected(self):
+        """
+        :return: None
+        """
+        if self.journal is not None and self.jobid is not None:
+            self.journal.record_collect(self.key, self.jobid)
+        return
+
+
+def _resume_array_from_journal(journal, key, session):
+    """
+    Array job counterpart of _resume_from_journal: if all tasks of a previous
+    submission are still known to the grid engine, they are collected as
+    usual. If not, the exit status of the tasks is lost, and the tasks are
+    only considered finished if all expected outputs exist
+
+    :param journal:
+    :param key:
+    :param session:
+    :return: None if the array job has to be submitted (again), otherwise the
+     job IDs of the previous submission and whether they are still known
+     :rtype: NoneType or (list of str, bool)
+    """
+    if journal is None:
+        return None
+    record = journal.pending_job(key)
+    if record is None:
+        return None
+    jids = list(record['jobid'])
+    try:
+        for jid in jids:
+            _ = session.jobStatus(jid)
+    except Exception:
+        outputs = record['outputs']
+        if not outputs or not all([os.path.isfile(f) for f in outputs]):
+            return None
+        return jids, False
+    return jids, True
+
+
+def _submit_array(cmd, argv, jobtemplate, session, lock, governor, journal, key, outputs, start, end, step):
+    """
+    Submit an array job or resume a previous submission recorded in the journal
+
+    :return: journal entry (with the job IDs of all tasks), the callable to
+     submit single tasks again, and whether the tasks have to be collected
+     (False: finished before a restart of the runner)
+     :rtype: _JournalEntry, callable, bool
+    """
+    entry = _JournalEntry(journal, key, cmd, jobtemplate, outputs)
+    resumed = _resume_array_from_journal(journal, key, session)
+    if resumed is None:
+        _ = governor.submit(_locked_submit(lock, jobtemplate, cmd, argv, session.runBulkJobs,
+                                           start, end, step, record=entry.submitted))
+        known = True
+    else:
+        entry.jobid, known = resumed
+    resubmit = _task_resubmitter(session, jobtemplate, lock, cmd, argv, governor, entry.task_submitted)
+    return entry, resubmit, known
+
+
+def _archive_output_files(archive, outpath, errpath, jid):
+    """
+    :param archive:
+     :type: LogArchive or NoneType
+    :param outpath:
+    :param errpath:
+    :param jid:
+    :return: None
+    """
+    if archive is not None:
+        _ = archive.add_output_files(outpath.strip(':'), '*o' + jid)
+        _ = archive.add_output_files(errpath.strip(':'), '*e' + jid)
+    return
+
+
+def _locked_submit(lock, jobtemplate, cmd, argv, submit_fun, *args, record=None):
+    """
+    The job template is shared by all jobs of a callable, i.e. it must only
+    be changed while holding the lock. Waiting for the rate limit or before
+    retrying a failed submission (see SubmissionGovernor.submit) happens
+    outside of the lock, otherwise all other submissions would be stalled
+
+    :param lock:
+    :param jobtemplate:
+    :param cmd:
+    :param argv: None = leave args of the template unchanged
+    :param submit_fun: session.runJob or session.runBulkJobs
+    :param args: additional arguments for submit_fun
+    :param record: called with the new job ID(s) while still holding the lock
+    :return: callable to be passed to SubmissionGovernor.submit
+    """
+    def submit():
+        with lock:
+            jobtemplate.remoteCommand = cmd
+            if argv is not None:
+                jobtemplate.args = argv
+            jobid = submit_fun(jobtemplate, *args)
+            if record is not None:
+                record(jobid)
+            return jobid
+    return submit
+
+
+def _job_resubmitter(session, jobtemplate, lock, cmd, argv=None, governor=None, record=None):
+    """
+    :param record: called with the new job ID (see _locked_submit)
+    :return: callable to submit a job (again), returns the new job ID
+    """
+    governor = SubmissionGovernor() if governor is None else governor
+
+    def resubmit(jid):
+        return governor.submit(_locked_submit(lock, jobtemplate, cmd, argv, session.runJob, record=record))
+    return resubmit
+
+
+def _handle_drmaa_singlejob(jid, session, waitforever, outpath, errpath, archive=None, excerpt=None,
+                            heartbeat=None, resubmit=None, jobname=None):
     """
     :param jid:
     :param session:
     :param waitforever:
     :param outpath:
     :param errpath:
+    :param archive:
+    :param excerpt:
+    :param heartbeat: if given, the job is watched and terminated if it hangs
+    :param resubmit: callable to submit a terminated job again
+    :param jobname: name of the job (output files: jobname.o<jid>), see heartbeat
     :return:
     """
     out, err = ['Job {} submitted'.format(jid)], []
+    excerpt = dict() if excerpt is None else excerpt
     try:
         try:
             stat = session.jobStatus(jid)
             out.append('Job {} status: {}'.format(jid, stat))
         except Exception as e:
             err.append('Checking job status failed: {}'.format(str(e)))
+        if heartbeat is not None:
+            jids, notes = heartbeat.watch([jid], session, resubmit, outpath, errpath, waitforever, jobname)
+            jid = jids[0]
+            err.extend(notes[0])
         retval = session.wait(jid, waitforever)
         if retval.exitStatus != 0:
             err.append('Exit {} - Error'.format(retval.exitStatus))
@@ -139,8 +554,9 @@ def _handle_drmaa_singlejob(jid, session, waitforever, outpath, errpath):
             out.append('Start: {}'.format(ru['start_time']))
             out.append('End: {}'.format(ru['end_time']))
             out.append('MAXRSS: {}'.format(ru['ru_maxrss']))
-        out.append(_read_output_file(outpath.strip(':'), '*o' + jid))
-        err.append(_read_output_file(errpath.strip(':'), '*e' + jid))
+        out.append(_read_output_file(outpath.strip(':'), '*o' + jid, expected=True, **excerpt))
+        err.append(_read_output_file(errpath.strip(':'), '*e' + jid, **excerpt))
+        _archive_output_files(archive, outpath, errpath, jid)
     except Exception as e:
         buf = io.StringIO()
         trb.print_exc(file=buf)
@@ -154,55 +570,283 @@ def _handle_drmaa_singlejob(jid, session, waitforever, outpath, errpath):
 
 
 @exec_env
-def drmaa_arrayjob(cmd, jobtemplate, session, waitforever, lock, start, end, step):
+def drmaa_arrayjob(cmd, jobtemplate, session, waitforever, lock, start, end, step, governor=None, archive=None,
+                   excerpt=None, monitor=None, heartbeat=None, journal=None, outputs=None, jobkey=None,
+                   speculate=False):
     """
     :param cmd:
     :param jobtemplate:
     :param session:
     :param waitforever:
+    :param governor: throttles submissions, no limits if None
+    :param archive: move job stdout/stderr files into this archive
+    :param excerpt: keyword arguments for reading job output files (head, tail, keywords)
+    :param monitor: start copies of straggling tasks (only used with speculate)
+     :type: StragglerMonitor
+    :param heartbeat: terminate (and resubmit) tasks that stop writing output
+     :type: HeartbeatMonitor
+    :param journal: record submission to resume after a crash
+     :type: JobJournal
+    :param outputs: expected output files of all tasks (recorded in journal)
+    :param jobkey: identifies the job in the journal, default: command line and task range
+    :param speculate: the copies of a task write to separate outputs, i.e.
+     copies of straggling tasks can be started (see monitor)
     :return:
     """
     out, err = '', ''
+    governor = SubmissionGovernor() if governor is None else governor
+    monitor = monitor if speculate else None
+    num_tasks = len(range(start, end + 1, step))
+    governor.acquire(num_tasks)
     try:
-        with lock:
-            outpath = jobtemplate.outputPath
-            errpath = jobtemplate.errorPath
-            jobtemplate.remoteCommand = cmd
-            jobids = session.runBulkJobs(jobtemplate, start, end, step)
-        out, err = _handle_drmaa_arrayjob(jobids, session, waitforever, outpath, errpath)
+        outpath = jobtemplate.outputPath
+        errpath = jobtemplate.errorPath
+        key = journal_key(cmd, [start, end, step]) if jobkey is None else jobkey
+        entry, resubmit, known = _submit_array(cmd, None, jobtemplate, session, lock, governor, journal,
+                                               key, outputs, start, end, step)
+        if known:
+            out, err = _handle_drmaa_arrayjob(entry.jobid, session, waitforever, outpath, errpath, archive,
+                                              excerpt, monitor, resubmit, heartbeat, jobtemplate.jobName)
+        else:
+            out = _resumed_array_note(entry.jobid)
+        entry.collected()
     except Exception as e:
-        err = 'Error for SingleJob argV call: {}\nMessage: {}'.format(cmd, e)
+        err = 'Error for ArrayJob call: {}\nMessage: {}'.format(cmd, e)
     finally:
+        governor.release(num_tasks)
         return out, err
 
 
 @exec_env
-def drmaa_arrayjob_argv(cmd, argv, jobtemplate, session, waitforever, lock, start, end, step):
+def drmaa_arrayjob_argv(cmd, argv, jobtemplate, session, waitforever, lock, start, end, step,
+                        governor=None, archive=None, excerpt=None, monitor=None, heartbeat=None,
+                        journal=None, outputs=None, jobkey=None, speculate=False):
     """
     :param cmd:
     :param argv:
     :param jobtemplate:
     :param session:
     :param waitforever:
+    :param governor: throttles submissions, no limits if None
+    :param archive: move job stdout/stderr files into this archive
+    :param excerpt: keyword arguments for reading job output files (head, tail, keywords)
+    :param monitor: start copies of straggling tasks (only used with speculate)
+     :type: StragglerMonitor
+    :param heartbeat: terminate (and resubmit) tasks that stop writing output
+     :type: HeartbeatMonitor
+    :param journal: record submission to resume after a crash
+     :type: JobJournal
+    :param outputs: expected output files of all tasks (recorded in journal)
+    :param jobkey: identifies the job in the journal, default: command line and task range
+    :param speculate: the copies of a task write to separate outputs, i.e.
+     copies of straggling tasks can be started (see monitor)
     :return:
     """
     out, err = '', ''
+    governor = SubmissionGovernor() if governor is None else governor
+    monitor = monitor if speculate else None
+    num_tasks = len(range(start, end + 1, step))
+    governor.acquire(num_tasks)
     try:
-        with lock:
-            argv = list(map(str, argv))
-            outpath = jobtemplate.outputPath
-            errpath = jobtemplate.errorPath
-            jobtemplate.remoteCommand = cmd
-            jobtemplate.args = argv
-            jobids = session.runBulkJobs(jobtemplate, start, end, step)
-        out, err = _handle_drmaa_arrayjob(jobids, session, waitforever, outpath, errpath)
+        argv = list(map(str, argv))
+        outpath = jobtemplate.outputPath
+        errpath = jobtemplate.errorPath
+        key = journal_key(cmd, argv + [start, end, step]) if jobkey is None else jobkey
+        entry, resubmit, known = _submit_array(cmd, argv, jobtemplate, session, lock, governor, journal,
+                                               key, outputs, start, end, step)
+        if known:
+            out, err = _handle_drmaa_arrayjob(entry.jobid, session, waitforever, outpath, errpath, archive,
+                                              excerpt, monitor, resubmit, heartbeat, jobtemplate.jobName)
+        else:
+            out = _resumed_array_note(entry.jobid)
+        entry.collected()
     except Exception as e:
-        err = 'Error for SingleJob argV call: {}\nMessage: {}'.format(cmd, e)
+        err = 'Error for ArrayJob argV call: {}\nMessage: {}'.format(cmd, e)
     finally:
+        governor.release(num_tasks)
         return out, err
 
 
-def _handle_drmaa_arrayjob(jids, session, waitforever, outpath, errpath):
+_TABLE_DRIVER = """#!/bin/bash
+ARGS=$(sed -n "${{SGE_TASK_ID}}p" "$1") || exit 1
+eval "set -- $ARGS"
+{activate}{cmd} "$@"
+"""
+
+
+def drmaa_arrayjob_table(cmd, argvs, jobtemplate, session, waitforever, lock, tabledir=None, governor=None,
+                         archive=None, excerpt=None, activate=None, keeptable=False, monitor=None,
+                         heartbeat=None, journal=None, outputs=None, speculate=False):
+    """
+    Array job with individual command line arguments for each task: the
+    arguments are written to a table (one line per task) and a driver script
+    calls cmd with the arguments in the line selected by SGE_TASK_ID. Hence,
+    arguments must not contain line breaks
+
+    :param cmd: command (executable) called for each task
+    :param argvs: one list of arguments per task
+    :param jobtemplate:
+    :param session:
+    :param waitforever:
+    :param lock:
+    :param tabledir: folder for argument table and driver script, must be accessible
+     from the compute nodes (default: current working directory)
+    :param governor: throttles submissions, no limits if None
+    :param archive: move job stdout/stderr files into this archive
+    :param excerpt: keyword arguments for reading job output files (head, tail, keywords)
+    :param activate: environment to activate before running cmd
+    :param keeptable: do not delete table and driver script after the jobs finished
+    :param monitor: start copies of straggling tasks (only used with speculate)
+     :type: StragglerMonitor
+    :param heartbeat: terminate (and resubmit) tasks that stop writing output
+     :type: HeartbeatMonitor
+    :param journal: record submission to resume after a crash
+     :type: JobJournal
+    :param outputs: expected output files of all tasks (recorded in journal)
+    :param speculate: see drmaa_arrayjob
+    :return: one result per task, in the order of argvs (task IDs start at 1)
+     :rtype: list of TaskResult
+    :raises: submission errors are not caught
+    """
+    assert len(argvs) > 0, 'Received no task arguments for ArrayJob: {}'.format(cmd)
+    # the table has one line per task, quoting does not protect line breaks
+    multiline = [argv for argv in argvs if any(['\n' in str(a) for a in argv])]
+    assert not multiline, 'Task arguments must not contain line breaks' \
+                          ' ({} tasks): {}'.format(len(multiline), multiline[0])
+    governor = SubmissionGovernor() if governor is None else governor
+    monitor = monitor if speculate else None
+    tabledir = tempfile.mkdtemp(prefix='pp_array_', dir=os.getcwd() if tabledir is None else tabledir)
+    num_tasks = len(argvs)
+    governor.acquire(num_tasks)
+    try:
+        table = os.path.join(tabledir, 'argv.txt')
+        lines = [' '.join([shlex.quote(str(a)) for a in argv]) for argv in argvs]
+        with open(table, 'w') as outfile:
+            _ = outfile.write('\n'.join(lines) + '\n')
+        driver = os.path.join(tabledir, 'driver.sh')
+        activate = '' if activate is None else 'source activate {} || exit 1\n'.format(activate)
+        with open(driver, 'w') as outfile:
+            _ = outfile.write(_TABLE_DRIVER.format(activate=activate, cmd=cmd))
+        os.chmod(driver, 0o755)
+        outpath = jobtemplate.outputPath
+        errpath = jobtemplate.errorPath
+        # the table folder differs between runs, the content does not
+        key = journal_key(cmd, lines)
+        entry, resubmit, known = _submit_array(driver, [table], jobtemplate, session, lock, governor, journal,
+                                               key, outputs, 1, num_tasks, 1)
+        if known:
+            results = _collect_array_tasks(entry.jobid, session, waitforever, outpath, errpath, archive,
+                                           excerpt, monitor, resubmit, heartbeat, jobtemplate.jobName)
+        else:
+            note = _resumed_array_note(entry.jobid)
+            results = [TaskResult(_task_id(j), j, None, None, note, '') for j in entry.jobid]
+        entry.collected()
+    finally:
+        governor.release(num_tasks)
+        if not keeptable:
+            shutil.rmtree(tabledir, ignore_errors=True)
+    unknown = [r.jobid for r in results if r.task is None]
+    assert not unknown, 'Cannot determine task ID of ArrayJob task(s): {} - expecting' \
+                        ' job IDs of the form <jobid>.<taskid>'.format(unknown)
+    return sorted(results, key=lambda r: r.task)
+
+
+def _resumed_array_note(jids):
+    """
+    :param jids:
+    :return: output of an array job that finished while the runner was down
+    """
+    return 'ArrayJob {} (from journal) finished before restart, all outputs present'.format(jids[0])
+
+
+def _task_id(jid):
+    """
+    :param jid: job ID combined with task ID, e.g. 12345.7
+    :return: task ID or None
+    """
+    try:
+        return int(jid.rsplit('.', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _task_resubmitter(session, jobtemplate, lock, cmd, argv=None, governor=None, record=None):
+    """
+    :param record: called with the new job IDs (see _locked_submit)
+    :return: callable to submit a single task of an array job (again)
+    """
+    governor = SubmissionGovernor() if governor is None else governor
+
+    def resubmit(task):
+        return governor.submit(_locked_submit(lock, jobtemplate, cmd, argv, session.runBulkJobs,
+                                              task, task, 1, record=record))
+    return resubmit
+
+
+def _collect_array_tasks(jids, session, waitforever, outpath, errpath, archive=None, excerpt=None,
+                         monitor=None, resubmit=None, heartbeat=None, jobname=None):
+    """
+    Wait for all tasks of an array job and collect the result of each task
+
+    :param jids: job ID combined with task ID
+     :type: list of str
+    :param session:
+    :param waitforever:
+    :param outpath:
+    :param errpath:
+    :param archive:
+    :param excerpt:
+    :param monitor: if given, stragglers are started again (using resubmit)
+     and the result of the copy finishing first is collected
+    :param resubmit:
+    :param heartbeat: if given, hanging tasks are terminated (and started again);
+     not used together with monitor (stragglers include hanging tasks)
+    :param jobname: name of the job, see heartbeat
+    :return: one result per task
+     :rtype: list of TaskResult
+    """
+    excerpt = dict() if excerpt is None else excerpt
+    notes = dict()
+    if monitor is not None:
+        jids = monitor.wait(jids, session, resubmit, waitforever)
+    elif heartbeat is not None:
+        resubmit_task = None if resubmit is None else lambda j: resubmit(_task_id(j))[0]
+        jids, notes = heartbeat.watch(jids, session, resubmit_task, outpath, errpath, waitforever, jobname)
+    # blocking call, wait until all jobs done
+    # Important
+    # Calling synchronize() with dispose=False can lead to a memory leak
+    # if the calling application does not call wait() for each individual
+    # job afterwards
+    session.synchronize(jids, waitforever, dispose=False)
+    results = []
+    for idx, j in enumerate(jids):
+        out, err = [], list(notes.get(idx, []))
+        exitstatus, aborted = None, None
+        try:
+            retval = session.wait(j, waitforever)
+            exitstatus, aborted = retval.exitStatus, retval.wasAborted
+            if retval.exitStatus != 0:
+                err.append('Exit {} - Error'.format(retval.exitStatus))
+            out.append('Job {} finished with status: {} - [Was aborted? {}]'.format(j, retval.hasExited, retval.wasAborted))
+            if 'start_time' in retval.resourceUsage:
+                ru = retval.resourceUsage
+                out.append('Start: {}'.format(ru['start_time']))
+                out.append('End: {}'.format(ru['end_time']))
+                out.append('MAXRSS: {}'.format(ru['ru_maxrss']))
+            # for thousands of jobs, this can take quite some time
+            # maybe, one should enforce /dev/null if the number of
+            # tasks in an array job is too large
+            out.append(_read_output_file(outpath.strip(':'), '*o' + j, expected=True, **excerpt))
+            err.append(_read_output_file(errpath.strip(':'), '*e' + j, **excerpt))
+            _archive_output_files(archive, outpath, errpath, j)
+        except Exception as e:
+            err.append('Warning: checking job status for {} after sync failed: {}'.format(j, e))
+        results.append(TaskResult(_task_id(j), j, exitstatus, aborted, '\n'.join(out), '\n'.join(err)))
+    return results
+
+
+def _handle_drmaa_arrayjob(jids, session, waitforever, outpath, errpath, archive=None, excerpt=None,
+                           monitor=None, resubmit=None, heartbeat=None, jobname=None):
     """
     :param jids: job ID combined with task ID
      :type: list of str
@@ -210,34 +854,20 @@ def _handle_drmaa_arrayjob(jids, session, waitforever, outpath, errpath):
     :param waitforever:
     :param outpath:
     :param errpath:
+    :param archive:
+    :param excerpt:
+    :param monitor:
+    :param resubmit:
+    :param heartbeat:
+    :param jobname:
     :return:
     """
     out, err = ['ArrayJob {} submitted - first task'.format(jids[0])], []
     try:
-        # blocking call, wait until all jobs done
-        # Important
-        # Calling synchronize() with dispose=False can lead to a memory leak
-        # if the calling application does not call wait() for each individual
-        # job afterwards
-        session.synchronize(jids, waitforever, dispose=False)
-        for j in jids:
-            try:
-                retval = session.wait(j, waitforever)
-                if retval.exitStatus != 0:
-                    err.append('Exit {} - Error'.format(retval.exitStatus))
-                out.append('Job {} finished with status: {} - [Was aborted? {}]'.format(j, retval.hasExited, retval.wasAborted))
-                if 'start_time' in retval.resourceUsage:
-                    ru = retval.resourceUsage
-                    out.append('Start: {}'.format(ru['start_time']))
-                    out.append('End: {}'.format(ru['end_time']))
-                    out.append('MAXRSS: {}'.format(ru['ru_maxrss']))
-                # for thousands of jobs, this can take quite some time
-                # maybe, one should enforce /dev/null if the number of
-                # tasks in an array job is too large
-                out.append(_read_output_file(outpath.strip(':'), '*o' + j))
-                err.append(_read_output_file(errpath.strip(':'), '*e' + j))
-            except Exception as e:
-                err.append('Warning: checking job status for {} after sync failed: {}'.format(j, e))
+        for res in _collect_array_tasks(jids, session, waitforever, outpath, errpath, archive, excerpt,
+                                        monitor, resubmit, heartbeat, jobname):
+            out.append(res.out)
+            err.append(res.err)
     except Exception as e:
         buf = io.StringIO()
         trb.print_exc(file=buf)
@@ -250,25 +880,192 @@ def _handle_drmaa_arrayjob(jids, session, waitforever, outpath, errpath):
         return '\n'.join(out), '\n'.join(err)
 
 
+_MEM_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_memory(value):
+    """
+    :param value: number of bytes, optionally with unit K, M, G or T (e.g. 4G)
+    :return: number of bytes
+     :rtype: int
+    """
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in _MEM_UNITS:
+        return int(float(value[:-1]) * _MEM_UNITS[value[-1]])
+    return int(value)
+
+
+def _limit_resources(max_mem, max_cputime):
+    """
+    The limits are set by the shell running the command (ulimit) instead of
+    a preexec_fn, which is not safe to use in a threaded runner process
+
+    :param max_mem: maximal size of virtual memory (bytes)
+    :param max_cputime: maximal CPU time (seconds)
+    :return: shell command prefix setting the limits
+     :rtype: str
+    """
+    limits = []
+    if max_mem is not None:
+        # ulimit expects KiB
+        limits.append('ulimit -v {}'.format(max(1, int(max_mem) // 1024)))
+    if max_cputime is not None:
+        # SIGXCPU at the soft limit, SIGKILL one second later
+        limits.append('ulimit -S -t {}'.format(int(max_cputime)))
+        limits.append('ulimit -H -t {}'.format(int(max_cputime) + 1))
+    return ' && '.join(limits) + ' || exit 1\n'
+
+
+def _communicate_rusage(proc):
+    """
+    Same as proc.communicate(), but the child is waited for with
+    os.wait4 to obtain its resource usage (communicate would reap
+    the child w/o giving access to the rusage information)
+
+    :param proc:
+    :return: stdout, stderr and resource usage of the child
+     :rtype: bytes, bytes, resource.struct_rusage
+    """
+    buffers = {'out': [], 'err': []}
+
+    def drain(stream, key):
+        for chunk in iter(lambda: stream.read(65536), b''):
+            buffers[key].append(chunk)
+        stream.close()
+
+    readers = [thd.Thread(target=drain, args=(stream, key)) for stream, key in
+               [(proc.stdout, 'out'), (proc.stderr, 'err')] if stream is not None]
+    for r in readers:
+        r.start()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    # same convention as subprocess: negative signal number if killed by a signal
+    if os.WIFEXITED(status):
+        proc.returncode = os.WEXITSTATUS(status)
+    elif os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = status
+    for r in readers:
+        r.join()
+    return b''.join(buffers['out']), b''.join(buffers['err']), rusage
+
+
+def _format_rusage(rusage, wallclock):
+    """
+    :param rusage:
+    :param wallclock: seconds
+    :return: accounting line, similar to what the grid engine reports
+    """
+    return 'Resource usage: wallclock {:.2f} s - user {:.2f} s - system {:.2f} s -' \
+           ' MAXRSS {} kB'.format(wallclock, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+
+
+_LOCAL_JOB_IDS = itt.count(1)
+
+
+def _open_output_files(outpath, errpath, jobname):
+    """
+    Output files of local jobs mirror the naming scheme of the grid
+    engine (JOBNAME.o<ID>, JOBNAME.e<ID>); the numeric ID combines
+    the process ID of the runner and a running number
+
+    :param outpath: folder for stdout
+    :param errpath: folder for stderr, if None, outpath is used
+    :param jobname:
+    :return: job ID and file objects for stdout and stderr
+    """
+    jid = '{}{:06d}'.format(os.getpid(), next(_LOCAL_JOB_IDS))
+    errpath = outpath if errpath is None or not os.path.isdir(errpath) else errpath
+    outfile = open(os.path.join(outpath, '{}.o{}'.format(jobname, jid)), 'wb')
+    try:
+        errfile = open(os.path.join(errpath, '{}.e{}'.format(jobname, jid)), 'wb')
+    except OSError:
+        outfile.close()
+        raise
+    return jid, outfile, errfile
+
+
 @exec_env
-def custom_systemcall(cmd, workdir=None, env=None):
+def custom_systemcall(cmd, workdir=None, env=None, rusage=False, max_mem=None, max_cputime=None,
+                      outpath=None, errpath=None, jobname='SCIjob', excerpt=None):
     """
     :param cmd:
     :param workdir:
     :param env:
+    :param rusage: append resource usage (wallclock, CPU, max. RSS) to the output
+    :param max_mem: limit for virtual memory of the command (bytes)
+    :param max_cputime: limit for CPU time of the command (seconds)
+    :param outpath: if given, stdout/stderr of the command are written directly to files
+     in this folder (and errpath) instead of being passed through the runner process;
+     only the excerpt of these files is returned (see _read_output_file)
+    :param errpath:
+    :param jobname: name prefix of the output files
+    :param excerpt: keyword arguments for reading output files (head, tail, keywords)
     :return:
     """
     out, err = '', ''
     try:
-        proc = sp.Popen(cmd, cwd=workdir, env=env, shell=True,
-                        stdout=sp.PIPE, stderr=sp.PIPE, executable='/bin/bash')
-        out, err = proc.communicate()
+        limits = ''
+        if max_mem is not None or max_cputime is not None:
+            limits = _limit_resources(max_mem, max_cputime)
+        start = time.time()
+        if outpath:
+            jid, stdout, stderr = _open_output_files(outpath, errpath, jobname)
+        else:
+            jid, stdout, stderr = None, sp.PIPE, sp.PIPE
+        try:
+            proc = sp.Popen(limits + cmd, cwd=workdir, env=env, shell=True,
+                            stdout=stdout, stderr=stderr, executable='/bin/bash')
+        finally:
+            if jid is not None:
+                stdout.close()
+                stderr.close()
+        if rusage:
+            out, err, usage = _communicate_rusage(proc)
+        else:
+            out, err = proc.communicate()
+        if jid is not None:
+            excerpt = dict() if excerpt is None else excerpt
+            out = _read_output_file(os.path.dirname(stdout.name), os.path.basename(stdout.name),
+                                    **excerpt).encode('utf-8')
+            err = _read_output_file(os.path.dirname(stderr.name), os.path.basename(stderr.name),
+                                    **excerpt).encode('utf-8')
         if proc.returncode != 0:
             out = out.decode('utf-8')
             err = 'ERROR from call: {}\nExit code: {}\nMessage: {}'.format(cmd, proc.returncode, err.decode('utf-8'))
         else:
             out, err = out.decode('utf-8'), err.decode('utf-8')
+        if rusage:
+            out += '\n' + _format_rusage(usage, time.time() - start)
     except Exception as e:
         err = 'ERROR during call: {}\nMessage: {}'.format(cmd, str(e))
     finally:
         return out, err
+
+
+def preload_modules(modules):
+    """
+    Initializer for worker processes of a process pool: import
+    modules once so that the jobs do not pay the import costs
+
+    :param modules: list of module names
+    :return: None
+    """
+    for mod in modules:
+        _ = imp.import_module(mod)
+    return
+
+
+def python_call(func, *args, pool=None):
+    """
+    Execute a Python callable in a (persistent) process pool;
+    exceptions raised by the callable are raised in the caller
+
+    :param func: must be picklable, i.e. defined at module level
+    :param args:
+    :param pool:
+     :type: multiprocessing.pool.Pool
+    :return: return value of func
+    """
+    assert pool is not None, 'No process pool for Python job: {}'.format(func)
+    return pool.apply(func, args)
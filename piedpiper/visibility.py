@@ -0,0 +1,90 @@
+# coding=utf-8
+
+"""
+Module to verify that the output files of finished jobs are visible. On shared
+(network) filesystems such as NFS, the attribute caching of the client can hide
+files that were just written on a compute node for a few seconds. Instead of
+declaring a job failed on the first miss, the expected files are checked again
+with exponentially increasing delays up to a timeout. Files are checked with stat;
+only after a miss, the parent folder is listed, which makes the client revalidate
+its cached view of the folder, and the missing files are checked again. Files in
+different folders are checked in parallel.
+"""
+
+import os as os
+import time as time
+import collections as col
+import concurrent.futures as cf
+
+# seconds to wait for missing files in total (default,
+# see SysCallInterface for the config key visibility_timeout)
+VISIBILITY_TIMEOUT = 30
+# delay before the first re-check, doubled for each further check
+VISIBILITY_DELAY = 0.5
+VISIBILITY_MAX_DELAY = 8
+VISIBILITY_WORKERS = 8
+
+
+def _missing_in_folder(folder, files):
+    """
+    :param folder:
+    :param files: paths in folder
+    :return: all paths that are not (regular) files
+     :rtype: list of str
+    """
+    missing = [f for f in files if not os.path.isfile(f)]
+    if not missing:
+        return missing
+    try:
+        _ = os.listdir(folder)
+    except OSError:
+        return missing
+    return [f for f in missing if not os.path.isfile(f)]
+
+
+def missing_files(paths, workers=VISIBILITY_WORKERS):
+    """
+    Check many paths at once: a folder is listed at most once,
+    and only if some of its files are missing
+
+    :param paths:
+    :param workers: number of folders checked in parallel
+    :return: all paths that are not (regular) files
+     :rtype: list of str
+    """
+    by_folder = col.defaultdict(list)
+    for p in paths:
+        by_folder[os.path.dirname(os.path.abspath(p))].append(p)
+    if len(by_folder) < 2 or workers < 2:
+        return [f for folder, files in by_folder.items() for f in _missing_in_folder(folder, files)]
+    missing = []
+    with cf.ThreadPoolExecutor(max_workers=min(workers, len(by_folder))) as pool:
+        for result in pool.map(lambda item: _missing_in_folder(*item), by_folder.items()):
+            missing.extend(result)
+    return missing
+
+
+def wait_visible(paths, timeout=None, delay=VISIBILITY_DELAY,
+                 max_delay=VISIBILITY_MAX_DELAY, workers=VISIBILITY_WORKERS):
+    """
+    Check the paths until all of them are visible as files or the timeout expires
+
+    :param paths:
+    :param timeout: seconds; 0 = check only once, None = VISIBILITY_TIMEOUT
+    :param delay: seconds before the first re-check
+    :param max_delay: upper bound for the delay between checks
+    :param workers: see missing_files
+    :return: paths that are still missing after the timeout
+     :rtype: list of str
+    """
+    timeout = VISIBILITY_TIMEOUT if timeout is None else timeout
+    deadline = time.time() + timeout
+    missing = missing_files(paths, workers)
+    while missing:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+        missing = missing_files(missing, workers)
+    return missing
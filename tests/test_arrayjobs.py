@@ -0,0 +1,232 @@
+# coding=utf-8
+
+"""
+Tests for the DRMAA array job functions, using a fake DRMAA session
+that runs all tasks synchronously as local subprocesses
+"""
+
+import os as os
+import functools as fnt
+import itertools as itt
+import collections as col
+import subprocess as sp
+
+import pytest as pytest
+
+import piedpiper.syscalls as sc
+import piedpiper.jobfunctions as jf
+from piedpiper.monitor import StragglerMonitor
+from piedpiper.syscallinterface import SysCallInterface
+
+
+JobInfo = col.namedtuple('JobInfo', 'jobId hasExited hasSignal terminatedSignal hasCoreDump'
+                                    ' wasAborted exitStatus resourceUsage')
+
+
+class FakeJobTemplate(object):
+
+    def __init__(self, logdir):
+        self.jobName = 'ppjob'
+        self.outputPath = ':' + logdir
+        self.errorPath = ':' + logdir
+        self.remoteCommand = ''
+        self.args = []
+
+
+class FakeSession(object):
+    """
+    Minimal stand-in for drmaa.Session: tasks are executed immediately
+    when submitted, stdout/stderr are written to <jobName>.o<jid> and
+    <jobName>.e<jid> as the grid engine would do
+    """
+    TIMEOUT_WAIT_FOREVER = -1
+
+    def __init__(self, logdir, task_suffix=True):
+        self.logdir = logdir
+        self.task_suffix = task_suffix
+        self.jobs = dict()
+        self.submitted = []
+        self._ids = itt.count(100)
+
+    def _run(self, jobtemplate, jid, task):
+        env = dict(os.environ)
+        env['SGE_TASK_ID'] = str(task)
+        if os.path.isfile(jobtemplate.remoteCommand):
+            call = [jobtemplate.remoteCommand]
+        else:
+            call = ['bash', '-c', jobtemplate.remoteCommand, 'bash']
+        outfile = os.path.join(self.logdir, '{}.o{}'.format(jobtemplate.jobName, jid))
+        errfile = os.path.join(self.logdir, '{}.e{}'.format(jobtemplate.jobName, jid))
+        with open(outfile, 'w') as out, open(errfile, 'w') as err:
+            self.jobs[jid] = sp.call(call + list(jobtemplate.args), stdout=out, stderr=err, env=env)
+
+    def runBulkJobs(self, jobtemplate, start, end, step):
+        self.submitted.append((jobtemplate.remoteCommand, list(jobtemplate.args), start, end, step))
+        base = next(self._ids)
+        jids = []
+        for task in range(start, end + 1, step):
+            jid = '{}.{}'.format(base, task) if self.task_suffix else str(next(self._ids))
+            self._run(jobtemplate, jid, task)
+            jids.append(jid)
+        return jids
+
+    def jobStatus(self, jid):
+        return 'done' if self.jobs[jid] == 0 else 'failed'
+
+    def synchronize(self, jids, timeout, dispose=False):
+        pass
+
+    def wait(self, jid, timeout):
+        return JobInfo(jid, True, False, '', False, False, self.jobs[jid], dict())
+
+    def control(self, jid, action):
+        pass
+
+
+@pytest.fixture
+def session(tmpdir):
+    return FakeSession(str(tmpdir.mkdir('logs')))
+
+
+@pytest.fixture
+def jobtemplate(session):
+    return FakeJobTemplate(session.logdir)
+
+
+def test_arrayjob_runs_all_tasks(session, jobtemplate):
+    out, err = sc.drmaa_arrayjob('echo task $SGE_TASK_ID', jobtemplate, session, -1, sc.FairLock(), 2, 6, 2)
+    assert session.submitted == [('echo task $SGE_TASK_ID', [], 2, 6, 2)]
+    assert out.startswith('ArrayJob 100.2 submitted')
+    for task in (2, 4, 6):
+        assert 'task {}'.format(task) in out
+    assert 'task 3' not in out
+    assert 'Error' not in err
+
+
+def test_arrayjob_reports_failed_tasks(session, jobtemplate):
+    out, err = sc.drmaa_arrayjob('test $SGE_TASK_ID -ne 2', jobtemplate, session, -1, sc.FairLock(), 1, 3, 1)
+    assert err.count('Exit 1 - Error') == 1
+
+
+def test_arrayjob_argv_passes_arguments(session, jobtemplate):
+    out, err = sc.drmaa_arrayjob_argv('echo "$SGE_TASK_ID:$1:$2"', ['a', 7], jobtemplate, session, -1,
+                                      sc.FairLock(), 1, 2, 1)
+    assert session.submitted[0][1] == ['a', '7']
+    assert '1:a:7' in out and '2:a:7' in out
+    assert 'Error' not in err
+
+
+def test_arrayjob_table_per_task_arguments(session, jobtemplate, tmpdir):
+    argvs = [['first', 'x y'], ['second', "it's"], ['third', '$HOME']]
+    tabledir = str(tmpdir.mkdir('tables'))
+    results = sc.drmaa_arrayjob_table('printf "%s|"', argvs, jobtemplate, session, -1, sc.FairLock(),
+                                      tabledir=tabledir)
+    assert [r.task for r in results] == [1, 2, 3]
+    assert [r.jobid for r in results] == ['100.1', '100.2', '100.3']
+    for res, argv in zip(results, argvs):
+        assert isinstance(res, sc.TaskResult)
+        assert res.exitstatus == 0 and res.aborted is False
+        # quoted arguments reach the command unchanged
+        assert '{}|{}|'.format(*argv) in res.out
+        assert 'Error' not in res.err
+    # argument table and driver script are removed afterwards
+    assert os.listdir(tabledir) == []
+
+
+def test_arrayjob_table_keeps_table(session, jobtemplate, tmpdir):
+    tabledir = str(tmpdir.mkdir('tables'))
+    _ = sc.drmaa_arrayjob_table('echo', [['a'], ['b c']], jobtemplate, session, -1, sc.FairLock(),
+                                tabledir=tabledir, keeptable=True)
+    kept = os.listdir(tabledir)
+    assert len(kept) == 1
+    with open(os.path.join(tabledir, kept[0], 'argv.txt')) as table:
+        assert table.read() == "a\n'b c'\n"
+
+
+def test_arrayjob_table_failed_task(session, jobtemplate, tmpdir):
+    results = sc.drmaa_arrayjob_table('exit', [[0], [3]], jobtemplate, session, -1, sc.FairLock(),
+                                      tabledir=str(tmpdir))
+    assert [r.exitstatus for r in results] == [0, 3]
+    assert 'Exit 3 - Error' in results[1].err
+
+
+def test_arrayjob_table_without_task_ids(jobtemplate, tmpdir):
+    session = FakeSession(jobtemplate.outputPath.strip(':'), task_suffix=False)
+    with pytest.raises(AssertionError) as excinfo:
+        _ = sc.drmaa_arrayjob_table('echo', [['a'], ['b']], jobtemplate, session, -1, sc.FairLock(),
+                                    tabledir=str(tmpdir))
+    assert 'Cannot determine task ID' in str(excinfo.value)
+
+
+def test_arrayjob_table_requires_tasks(session, jobtemplate):
+    with pytest.raises(AssertionError):
+        _ = sc.drmaa_arrayjob_table('echo', [], jobtemplate, session, -1, sc.FairLock())
+
+
+def test_arrayjob_table_rejects_line_breaks(session, jobtemplate, tmpdir):
+    tabledir = str(tmpdir.mkdir('tables'))
+    with pytest.raises(AssertionError) as excinfo:
+        _ = sc.drmaa_arrayjob_table('echo', [['a'], ['b\nc']], jobtemplate, session, -1, sc.FairLock(),
+                                    tabledir=tabledir)
+    assert 'line breaks' in str(excinfo.value)
+    assert session.submitted == [] and os.listdir(tabledir) == []
+
+
+def test_bulk_rejects_line_breaks(session, jobtemplate, tmpdir):
+    syscall = fnt.partial(sc.drmaa_arrayjob_argv, jobtemplate=jobtemplate, session=session, waitforever=-1,
+                          lock=sc.FairLock())
+    infile = tmpdir.join('in\nput.txt')
+    infile.write('content')
+    with pytest.raises(AssertionError) as excinfo:
+        _ = jf.syscall_bulk_in_out([(str(infile), str(tmpdir.join('out.txt')))], 'cat {inputfile} > {outputfile}',
+                                   syscall, tabledir=str(tmpdir))
+    assert 'line breaks' in str(excinfo.value)
+    assert session.submitted == []
+
+
+def test_bulk_speculative_copies_write_private_outputs(session, jobtemplate, tmpdir):
+    syscall = fnt.partial(sc.drmaa_arrayjob_argv, jobtemplate=jobtemplate, session=session, waitforever=-1,
+                          lock=sc.FairLock(), monitor=StragglerMonitor(poll=0))
+    syscall.takes_outputs = True
+    syscall.speculative = True
+    indir, outdir = tmpdir.mkdir('in'), tmpdir.mkdir('out')
+    jobs = []
+    for num in range(3):
+        infile = indir.join('f{}.txt'.format(num))
+        infile.write('content {}'.format(num))
+        jobs.append((str(infile), str(outdir.join('f{}.out'.format(num)))))
+    outputs = jf.syscall_bulk_in_out(jobs, 'cat {inputfile} > {outputfile}', syscall, tabledir=str(tmpdir),
+                                     keeptable=True)
+    assert outputs == [o for _, o in jobs]
+    with open(session.submitted[0][1][0]) as table:
+        assert table.read().count('"$PP_COPY"') == 3 * 3
+    # private folders of the copies are removed
+    assert sorted(os.listdir(str(outdir))) == ['f0.out', 'f1.out', 'f2.out']
+    assert outdir.join('f2.out').read() == 'content 2'
+
+
+@pytest.mark.parametrize('start, end, step, expected', [
+    (None, None, 1, dict()),
+    (1, None, 1, {'start': 1, 'end': 1, 'step': 1}),
+    (1, 10, 3, {'start': 1, 'end': 10, 'step': 3}),
+    (5, 5, 1, {'start': 5, 'end': 5, 'step': 1}),
+])
+def test_task_range(start, end, step, expected):
+    assert SysCallInterface._task_range(start, end, step) == expected
+
+
+@pytest.mark.parametrize('start, end, step', [
+    (0, 5, 1),
+    (3, 2, 1),
+    (1, 5, 0),
+    (-1, 5, 1),
+])
+def test_task_range_invalid(start, end, step):
+    with pytest.raises(AssertionError):
+        _ = SysCallInterface._task_range(start, end, step)
+
+
+def test_task_id():
+    assert sc._task_id('12345.7') == 7
+    assert sc._task_id('12345') is None
+    assert sc._task_id('12345.x') is None